@@ -0,0 +1,123 @@
+"""
+Import-time benchmark of the data modules
+
+Every module is imported in a fresh interpreter, so nothing is shared
+between measurements. The run fails if a data module loads a plotting or
+forecasting library, or if its import got slower than the stored baseline
+by more than the tolerance.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --save-baseline
+
+Like benchmarks/run.py, no baseline is committed: store one with
+--save-baseline on the machine that runs the comparisons. Without one the
+heavy-library check still runs and the timing check warns, or fails with
+--require-baseline.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+data_modules = [
+    'src.accidents.accidents_data',
+    'src.econ.data',
+    'src.sdge.data',
+    'src.mobility.data',
+    'src.air_quality.air_quality_analysis',
+]
+
+# Libraries data modules must only load when plotting or forecasting
+heavy_modules = ['matplotlib', 'fbprophet', 'pystan', 'cmdstanpy']
+
+probe = """
+import sys, json, time, resource
+import numpy, pandas
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+__import__({module!r})
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    'seconds': seconds,
+    'rss_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024,
+    'heavy': sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r})),
+}}))
+"""
+
+
+def measure(module, repeat=5):
+    """
+    Parameters
+    ----------
+    module : str
+        Dotted module name
+    repeat : int
+        Number of fresh interpreters, the fastest run is kept
+
+    Returns
+    -------
+    Dict with the import time in seconds and the RSS growth in MB of the
+    fastest run, and the heavy libraries loaded by the import. numpy and
+    pandas are imported before the clock starts, every module needs them
+    """
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, '-c', probe.format(module=module, heavy=heavy_modules)],
+            cwd=root, check=True, capture_output=True, text=True
+        )
+        runs.append(json.loads(out.stdout))
+    return min(runs, key=lambda run: run['seconds'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per module')
+    parser.add_argument('--baseline', default=os.path.join(root, 'benchmarks', 'import_time_baseline.json'))
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed slowdown factor over the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--require-baseline', action='store_true', help='fail when a module has no baseline to compare with')
+    args = parser.parse_args(argv)
+
+    results = {module: measure(module, args.repeat) for module in data_modules}
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.save_baseline:
+        print('WARNING no baseline at {}, import times are not compared; '
+              'store one with --save-baseline'.format(args.baseline), file=sys.stderr)
+
+    failures = []
+    print('{:<40}{:>10}{:>10}{:>10}  {}'.format('module', 'ms', 'base ms', 'RSS MB', 'heavy'))
+    for module, result in results.items():
+        base = baseline.get(module, {}).get('seconds')
+        print('{:<40}{:>10.1f}{:>10}{:>10.1f}  {}'.format(
+            module, result['seconds'] * 1e3, '-' if base is None else '{:.1f}'.format(base * 1e3),
+            result['rss_mb'], ', '.join(result['heavy'])
+        ))
+        if result['heavy']:
+            failures.append('{} imports {}'.format(module, ', '.join(result['heavy'])))
+        # A floor of 10 ms keeps timer noise on tiny imports from failing the run
+        if base is not None and result['seconds'] > max(base * args.tolerance, base + 0.01):
+            failures.append('{} import is {:.1f}x slower than the baseline'.format(module, result['seconds'] / base))
+
+    missing = [] if args.save_baseline else [module for module in results if module not in baseline]
+    if baseline and missing:
+        print('WARNING not in the baseline, not compared: ' + ', '.join(missing), file=sys.stderr)
+    if args.require_baseline and missing:
+        failures.append('no baseline for ' + ', '.join(missing))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    for failure in failures:
+        print('FAIL ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+"""
+Benchmarks of the ingestion and aggregation hot paths on synthetic data
+
+Inputs are generated by benchmarks/synthetic.py with fixed seeds, so runs
+are offline and comparable. Each case records the fastest wall time over
+--repeat runs and the peak traced allocation of one extra run, writes them
+to JSON and compares them with a stored baseline. Fast paths with a
+reference implementation are first checked against it.
+
+    python benchmarks/run.py --sizes small,medium
+    python benchmarks/run.py --save-baseline
+    python benchmarks/run.py --only accidents
+
+Baselines depend on the machine, so none is committed: store one with
+--save-baseline on the machine that runs the comparisons, and again after
+an intended change in speed. Without a baseline, or for cases missing
+from it, the run warns, and fails with --require-baseline.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic
+from src.accidents.accidents_cube import build_cube, query_cube
+from src.accidents.accidents_data import ingestion_and_clean
+from src.accidents.accidents_graph import prepare_series
+from src.accidents.accidents_spatial import build_grid, count_bbox, count_radius, hotspot_deltas
+from src.accidents.accidents_store import build_partitioned_dataset, query_accidents
+from src.air_quality.air_quality_analysis import (
+    month_enum, selected_sites, get_2019_urls, get_2020_urls, get_year_features, get_normalized_features
+)
+from src.econ import data as econ_data
+from src.econ.trend import make_trend
+from src.mobility.data import read_mobility_data, read_mobility_regions, ingest_filter_data
+from src.sdge.data import read_sdge_range, get_avgkwh_per_customer_month
+
+# Multiplier of the base size of every generator
+sizes = {'small': 1, 'medium': 4, 'large': 16}
+
+
+def generate(data_dir, scale, seed=0):
+    """
+    Parameters
+    ----------
+    data_dir : str
+        Directory of the generated inputs. Inputs of a scale already there
+        are reused
+    scale : int
+        Multiplier of the base size of every generator
+    seed : int
+        Seed of the generators
+
+    Returns
+    -------
+    Dict of the input paths
+    """
+    folder = os.path.join(data_dir, 'scale-{}-seed-{}'.format(scale, seed))
+    paths = {
+        'accidents': os.path.join(folder, 'accidents', 'US_Accidents_June20.csv'),
+        'econ': os.path.join(folder, 'econ', 'sd_businesses_active_since08_datasd_v1.csv'),
+        'air_quality': os.path.join(folder, 'air_quality', ''),
+        'sdge': os.path.join(folder, 'sdge', ''),
+        'mobility': os.path.join(folder, 'mobility', ''),
+    }
+    done_fp = os.path.join(folder, 'done')
+    if os.path.exists(done_fp):
+        paths['air_quality_urls'] = (
+            get_2019_urls(month_enum, paths['air_quality']),
+            get_2020_urls(month_enum, paths['air_quality']),
+        )
+        return paths
+
+    for key in ['accidents', 'econ']:
+        os.makedirs(os.path.dirname(paths[key]), exist_ok=True)
+    synthetic.write_accidents_csv(paths['accidents'], 20000 * scale, seed)
+    synthetic.write_econ_csv(paths['econ'], 50000 * scale, seed)
+    paths['air_quality_urls'] = synthetic.write_air_quality_files(paths['air_quality'], 2 * scale, seed)
+    synthetic.write_sdge_csvs(paths['sdge'], 300 * scale, seed)
+    synthetic.write_mobility_csv(paths['mobility'], n_states=10 * scale, seed=seed)
+    open(done_fp, 'w').close()
+    return paths
+
+
+def _load(paths, key, cache):
+    """
+    Inputs shared by several cases, built once per scale outside the clock
+    """
+    if key not in cache:
+        urls_2019, urls_2020 = paths['air_quality_urls']
+        loaders = {
+            'accidents': lambda: ingestion_and_clean(paths['accidents']),
+            'accidents_cube': lambda: build_cube(_load(paths, 'accidents', cache)),
+            'accidents_grid': lambda: build_grid(_load(paths, 'accidents', cache)),
+            'accidents_dataset': lambda: build_partitioned_dataset(
+                paths['accidents'], os.path.join(os.path.dirname(paths['accidents']), 'partitioned')
+            ),
+            'econ': lambda: econ_data.ingest_and_clean(paths['econ']),
+            'air_quality': lambda: (get_year_features(urls_2019, 2019), get_year_features(urls_2020, 2020)),
+            'air_quality_frame': lambda: (
+                get_year_features(urls_2019, 2019, as_frame=True), get_year_features(urls_2020, 2020, as_frame=True)
+            ),
+            'sdge': lambda: read_sdge_range(paths['sdge'], ['2019'], types=['ELEC'])[0],
+            'mobility': lambda: read_mobility_data(paths['mobility']),
+        }
+        cache[key] = loaders[key]()
+    return cache[key]
+
+
+# Case name to a function of (paths, cache) returning the call to measure
+cases = {
+    'accidents.ingestion_and_clean': lambda p, c: lambda: ingestion_and_clean(p['accidents']),
+    'accidents.prepare_series': lambda p, c: (
+        lambda df=_load(p, 'accidents', c): prepare_series(df, field='RushHour', timestamp='2019-09-09', freq='W')
+    ),
+    'accidents.build_cube': lambda p, c: lambda df=_load(p, 'accidents', c): build_cube(df),
+    'accidents.query_cube': lambda p, c: (
+        lambda cube=_load(p, 'accidents_cube', c): query_cube(cube, field='Zipcode', timestamp='2019-09-09', freq='W')
+    ),
+    'accidents.build_grid': lambda p, c: lambda df=_load(p, 'accidents', c): build_grid(df),
+    'accidents.count_bbox_x100': lambda p, c: (
+        lambda grid=_load(p, 'accidents_grid', c): [
+            count_bbox(grid, 32.5 + i * 0.005, 32.6 + i * 0.005, -117.2, -117.0) for i in range(100)
+        ]
+    ),
+    'accidents.count_radius_x100': lambda p, c: (
+        lambda grid=_load(p, 'accidents_grid', c): [count_radius(grid, 32.5 + i * 0.005, -117.1, 2) for i in range(100)]
+    ),
+    'accidents.hotspot_deltas': lambda p, c: (
+        lambda grid=_load(p, 'accidents_grid', c): hotspot_deltas(grid, '2019-09-09', days=90)
+    ),
+    'accidents.query_accidents': lambda p, c: (
+        lambda dataset_dir=_load(p, 'accidents_dataset', c): query_accidents(dataset_dir, 'San Diego')
+    ),
+    'econ.ingest_and_clean': lambda p, c: lambda: econ_data.ingest_and_clean(p['econ']),
+    'econ.aggregate_on': lambda p, c: (
+        lambda df=_load(p, 'econ', c): econ_data.aggregate_on(df, 'date_account_creation', period='W')
+    ),
+    'econ.make_trend': lambda p, c: (
+        lambda s=econ_data.aggregate_on(_load(p, 'econ', c), 'date_account_creation', period='W'): make_trend(s)
+    ),
+    'air_quality.get_features': lambda p, c: (
+        lambda urls=p['air_quality_urls'][0]: get_year_features(urls, 2019)
+    ),
+    'air_quality.get_features_frame': lambda p, c: (
+        lambda urls=p['air_quality_urls'][0]: get_year_features(urls, 2019, as_frame=True)
+    ),
+    'air_quality.get_normalized_features': lambda p, c: (
+        lambda f=_load(p, 'air_quality', c): get_normalized_features(f[0], f[1], selected_sites)
+    ),
+    'sdge.read_sdge_range': lambda p, c: lambda: read_sdge_range(p['sdge'], ['2019', '2020'], types=['ELEC']),
+    'sdge.get_avgkwh_per_customer_month': lambda p, c: (
+        lambda data=_load(p, 'sdge', c): get_avgkwh_per_customer_month(data)
+    ),
+    'mobility.ingest_filter_data': lambda p, c: (
+        lambda df=_load(p, 'mobility', c): ingest_filter_data(df)
+    ),
+    'mobility.read_mobility_regions': lambda p, c: lambda: read_mobility_regions(p['mobility']),
+}
+
+
+def check_query_cube(paths, cache):
+    """
+    Assert that query_cube returns the frame of prepare_series for every
+    field of the cube, on a few frequencies and timestamps
+    """
+    df, cube = _load(paths, 'accidents', cache), _load(paths, 'accidents_cube', cache)
+    for field in cube.cumulative:
+        for freq in ['h', 'D', 'W', 'MS']:
+            for timestamp in ['2016-01-01', '2019-09-09 13:30', '2030-01-01']:
+                expected = prepare_series(df, field=field, timestamp=timestamp, freq=freq)
+                # Empty frames differ only in the integer width of their categorical codes
+                pd.testing.assert_frame_equal(query_cube(cube, field=field, timestamp=timestamp, freq=freq),
+                                              expected, check_categorical=not expected.empty,
+                                              obj='query_cube({}, {}, {})'.format(field, timestamp, freq))
+
+
+def check_normalized_features(paths, cache):
+    """
+    Assert that get_normalized_features returns the same series for the
+    lists and the frames of the same daily files
+    """
+    lists, frames = _load(paths, 'air_quality', cache), _load(paths, 'air_quality_frame', cache)
+    overall, sites = get_normalized_features(lists[0], lists[1], selected_sites)
+    frame_overall, frame_sites = get_normalized_features(frames[0], frames[1], selected_sites)
+    np.testing.assert_allclose(frame_overall, overall, rtol=1e-12, atol=1e-12)
+    for site in selected_sites:
+        np.testing.assert_allclose(frame_sites[site], sites[site], rtol=1e-12, atol=1e-12, err_msg=site)
+
+
+# Case name to a function of the same inputs raising AssertionError when a
+# fast path stops matching the reference one
+checks = {
+    'accidents.query_cube': check_query_cube,
+    'air_quality.get_normalized_features': check_normalized_features,
+}
+
+
+def measure(call, repeat=3):
+    """
+    Parameters
+    ----------
+    call : callable
+        Function without arguments
+    repeat : int
+        Number of timed runs
+
+    Returns
+    -------
+    Dict with the fastest wall time in seconds and the peak memory in MB
+    traced during one extra run. Tracing slows the run down, so it is kept
+    out of the timings
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'peak_mb': peak / 2**20}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Parameters
+    ----------
+    results, baseline : dict
+        Case key to the output of measure
+    tolerance : float
+        Allowed slowdown or memory growth factor
+
+    Returns
+    -------
+    List of the regressions as messages
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        # Floors keep timer and allocator noise on tiny cases from failing the run
+        if result['seconds'] > max(base['seconds'] * tolerance, base['seconds'] + 0.01):
+            regressions.append('{} is {:.2f}x slower'.format(key, result['seconds'] / base['seconds']))
+        if result['peak_mb'] > max(base['peak_mb'] * tolerance, base['peak_mb'] + 1):
+            regressions.append('{} peaks {:.2f}x higher'.format(key, result['peak_mb'] / base['peak_mb']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default='small,medium', help='comma separated subset of: ' + ', '.join(sizes))
+    parser.add_argument('--only', default='', help='run the cases whose name contains this text')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generators')
+    parser.add_argument('--data-dir', default=None, help='keep generated inputs here, a temporary folder by default')
+    parser.add_argument('--out', default=os.path.join(root, 'benchmarks', 'results.json'))
+    parser.add_argument('--baseline', default=os.path.join(root, 'benchmarks', 'baseline.json'))
+    parser.add_argument('--tolerance', type=float, default=1.3, help='allowed slowdown factor over the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--require-baseline', action='store_true', help='fail when a case has no baseline to compare with')
+    args = parser.parse_args(argv)
+
+    selected_sizes = [size for size in args.sizes.split(',') if size]
+    assert all(size in sizes for size in selected_sizes), "Unknown size"
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='benchmarks-')
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    elif not args.save_baseline:
+        print('WARNING no baseline at {}, nothing will be compared; '
+              'store one with --save-baseline'.format(args.baseline), file=sys.stderr)
+
+    results, mismatches = {}, []
+    print('{:<48}{:>10}{:>10}{:>10}'.format('case', 'ms', 'base ms', 'peak MB'))
+    try:
+        for size in selected_sizes:
+            paths = generate(data_dir, sizes[size], args.seed)
+            cache = {}
+            for name, check in checks.items():
+                if args.only in name:
+                    try:
+                        check(paths, cache)
+                    except AssertionError as e:
+                        message = next((line.strip() for line in str(e).splitlines() if line.strip()), '')
+                        mismatches.append('{}@{}: {}'.format(name, size, message))
+            for name, make_call in cases.items():
+                if args.only not in name:
+                    continue
+                key = '{}@{}'.format(name, size)
+                results[key] = measure(make_call(paths, cache), args.repeat)
+                base = baseline.get(key, {}).get('seconds')
+                print('{:<48}{:>10.1f}{:>10}{:>10.1f}'.format(
+                    key, results[key]['seconds'] * 1e3,
+                    '-' if base is None else '{:.1f}'.format(base * 1e3), results[key]['peak_mb']
+                ))
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'repeat': args.repeat, 'seed': args.seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    with open(args.baseline if args.save_baseline else args.out, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    for mismatch in mismatches:
+        print('MISMATCH ' + mismatch)
+    missing = [] if args.save_baseline else [key for key in results if key not in baseline]
+    if baseline and missing:
+        print('WARNING not in the baseline, not compared: ' + ', '.join(missing), file=sys.stderr)
+    return 1 if regressions or mismatches or (args.require_baseline and missing) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
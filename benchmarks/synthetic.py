@@ -0,0 +1,277 @@
+"""
+Seeded generators of synthetic inputs laid out like the real data files
+
+Every generator writes files with the columns, value formats and quirks
+the readers in src/ expect (mixed counties, ZIP+4 codes, broken econ date
+prefixes, "M" air quality readings, region header rows), so the
+benchmarks exercise the same code paths as the multi-GB originals.
+"""
+import os
+import csv
+import itertools
+import numpy as np
+import pandas as pd
+
+from src.air_quality.air_quality_analysis import month_enum, selected_sites, get_2019_urls, get_2020_urls
+
+
+accident_columns = [
+    'ID', 'Source', 'TMC', 'Severity', 'Start_Time', 'End_Time', 'Start_Lat', 'Start_Lng',
+    'End_Lat', 'End_Lng', 'Distance(mi)', 'Description', 'Number', 'Street', 'Side', 'City',
+    'County', 'State', 'Zipcode', 'Country', 'Timezone', 'Airport_Code', 'Weather_Timestamp',
+    'Temperature(F)', 'Wind_Chill(F)', 'Humidity(%)', 'Pressure(in)', 'Visibility(mi)',
+    'Wind_Direction', 'Wind_Speed(mph)', 'Precipitation(in)', 'Weather_Condition', 'Amenity',
+    'Bump', 'Crossing', 'Give_Way', 'Junction', 'No_Exit', 'Railway', 'Roundabout', 'Station',
+    'Stop', 'Traffic_Calming', 'Traffic_Signal', 'Turning_Loop', 'Sunrise_Sunset',
+    'Civil_Twilight', 'Nautical_Twilight', 'Astronomical_Twilight'
+]
+accident_flags = [
+    'Amenity', 'Bump', 'Crossing', 'Give_Way', 'Junction', 'No_Exit', 'Railway', 'Roundabout',
+    'Station', 'Stop', 'Traffic_Calming', 'Traffic_Signal', 'Turning_Loop'
+]
+
+percent_change_columns = [
+    'retail_and_recreation', 'grocery_and_pharmacy', 'parks', 'transit_stations',
+    'workplaces', 'residential'
+]
+
+
+def write_accidents_csv(path, n_rows, seed=0, san_diego_share=0.3):
+    """
+    Parameters
+    ----------
+    path : str
+        Output CSV file
+    n_rows : int
+        Number of accidents, across several counties
+    seed : int
+        Seed of the generator
+    san_diego_share : float
+        Fraction of the rows in San Diego County
+
+    Returns
+    -------
+    path
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('2016-02-01') + pd.to_timedelta(rng.integers(0, 4 * 365 * 86400, n_rows), unit='s')
+    end = start + pd.to_timedelta(rng.integers(60, 7200, n_rows), unit='s')
+    zipcode = rng.integers(91900, 92200, n_rows).astype(str)
+
+    df = pd.DataFrame({col: np.nan for col in accident_columns}, index=pd.RangeIndex(n_rows))
+    df['ID'] = pd.Series(np.arange(n_rows)).map('A-{}'.format)
+    df['Source'] = 'MapQuest'
+    df['TMC'] = rng.choice([201.0, 241.0, np.nan], n_rows)
+    df['Severity'] = rng.integers(1, 5, n_rows)
+    df['Start_Time'] = start.strftime('%Y-%m-%d %H:%M:%S')
+    df['End_Time'] = end.strftime('%Y-%m-%d %H:%M:%S')
+    df['Start_Lat'] = 32.5 + rng.random(n_rows) * 0.8
+    df['Start_Lng'] = -117.3 + rng.random(n_rows) * 0.9
+    df['Distance(mi)'] = rng.exponential(0.5, n_rows).round(3)
+    df['Description'] = 'Accident on I-5 Northbound'
+    df['Street'] = rng.choice(['I-5 N', 'I-8 E', 'I-805 S', 'CA-163 N'], n_rows)
+    df['Side'] = rng.choice(['R', 'L'], n_rows)
+    df['City'] = 'San Diego'
+    df['County'] = np.where(
+        rng.random(n_rows) < san_diego_share, 'San Diego',
+        rng.choice(['Los Angeles', 'Orange', 'Riverside'], n_rows)
+    )
+    df['State'] = 'CA'
+    df['Zipcode'] = np.where(rng.random(n_rows) < 0.3, np.char.add(zipcode, '-1234'), zipcode)
+    df['Country'] = 'US'
+    df['Timezone'] = 'US/Pacific'
+    df['Airport_Code'] = 'KSAN'
+    df['Weather_Timestamp'] = df['Start_Time']
+    df['Temperature(F)'] = rng.normal(65, 10, n_rows).round(1)
+    df['Humidity(%)'] = rng.uniform(10, 100, n_rows).round(0)
+    df['Pressure(in)'] = 30.0
+    df['Visibility(mi)'] = 10.0
+    df['Wind_Direction'] = rng.choice(['N', 'SW', 'Calm'], n_rows)
+    df['Wind_Speed(mph)'] = rng.uniform(0, 20, n_rows).round(1)
+    df['Weather_Condition'] = rng.choice(['Clear', 'Overcast', 'Light Rain', None], n_rows)
+    for col in accident_flags:
+        df[col] = rng.random(n_rows) < 0.1
+    for col in ['Sunrise_Sunset', 'Civil_Twilight', 'Nautical_Twilight', 'Astronomical_Twilight']:
+        df[col] = rng.choice(['Day', 'Night'], n_rows)
+    df.to_csv(path, index=False)
+    return path
+
+
+def write_econ_csv(path, n_rows, seed=0, broken_share=0.01):
+    """
+    Parameters
+    ----------
+    path : str
+        Output CSV file
+    n_rows : int
+        Number of business accounts
+    seed : int
+        Seed of the generator
+    broken_share : float
+        Fraction of dates whose year prefix is mangled like in the real
+        listings, e.g. 0019- or 7201-
+
+    Returns
+    -------
+    path
+    """
+    rng = np.random.default_rng(seed)
+    broken_years = {'2017': ['0017', '7201'], '2018': ['0018'], '2019': ['0019', '1019'], '2020': ['0020']}
+
+    def dates(lo, hi):
+        days = (pd.Timestamp(hi) - pd.Timestamp(lo)).days
+        out = (pd.Timestamp(lo) + pd.to_timedelta(rng.integers(0, days, n_rows), unit='D')).strftime('%Y-%m-%d')
+        out = out.to_numpy(dtype=object)
+        for i in np.flatnonzero(rng.random(n_rows) < broken_share):
+            year = out[i][:4]
+            if year in broken_years:
+                out[i] = rng.choice(broken_years[year]) + out[i][4:]
+        return out
+
+    pd.DataFrame({
+        'account_key': np.arange(n_rows),
+        'business_owner_name': 'OWNER',
+        'ownership_type': rng.choice(['CORP', 'LLC', 'SCORP', 'SOLE', 'PART'], n_rows),
+        'date_account_creation': dates('2008-01-01', '2020-11-30'),
+        'date_cert_expiration': dates('2020-01-01', '2022-12-31'),
+        'date_business_start': dates('1990-01-01', '2020-11-30'),
+        'dba_name': 'SHOP',
+        'naics_sector': rng.integers(11, 93, n_rows),
+    }).to_csv(path, index=False, quoting=csv.QUOTE_NONNUMERIC)
+    return path
+
+
+def write_air_quality_files(root, n_extra_sites=2, seed=0, missing_share=0.03):
+    """
+    Parameters
+    ----------
+    root : str
+        Directory mirroring the air quality server, passed as base_url to
+        get_2019_urls and get_2020_urls
+    n_extra_sites : int
+        Number of sites per parameter on top of the selected sites, sets the
+        size of each daily file
+    seed : int
+        Seed of the generator
+    missing_share : float
+        Fraction of "M" average readings
+
+    Returns
+    -------
+    The 2019 and 2020 lists of daily file paths
+    """
+    rng = np.random.default_rng(seed)
+    sites = selected_sites + ['SITE {}'.format(i) for i in range(n_extra_sites)]
+    params = ['OZONE', 'PM2.5', 'NO2', 'CO']
+
+    def write(path, site_col):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lines = ['San Diego APCD', 'Daily report', 'Date', 'Units', 'Parameter,{},Avg,Max,Hr. of Max'.format(site_col)]
+        for param in params:
+            lines.append('{},,,,'.format(param))
+            avg = rng.uniform(0, 50, len(sites))
+            peak = rng.uniform(0, 80, len(sites))
+            hour = rng.integers(0, 24, len(sites))
+            missing = rng.random(len(sites)) < missing_share
+            for site, a, m, h, na in zip(sites, avg, peak, hour, missing):
+                lines.append(',{},{},{:.1f},{}'.format(site, 'M' if na else '{:.1f}'.format(a), m, h))
+        # The files end with a parameter of a single site, dropped by get_features
+        lines += ['END,,,,', ',{},1,2,3'.format(sites[0])]
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    root = os.path.join(root, '')
+    urls_2019 = get_2019_urls(month_enum, root)
+    urls_2020 = get_2020_urls(month_enum, root)
+    for url in urls_2019:
+        write(url, 'SiteName')
+    for url in urls_2020:
+        write(url, 'Site Name')
+    return urls_2019, urls_2020
+
+
+def write_sdge_csvs(root, n_zips=300, seed=0):
+    """
+    Parameters
+    ----------
+    root : str
+        Output directory, passed as path to the sdge readers
+    n_zips : int
+        Number of ZIP codes per file
+    seed : int
+        Seed of the generator
+
+    Returns
+    -------
+    List of the written files, ELEC and GAS for 2019 and 2020 up to Q3
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(root, exist_ok=True)
+    zips = np.arange(91901, 91901 + n_zips)
+    classes = ['R', 'C', 'I', 'A']
+    paths = []
+    for kind, year, quarter in itertools.product(['ELEC', 'GAS'], ['2019', '2020'], ['Q1', 'Q2', 'Q3', 'Q4']):
+        if year == '2020' and quarter == 'Q4':
+            continue
+        q = int(quarter[1])
+        rows = list(itertools.product(zips, range(3 * q - 2, 3 * q + 1), [int(year)], classes))
+        df = pd.DataFrame(rows, columns=['ZipCode', 'Month', 'Year', 'CustomerClass'])
+        df['Combined'] = rng.choice(['Y', 'N'], len(df))
+        df['TotalCustomers'] = rng.integers(0, 5000, len(df))
+        unit = 'kWh' if kind == 'ELEC' else 'Therms'
+        df['Total' + unit] = rng.integers(0, 10**6, len(df))
+        df['Average' + unit] = rng.uniform(0, 900, len(df)).round(0)
+        path = os.path.join(root, 'SDGE-{}-{}-{}.csv'.format(kind, year, quarter))
+        df.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def write_mobility_csv(root, n_states=10, counties_per_state=5, year='2020', country='US', seed=0):
+    """
+    Parameters
+    ----------
+    root : str
+        Output directory, passed as path to the mobility readers
+    n_states : int
+        Number of states, California included
+    counties_per_state : int
+        Number of counties of the other states
+    year, country : str
+        Year and country code in the report file name
+    seed : int
+        Seed of the generator
+
+    Returns
+    -------
+    Path of the report
+    """
+    rng = np.random.default_rng(seed)
+    folder = os.path.join(root, 'Region_Mobility_Report_CSVs')
+    os.makedirs(folder, exist_ok=True)
+    dates = pd.date_range(year + '-02-15', year + '-11-30').strftime('%Y-%m-%d')
+    states = ['California'] + ['State {}'.format(i) for i in range(n_states - 1)]
+    counties = {
+        state: ['San Diego County', 'Los Angeles County', 'Orange County'] if state == 'California'
+        else ['County {}'.format(j) for j in range(counties_per_state)]
+        for state in states
+    }
+    # Country, state and county rows, like the real report
+    regions = [(np.nan, np.nan)] + [(s, np.nan) for s in states] + [(s, c) for s in states for c in counties[s]]
+
+    blocks = []
+    for sub_region_1, sub_region_2 in regions:
+        block = pd.DataFrame({
+            'country_region_code': country, 'country_region': 'United States',
+            'sub_region_1': sub_region_1, 'sub_region_2': sub_region_2, 'metro_area': np.nan,
+            'iso_3166_2_code': np.nan, 'census_fips_code': rng.integers(1000, 9999),
+            'place_id': 'ChIJ', 'date': dates,
+        })
+        for col in percent_change_columns:
+            values = rng.integers(-80, 80, len(dates)).astype('float64')
+            values[rng.random(len(dates)) < 0.05] = np.nan
+            block[col + '_percent_change_from_baseline'] = values
+        blocks.append(block)
+    path = os.path.join(folder, '{}_{}_Region_Mobility_Report.csv'.format(year, country))
+    pd.concat(blocks).to_csv(path, index=False)
+    return path
@@ -0,0 +1,56 @@
+"""
+Command line entry point, e.g.
+
+    python -m src run --domains accidents,econ --out figures/
+"""
+import logging
+import argparse
+
+from src.pipeline import instrument
+from src.pipeline.dag import domains, run_pipeline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m src', description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='ingest, model and render the figures of some domains')
+    run.add_argument('--domains', default=','.join(domains),
+                     help='comma separated subset of: ' + ', '.join(domains))
+    run.add_argument('--data-dir', default='data/', help='folder laid out as described in the README')
+    run.add_argument('--out', default='figures/', help='folder of the figures and of the stage report')
+    run.add_argument('--workers', type=int, default=4, help='stages running at the same time')
+    run.add_argument('--render-workers', type=int, default=None, help='processes of each figure stage')
+    run.add_argument('--force', action='store_true', help='render figures even if their inputs did not change')
+    run.add_argument('--econ-engine', choices=['prophet', 'numpy'], default='prophet',
+                     help='fit the econ trends with Prophet or the fast NumPy piecewise-linear fit')
+    run.add_argument('--no-memory', action='store_true', help='skip tracing the peak memory of every stage, faster')
+    run.add_argument('--trace', default=None, help='write a Chrome trace of the instrumented calls to this file')
+    run.add_argument('--trace-memory', action='store_true', help='record the tracemalloc peak of every call, slower')
+    run.add_argument('--log-calls', action='store_true', help='log every instrumented call as a JSON line')
+    args = parser.parse_args(argv)
+
+    if args.trace or args.trace_memory or args.log_calls:
+        if args.log_calls:
+            logging.basicConfig(level=logging.INFO, format='%(message)s')
+        instrument.enable(args.trace, log=args.log_calls, memory=args.trace_memory)
+    try:
+        report = run_pipeline(
+            [domain for domain in args.domains.split(',') if domain], data_dir=args.data_dir,
+            out_dir=args.out, max_workers=args.workers, render_workers=args.render_workers,
+            force=args.force, econ_engine=args.econ_engine, memory=not args.no_memory
+        )
+    finally:
+        events = instrument.disable()
+    if events:
+        print(instrument.summarize(events).head(15).to_string())
+    print('{:<22}{:>10}{:>10}{:>10}{:>12}'.format('stage', 'start s', 'wall s', 'peak MB', 'concurrent'))
+    for stats in report:
+        print('{:<22}{:>10}{:>10}{:>10}{:>12}'.format(
+            stats['stage'], stats['start_s'], stats['wall_s'],
+            '-' if stats['peak_mb'] is None else stats['peak_mb'], stats['concurrent']
+        ))
+
+
+if __name__ == '__main__':
+    main()
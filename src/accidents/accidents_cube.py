@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+from src.pipeline.instrument import instrumented
+
+cube_fields = ['RushHour', 'Weekday', 'Zipcode', 'Weather_Condition', 'Severity']
+
+
+class AccidentsCube:
+    '''
+    Hourly accident counts per value of every field, built once by
+    build_cube and rolled up by query_cube
+    '''
+    def __init__(self, hours, cumulative, values, times, row_codes):
+        # Sorted hours holding at least one accident
+        self.hours = hours
+        # Field to the running totals of its hourly counts, an int32 array of
+        # shape (len(hours) + 1, len(values[field])) starting with zeros, so
+        # any range of hours sums with two row lookups
+        self.cumulative = cumulative
+        # Field to the column index of its counts
+        self.values = values
+        # Sorted Start_Time of every row and, per field, the column of each
+        # row (-1 for missing values), to cut the hour of a query's timestamp
+        self.times = times
+        self.row_codes = row_codes
+        # Frequency to the first hour position and label of each bucket
+        self.buckets = {}
+
+
+@instrumented
+def build_cube(df, fields = cube_fields):
+    '''
+    Parameters
+    ----------
+    df : pd.DataFrame
+        The accidents dataset prepared
+    fields : list
+        Fields of the dataframe to count
+
+    Returns
+    -------
+    AccidentsCube answering prepare_series queries on these fields
+    '''
+    assert isinstance(df, pd.DataFrame), "df should be a dataframe"
+    assert ('Start_Time' in df.columns), "Start_Time is not present in columns"
+    assert all(field in df.columns for field in fields), "Field is not present in columns"
+
+    df = df[df['Start_Time'].notna()].sort_values('Start_Time', kind='stable')
+    times = df['Start_Time'].to_numpy()
+    hours, hour_codes = np.unique(df['Start_Time'].dt.floor('h').to_numpy(), return_inverse=True)
+
+    cumulative, values, row_codes = {}, {}, {}
+    for field in fields:
+        col = df[field]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            codes = col.cat.codes.to_numpy()
+            uniques = pd.CategoricalIndex(col.cat.categories, dtype=col.dtype)
+        else:
+            codes, uniques = pd.factorize(col, sort=True)
+        codes = codes.astype('int64')
+        present = codes >= 0
+        flat = np.bincount(hour_codes[present] * len(uniques) + codes[present],
+                           minlength=len(hours) * len(uniques))
+        cumulative[field] = np.zeros((len(hours) + 1, len(uniques)), dtype='int32')
+        np.cumsum(flat.reshape(len(hours), len(uniques)), axis=0, out=cumulative[field][1:])
+        values[field] = uniques
+        row_codes[field] = codes
+    return AccidentsCube(pd.DatetimeIndex(hours), cumulative, values, times, row_codes)
+
+
+def _buckets(cube, freq):
+    '''
+    First hour position and label of every non-empty bucket of freq, cached
+    '''
+    if freq not in cube.buckets:
+        first = pd.Series(np.arange(len(cube.hours)), index=cube.hours).resample(freq).first().dropna()
+        cube.buckets[freq] = (first.to_numpy(dtype='int64'), first.index)
+    return cube.buckets[freq]
+
+
+@instrumented
+def query_cube(cube, field = 'RushHour', timestamp = '2019-09-09', freq = 'W'):
+    '''
+    Same output as prepare_series on the dataframe the cube was built from,
+    buckets and values without accidents left out for categorical fields too,
+    rolled up from the hourly counts instead of grouping the rows
+
+    Parameters
+    ----------
+    cube : AccidentsCube
+        Output of build_cube
+    field : string
+        Field of the cube
+    timestamp :
+        Minimum timestamp starting which data is to be selected
+    freq : string
+        Frequency with which we want to group the data based on 'Start_Time'
+
+    Returns
+    -------
+    pd.DataFrame with a row per bucket holding accidents after timestamp and
+    a column per value of field seen there
+    '''
+    assert field in cube.cumulative, "field is not in the cube"
+
+    cumulative, values = cube.cumulative[field], cube.values[field]
+    timestamp = pd.Timestamp(timestamp)
+    first_hour = timestamp.floor('h')
+    start = cube.hours.searchsorted(first_hour)
+    starts, labels = _buckets(cube, freq)
+
+    if start < len(cube.hours):
+        # Bucket holding the start hour, then every later bucket
+        b = starts.searchsorted(start, side='right') - 1
+        bounds = np.concatenate([[start], starts[b + 1:], [len(cube.hours)]])
+        sums = (cumulative[bounds[1:]] - cumulative[bounds[:-1]]).astype('int64')
+        labels = labels[b:]
+        # Rows of the start hour up to timestamp are not after it
+        lo = cube.times.searchsorted(first_hour.to_datetime64())
+        hi = cube.times.searchsorted(timestamp.to_datetime64(), side='right')
+        codes = cube.row_codes[field][lo:hi]
+        sums[0] -= np.bincount(codes[codes >= 0], minlength=len(values))
+    else:
+        sums, labels = np.zeros((0, len(values)), dtype='int64'), labels[:0]
+
+    # Like groupby with observed=True, keep only the buckets and values with
+    # accidents. Labels keep their freq when no bucket is left out, as
+    # prepare_series' do
+    rows, cols = sums.sum(axis=1) > 0, sums.sum(axis=0) > 0
+    if not rows.all():
+        sums, labels = sums[rows], labels[rows]
+    elif len(labels) and labels.freq is None:
+        # Dropping empty buckets in _buckets also dropped the freq, which
+        # contiguous labels get back
+        contiguous = pd.date_range(labels[0], periods=len(labels), freq=freq, name=labels.name)
+        labels = contiguous if contiguous.equals(labels) else labels
+    sums = sums[:, cols]
+    out = pd.DataFrame(sums, index=labels.rename('Start_Time'), columns=values[cols].rename(field))
+    # unstack leaves missing pairs as NaN, which fillna(0) keeps as floats
+    return out.astype('float64') if (sums == 0).any() else out
@@ -1,28 +1,54 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import os
-
-import warnings
-
-def fxn():
-    warnings.warn("deprecated", DeprecationWarning)
-
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    fxn()
+import glob
+import hashlib
+import importlib.util
+from src.pipeline.instrument import instrumented
 
 isRushHour = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 
               6: 2, 7: 2, 8: 2, 9: 2, 10: 1, 11: 1,
               12: 1, 13: 1, 14: 2, 15: 2, 16: 2, 17: 2,
               18: 1, 19: 1, 20: 1, 21: 0, 22: 0, 23: 0}
+rush_hour_labels = ["Low Traffic", "Normal Traffic", "Rush Hour"]
+# Level of rush for every hour of the day, indexed by hour
+rush_hour_codes = np.array([isRushHour[hour] for hour in range(24)], dtype='int8')
+
+time_format = '%Y-%m-%d %H:%M:%S'
+
+# Bump whenever filter_data/compute_features change their output, so cached
+# frames built by an older version are rebuilt
+features_version = "2"
 
-def ingestion_and_clean(raw_fp = '../data/accidents/US_Accidents_June20.csv'):
+remove_cols = ['Astronomical_Twilight','Nautical_Twilight','Precipitation(in)', 'Wind_Chill(F)', 
+               'Number','End_Lng','End_Lat','Civil_Twilight','Source', 'ID','Street', 'Side',  
+               'Country', 'Timezone', 'Airport_Code','Distance(mi)','Description','State']
+
+# Explicit dtypes of the columns kept after filter_data, so that chunks never
+# re-infer types (e.g. an all-numeric Zipcode chunk being read as int)
+accident_dtypes = {'TMC': 'float64', 'Severity': 'int64',
+                   'Start_Time': str, 'End_Time': str,
+                   'Start_Lat': 'float64', 'Start_Lng': 'float64',
+                   'City': str, 'County': str, 'Zipcode': str,
+                   'Weather_Timestamp': str, 'Temperature(F)': 'float64',
+                   'Humidity(%)': 'float64', 'Pressure(in)': 'float64',
+                   'Visibility(mi)': 'float64', 'Wind_Direction': str,
+                   'Wind_Speed(mph)': 'float64', 'Weather_Condition': str,
+                   'Amenity': bool, 'Bump': bool, 'Crossing': bool, 'Give_Way': bool,
+                   'Junction': bool, 'No_Exit': bool, 'Railway': bool,
+                   'Roundabout': bool, 'Station': bool, 'Stop': bool,
+                   'Traffic_Calming': bool, 'Traffic_Signal': bool,
+                   'Turning_Loop': bool, 'Sunrise_Sunset': str}
+
+@instrumented
+def ingestion_and_clean(raw_fp = '../data/accidents/US_Accidents_June20.csv', chunksize = 500000):
     """
     Parameters
     ----------
     raw_fp : string
         Raw filepath of Complete US Accidents Dataset CSV file
+    chunksize : int or None
+        Number of rows parsed at a time. None reads the whole file at once
     
     Returns
     -------
@@ -31,11 +57,96 @@ def ingestion_and_clean(raw_fp = '../data/accidents/US_Accidents_June20.csv'):
     assert os.path.exists(raw_fp),"Raw file exists"
     assert raw_fp[-3:] == "csv", "File of type csv allowed"
 
-    df = pd.read_csv(raw_fp)
-    df = filter_data(df)
+    if chunksize is None:
+        df = pd.read_csv(raw_fp)
+        df = filter_data(df)
+    else:
+        df = stream_filter_data(raw_fp, chunksize=chunksize)
     df = compute_features(df)
     return df
 
+@instrumented
+def file_fingerprint(raw_fp, block_size = 1 << 20):
+    '''
+    Parameters
+    ----------
+    raw_fp : string
+        Path of the file to fingerprint
+    block_size : int
+        Number of bytes hashed from the head and the tail of the file
+
+    Returns
+    -------
+    Hex digest of the file size, mtime and its first/last blocks. Cheap enough
+    to compute on every call even for a multi-GB file
+    '''
+    stat = os.stat(raw_fp)
+    digest = hashlib.sha1("{}-{}".format(stat.st_size, stat.st_mtime_ns).encode())
+    with open(raw_fp, 'rb') as f:
+        digest.update(f.read(block_size))
+        if stat.st_size > block_size:
+            f.seek(max(stat.st_size - block_size, block_size))
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+def storage_format():
+    '''
+    Returns
+    -------
+    Extension of the files caching frames: 'parquet' when pyarrow is
+    installed, 'pkl' otherwise. pyarrow is not imported to find out
+    '''
+    return 'parquet' if importlib.util.find_spec('pyarrow') is not None else 'pkl'
+
+@instrumented
+def cached_ingestion_and_clean(raw_fp = '../data/accidents/US_Accidents_June20.csv', cache_dir = None, chunksize = 500000):
+    """
+    Parameters
+    ----------
+    raw_fp : string
+        Raw filepath of Complete US Accidents Dataset CSV file
+    cache_dir : string
+        Directory holding the cached frame. Defaults to a 'cache' folder next to raw_fp
+    chunksize : int or None
+        Passed to ingestion_and_clean when the cache has to be rebuilt
+
+    Returns
+    -------
+    Same frame as ingestion_and_clean, loaded from a columnar cache keyed on
+    the raw file path, its fingerprint and features_version. Stale entries
+    of the same raw file are rebuilt, the caches of other files are kept
+    """
+    assert os.path.exists(raw_fp),"Raw file exists"
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(raw_fp), 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    ext = storage_format()
+    raw_key = hashlib.sha1(os.path.abspath(raw_fp).encode()).hexdigest()[:12]
+    prefix = os.path.join(cache_dir, 'san_diego_accidents-{}-'.format(raw_key))
+    cache_fp = "{}{}-v{}.{}".format(prefix, file_fingerprint(raw_fp), features_version, ext)
+
+    if os.path.exists(cache_fp):
+        return pd.read_parquet(cache_fp) if ext == 'parquet' else pd.read_pickle(cache_fp)
+
+    df = ingestion_and_clean(raw_fp, chunksize=chunksize)
+    # Temp files are other writers' entries in progress
+    for stale_fp in glob.glob(glob.escape(prefix) + '*'):
+        if not stale_fp.endswith('.tmp'):
+            try:
+                os.remove(stale_fp)
+            except FileNotFoundError:
+                pass
+    tmp_fp = cache_fp + '.tmp'
+    if ext == 'parquet':
+        df.to_parquet(tmp_fp)
+    else:
+        df.to_pickle(tmp_fp)
+    os.replace(tmp_fp, cache_fp)
+    return df
+
+@instrumented
 def filter_data(df):
     '''
     Parameters
@@ -49,14 +160,83 @@ def filter_data(df):
     '''
     assert ('County' in df.columns),"County Entry doesn't exist in df"
 
-    remove_cols = ['Astronomical_Twilight','Nautical_Twilight','Precipitation(in)', 'Wind_Chill(F)', 
-                          'Number','End_Lng','End_Lat','Civil_Twilight','Source', 'ID','Street', 'Side',  
-                          'Country', 'Timezone', 'Airport_Code','Distance(mi)','Description','State']
-
     assert (remove_col in df.columns for remove_col in remove_cols), "Column Doesn't exist"
     df = df.drop(columns=remove_cols)
     return df[df['County']=='San Diego']
 
+@instrumented
+def stream_filter_data(raw_fp, chunksize = 500000):
+    '''
+    Parameters
+    ----------
+    raw_fp : string
+        Raw filepath of Complete US Accidents Dataset CSV file
+    chunksize : int
+        Number of rows parsed at a time
+    
+    Returns
+    -------
+    Same frame as filter_data, reading only the kept columns and applying
+    the county filter chunk by chunk so memory is bounded by chunksize
+    '''
+    assert chunksize > 0, "chunksize should be positive"
+
+    reader = pd.read_csv(raw_fp, usecols=lambda col: col not in remove_cols,
+                         dtype=accident_dtypes, chunksize=chunksize)
+    chunks = [chunk[chunk['County']=='San Diego'] for chunk in reader]
+    return pd.concat(chunks)
+
+def civil_fields(seconds):
+    '''
+    Parameters
+    ----------
+    seconds : np.ndarray
+        int64 seconds since 1970-01-01
+
+    Returns
+    -------
+    dict of the 'Year', 'Month', 'Hour' and 'Weekday' of each as int64
+    arrays, computed with integer arithmetic (Howard Hinnant's
+    civil_from_days) instead of the .dt accessors
+    '''
+    days = seconds // 86400
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    # 1970-01-01 was a Thursday, and Monday is 0
+    return {'Year': yoe + era * 400 + (month <= 2), 'Month': month,
+            'Hour': seconds // 3600 % 24, 'Weekday': (days + 3) % 7}
+
+def parse_times(col, fields = True):
+    '''
+    Parameters
+    ----------
+    col : pd.Series
+        Strings in time_format, missing values allowed
+    fields : bool
+        Also compute the fields of every datetime
+
+    Returns
+    -------
+    pd.Series of the datetimes, and dict of the 'Year', 'Month', 'Hour' and
+    'Weekday' of each as integer arrays holding -1 on NaT rows (None
+    without fields)
+    '''
+    times = pd.to_datetime(col, format=time_format)
+    if not fields:
+        return times, None
+    seconds = times.to_numpy(dtype='datetime64[s]')
+    missing = np.isnat(seconds)
+    values = civil_fields(np.where(missing, 0, seconds.view('int64')))
+    for field in values.values():
+        field[missing] = -1
+    return times, values
+
+@instrumented
 def compute_features(df):
     '''
     Parameters
@@ -71,18 +251,36 @@ def compute_features(df):
     list_keys = ['Start_Time','End_Time','Hour','Zipcode','Start_Lat','Start_Lng']
     assert (key in df.columns for key in list_keys),"County Entry doesn't exist in df"
 
+    start_time, fields = parse_times(df['Start_Time'])
+    end_time, _ = parse_times(df['End_Time'], fields=False)
+    # Rows without a Start_Time get NaN fields and no level of rush, their
+    # Hour of -1 masked before it indexes the lookup
+    missing = start_time.isna().to_numpy()
+    rush_codes = rush_hour_codes.take(np.where(missing, 0, fields['Hour']))
+    rush_codes[missing] = -1
+
+    def field(key, dtype):
+        values = fields[key]
+        return np.where(missing, np.nan, values) if missing.any() else values.astype(dtype)
 
-    df['Start_Time'] = pd.to_datetime(df['Start_Time'])
-    df['End_Time'] = pd.to_datetime(df['End_Time'])
-    df['Month'] = df['Start_Time'].dt.month
-    df['Year'] = df['Start_Time'].dt.year
-    df['Hour'] = df['Start_Time'].dt.hour
-    df['Weekday'] = df['Start_Time'].dt.weekday
-    df['Duration'] = (df['End_Time'] - df['Start_Time']).dt.total_seconds()/60
-    df['RushHour'] = df['Hour'].map(RushHour(isRushHour))
-    df['Zipcode'] = df['Zipcode'].apply(lambda x: x if len(x) == 5 else x.split('-')[0])
+    # Slice every distinct Zipcode once rather than every row
+    zip_codes, zip_uniques = pd.factorize(df['Zipcode'])
+    zip_codes2, zipcodes = pd.factorize(pd.Index(zip_uniques).astype(str).str.slice(0, 5), sort=True)
+    zip_codes = np.where(zip_codes >= 0, zip_codes2[zip_codes], -1)
 
-    df = df.rename(columns={'Start_Lat': 'Latitude', 'Start_Lng': 'Longitude'})
+    # A shallow copy takes the new columns without copying and consolidating
+    # the others, and leaves df untouched
+    df = df.copy(deep=False)
+    df['Start_Time'] = start_time
+    df['End_Time'] = end_time
+    df['Month'] = field('Month', 'int8')
+    df['Year'] = field('Year', 'int16')
+    df['Hour'] = field('Hour', 'int8')
+    df['Weekday'] = field('Weekday', 'int8')
+    df['Duration'] = (end_time.to_numpy() - start_time.to_numpy()) / np.timedelta64(1, 's') / 60
+    df['RushHour'] = pd.Categorical.from_codes(rush_codes, categories=rush_hour_labels)
+    df['Zipcode'] = pd.Categorical.from_codes(zip_codes, categories=zipcodes)
+    df.rename(columns={'Start_Lat': 'Latitude', 'Start_Lng': 'Longitude'}, inplace=True)
     return df
 
 def RushHour(isRushHour, labels = ["Low Traffic", "Normal Traffic", "Rush Hour"]):
@@ -96,11 +294,9 @@ def RushHour(isRushHour, labels = ["Low Traffic", "Normal Traffic", "Rush Hour"]
 
     Returns
     -------
-    Maps level of rush (i) to label[i]
+    New dict mapping each hour to label[level]; isRushHour is left untouched
     '''
     assert isinstance(isRushHour,dict), "Rush Hour is a dictionary"
-    assert all(0 <= v <= len(labels) for v in isRushHour.values()),"Rush Hour Dictionary has less labels"
-    for k,v in list(isRushHour.items()):
-        isRushHour[k] = labels[v]
+    assert all(0 <= v < len(labels) for v in isRushHour.values()),"Rush Hour Dictionary has less labels"
 
-    return isRushHour
\ No newline at end of file
+    return {k: labels[v] for k,v in isRushHour.items()}
@@ -1,11 +1,14 @@
 from src.accidents.accidents_data import *
+from src.pipeline.render import new_figure
 import pandas as pd
+from src.pipeline.instrument import instrumented
 
 try:
     from matplotlib import pyplot as plt
 except ImportError:
     print('Importing matplotlib failed. Plotting will not work.')
 
+@instrumented
 def prepare_series(df, field='RushHour',  timestamp='2019-09-09', freq = 'W'):
     """
     Prepare a pd.Series to have index name 'ds' and name 'y' for fbprophet
@@ -27,10 +30,12 @@ def prepare_series(df, field='RushHour',  timestamp='2019-09-09', freq = 'W'):
     assert isinstance(df, pd.DataFrame), "df should be a dataframe"
     assert ('Start_Time' in df.columns), "Start_Time is not present in columns"
 
-    return df[df['Start_Time'] > pd.Timestamp(timestamp)].groupby([pd.Grouper(key='Start_Time',freq=freq),field]).size().unstack().fillna(0)
+    return df[df['Start_Time'] > pd.Timestamp(timestamp)].groupby([pd.Grouper(key='Start_Time',freq=freq),field], observed=True).size().unstack().fillna(0)
 
+@instrumented
 def custom_plot(df, colors = ['#219ebc', '#023047', '#fb8500', '#ffb703'], 
-                ax=None, xlabel='', ylabel='Number of Accidents', title = 'Accidents by Traffic Density', figsize=(10, 6)):
+                ax=None, xlabel='', ylabel='Number of Accidents', title = 'Accidents by Traffic Density', figsize=(10, 6),
+                dpi=260, show=True):
     """
     Plot the custom function
 
@@ -43,13 +48,16 @@ def custom_plot(df, colors = ['#219ebc', '#023047', '#fb8500', '#ffb703'],
     ylabel: Optional label name on Y-axis
     title: Optional custom Title for the plot
     figsize: Optional tuple width, height in inches.
+    dpi: Optional resolution of a new figure
+    show: Create the figure through pyplot and show it. False draws on a
+        figure detached from pyplot, for headless rendering
     
     Returns
     -------
-    None
+    A matplotlib figure.
     """
     if ax is None:
-        fig = plt.figure(facecolor='w', figsize=figsize, dpi=260)
+        fig = new_figure(figsize=figsize, dpi=dpi, pyplot=show)
         ax = fig.add_subplot(111)
     else:
         fig = ax.get_figure()
@@ -67,14 +75,17 @@ def custom_plot(df, colors = ['#219ebc', '#023047', '#fb8500', '#ffb703'],
     )
     box = ax.get_position()
     ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-    plt.legend(list(df.columns),loc='lower left', bbox_to_anchor=(1, 0.5))
+    ax.legend(list(df.columns),loc='lower left', bbox_to_anchor=(1, 0.5))
     fig.tight_layout()
-    plt.show()
+    if show:
+        plt.show()
+    return fig
 
-def make_figures(accident_df):
+@instrumented
+def make_figures(accident_df, show=True):
     """
     Helper function that includes all graphs in notebook
     """
     accidents_by_rush_hour = prepare_series(accident_df, field='RushHour',  timestamp='2019-09-09', freq = 'W')
 
-    custom_plot(accidents_by_rush_hour)
\ No newline at end of file
+    return [custom_plot(accidents_by_rush_hour, show=show)]
\ No newline at end of file
@@ -0,0 +1,319 @@
+import numpy as np
+import pandas as pd
+
+from src.pipeline.instrument import instrumented
+
+# California's stay at home order
+lockdown = '2020-03-19'
+earth_radius_km = 6371.0088
+
+
+class SpatialGrid:
+    '''
+    Accidents bucketed in a uniform latitude/longitude grid, built once by
+    build_grid. Cell id is row * n_cols + col, row counting up from lat0
+    and col from lng0. Points are stored sorted by cell then Start_Time, so
+    the points of a cell, or of a run of cells along a row, are one slice
+    '''
+    def __init__(self, lat0, lng0, cell_size, n_rows, n_cols, starts, cells, lat, lng, times):
+        self.lat0 = lat0
+        self.lng0 = lng0
+        self.cell_size = cell_size
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        # Position of the first point of every cell, plus the number of points
+        self.starts = starts
+        self.cells = cells
+        self.lat = lat
+        self.lng = lng
+        self.times = times
+        # Summed area table of the cell counts, shape (n_rows + 1, n_cols + 1)
+        counts = np.diff(starts).reshape(n_rows, n_cols)
+        self.summed = np.zeros((n_rows + 1, n_cols + 1), dtype='int64')
+        self.summed[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+
+
+@instrumented
+def build_grid(df, cell_size = 0.01):
+    '''
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Output of compute_features, with Latitude, Longitude and Start_Time
+    cell_size : float
+        Side of the cells in degrees, 0.01 is about a kilometer
+
+    Returns
+    -------
+    SpatialGrid of the rows with coordinates
+    '''
+    assert isinstance(df, pd.DataFrame), "df should be a dataframe"
+    assert all(key in df.columns for key in ['Latitude', 'Longitude', 'Start_Time']), "Coordinates are not present in columns"
+    assert cell_size > 0, "cell_size should be positive"
+
+    df = df[df['Latitude'].notna() & df['Longitude'].notna() & df['Start_Time'].notna()]
+    lat = df['Latitude'].to_numpy(dtype='float64')
+    lng = df['Longitude'].to_numpy(dtype='float64')
+    times = df['Start_Time'].to_numpy()
+
+    lat0 = np.floor(lat.min() / cell_size) * cell_size if len(lat) else 0.0
+    lng0 = np.floor(lng.min() / cell_size) * cell_size if len(lng) else 0.0
+    rows = np.floor((lat - lat0) / cell_size).astype('int64')
+    cols = np.floor((lng - lng0) / cell_size).astype('int64')
+    n_rows = int(rows.max()) + 1 if len(rows) else 1
+    n_cols = int(cols.max()) + 1 if len(cols) else 1
+    cells = rows * n_cols + cols
+
+    order = np.lexsort((times, cells))
+    cells = cells[order]
+    starts = np.searchsorted(cells, np.arange(n_rows * n_cols + 1))
+    return SpatialGrid(lat0, lng0, cell_size, n_rows, n_cols, starts, cells, lat[order], lng[order], times[order])
+
+
+def cell_of(grid, lat, lng):
+    '''
+    Parameters
+    ----------
+    grid : SpatialGrid
+        Output of build_grid
+    lat, lng : float or np.ndarray
+        Coordinates
+
+    Returns
+    -------
+    Cell ids of the coordinates, -1 outside the grid
+    '''
+    rows = np.floor((np.asarray(lat, dtype='float64') - grid.lat0) / grid.cell_size).astype('int64')
+    cols = np.floor((np.asarray(lng, dtype='float64') - grid.lng0) / grid.cell_size).astype('int64')
+    inside = (rows >= 0) & (rows < grid.n_rows) & (cols >= 0) & (cols < grid.n_cols)
+    return np.where(inside, rows * grid.n_cols + cols, -1)
+
+
+def cell_counts(grid, cells):
+    '''
+    Parameters
+    ----------
+    grid : SpatialGrid
+        Output of build_grid
+    cells : int or np.ndarray
+        Cell ids, -1 counts as empty
+
+    Returns
+    -------
+    Number of accidents of every cell
+    '''
+    cells = np.asarray(cells, dtype='int64')
+    safe = np.where(cells >= 0, cells, 0)
+    return np.where(cells >= 0, grid.starts[safe + 1] - grid.starts[safe], 0)
+
+
+def cell_centers(grid, cells):
+    '''
+    Returns
+    -------
+    Latitudes and longitudes of the centers of the cells
+    '''
+    rows, cols = np.divmod(np.asarray(cells, dtype='int64'), grid.n_cols)
+    return grid.lat0 + (rows + 0.5) * grid.cell_size, grid.lng0 + (cols + 0.5) * grid.cell_size
+
+
+def _slices(lo, hi):
+    '''
+    Concatenation of np.arange(lo[i], hi[i]) without a Python loop
+    '''
+    lengths = hi - lo
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype='int64')
+    offsets = np.repeat(lo - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    return np.arange(total) + offsets
+
+
+def _row_spans(grid, row_lo, row_hi, col_lo, col_hi):
+    '''
+    Indices of the points in cells row_lo..row_hi x col_lo..col_hi, all
+    bounds inclusive and inside the grid. Each row of cells is one slice
+    '''
+    rows = np.arange(row_lo, row_hi + 1)
+    return _slices(grid.starts[rows * grid.n_cols + col_lo], grid.starts[rows * grid.n_cols + col_hi + 1])
+
+
+def _clip_box(grid, lat_min, lat_max, lng_min, lng_max):
+    '''
+    Rows and columns of the cells overlapping the box, None if it misses the grid
+    '''
+    row_lo = int(np.floor((lat_min - grid.lat0) / grid.cell_size))
+    row_hi = int(np.floor((lat_max - grid.lat0) / grid.cell_size))
+    col_lo = int(np.floor((lng_min - grid.lng0) / grid.cell_size))
+    col_hi = int(np.floor((lng_max - grid.lng0) / grid.cell_size))
+    if row_hi < 0 or col_hi < 0 or row_lo >= grid.n_rows or col_lo >= grid.n_cols:
+        return None
+    return max(row_lo, 0), min(row_hi, grid.n_rows - 1), max(col_lo, 0), min(col_hi, grid.n_cols - 1)
+
+
+def _box_sum(grid, row_lo, row_hi, col_lo, col_hi):
+    if row_lo > row_hi or col_lo > col_hi:
+        return 0
+    s = grid.summed
+    return int(s[row_hi + 1, col_hi + 1] - s[row_lo, col_hi + 1] - s[row_hi + 1, col_lo] + s[row_lo, col_lo])
+
+
+def count_bbox(grid, lat_min, lat_max, lng_min, lng_max):
+    '''
+    Parameters
+    ----------
+    grid : SpatialGrid
+        Output of build_grid
+    lat_min, lat_max, lng_min, lng_max : float
+        Inclusive bounds of the box
+
+    Returns
+    -------
+    Number of accidents in the box. Cells fully inside it are counted from
+    the summed area table, only the points of its border cells are tested
+    '''
+    assert lat_min <= lat_max and lng_min <= lng_max, "Box bounds are reversed"
+    box = _clip_box(grid, lat_min, lat_max, lng_min, lng_max)
+    if box is None:
+        return 0
+    row_lo, row_hi, col_lo, col_hi = box
+
+    inner = _box_sum(grid, row_lo + 1, row_hi - 1, col_lo + 1, col_hi - 1)
+    border = [_row_spans(grid, row_lo, row_lo, col_lo, col_hi)]
+    if row_hi > row_lo:
+        border.append(_row_spans(grid, row_hi, row_hi, col_lo, col_hi))
+    if row_hi - row_lo > 1:
+        border.append(_row_spans(grid, row_lo + 1, row_hi - 1, col_lo, col_lo))
+        if col_hi > col_lo:
+            border.append(_row_spans(grid, row_lo + 1, row_hi - 1, col_hi, col_hi))
+    idx = np.concatenate(border)
+    lat, lng = grid.lat[idx], grid.lng[idx]
+    hits = (lat >= lat_min) & (lat <= lat_max) & (lng >= lng_min) & (lng <= lng_max)
+    return inner + int(hits.sum())
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    '''
+    Great circle distance in kilometers, broadcasting like NumPy
+    '''
+    lat1, lng1, lat2, lng2 = (np.radians(x) for x in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * earth_radius_km * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def radius_points(grid, lat, lng, radius_km):
+    '''
+    Parameters
+    ----------
+    grid : SpatialGrid
+        Output of build_grid
+    lat, lng : float
+        Center of the circle
+    radius_km : float
+        Radius of the circle in kilometers
+
+    Returns
+    -------
+    Positions in the grid arrays of the accidents within radius_km
+    '''
+    assert radius_km >= 0, "radius_km should not be negative"
+    dlat = np.degrees(radius_km / earth_radius_km)
+    # Longitude degrees shrink with the cosine of the latitude
+    dlng = dlat / max(np.cos(np.radians(min(abs(lat) + dlat, 90.0))), 1e-12)
+    box = _clip_box(grid, lat - dlat, lat + dlat, lng - dlng, lng + dlng)
+    if box is None:
+        return np.zeros(0, dtype='int64')
+    idx = _row_spans(grid, *box)
+    return idx[haversine_km(lat, lng, grid.lat[idx], grid.lng[idx]) <= radius_km]
+
+
+def count_radius(grid, lat, lng, radius_km):
+    '''
+    Returns
+    -------
+    Number of accidents within radius_km kilometers of (lat, lng)
+    '''
+    return len(radius_points(grid, lat, lng, radius_km))
+
+
+@instrumented
+def cell_series(grid, cells = None, freq = 'W', timestamp = None):
+    '''
+    Parameters
+    ----------
+    grid : SpatialGrid
+        Output of build_grid
+    cells : list
+        Cell ids. None keeps every cell with accidents
+    freq : string
+        Frequency with which we want to group the data based on 'Start_Time'
+    timestamp :
+        Optional minimum timestamp starting which data is to be selected
+
+    Returns
+    -------
+    pd.DataFrame of the number of accidents with a row per period, like
+    prepare_series, and a column per cell
+    '''
+    if cells is None:
+        idx = np.arange(len(grid.cells))
+    else:
+        cells = np.asarray(cells, dtype='int64')
+        idx = _slices(grid.starts[cells], grid.starts[cells + 1])
+    df = pd.DataFrame({'Start_Time': grid.times[idx], 'Cell': grid.cells[idx]})
+    if timestamp is not None:
+        df = df[df['Start_Time'] > pd.Timestamp(timestamp)]
+    out = df.groupby([pd.Grouper(key='Start_Time', freq=freq), 'Cell']).size().unstack(fill_value=0)
+    if cells is not None:
+        out = out.reindex(columns=pd.Index(cells, name='Cell'), fill_value=0)
+    return out
+
+
+@instrumented
+def hotspot_deltas(grid, split = lockdown, days = None):
+    '''
+    Compare the accidents of every cell before and after a date
+
+    Parameters
+    ----------
+    grid : SpatialGrid
+        Output of build_grid
+    split : string or pd.Timestamp
+        First moment of the after period, the lockdown by default
+    days : int
+        Optional length of both periods in days. None compares all the data
+        before split with all the data after it
+
+    Returns
+    -------
+    pd.DataFrame indexed by cell id, for the cells with accidents in either
+    period, with the cell center, the counts and daily rates of both
+    periods and the change of the daily rate, largest drop first
+    '''
+    split = pd.Timestamp(split)
+    first = pd.Timestamp(grid.times.min()) if len(grid.times) else split
+    last = pd.Timestamp(grid.times.max()) if len(grid.times) else split
+    if days is None:
+        start, end = first, last + pd.Timedelta(1, 'us')
+    else:
+        start, end = split - pd.Timedelta(days=days), split + pd.Timedelta(days=days)
+    before_days = max((split - max(start, first)) / pd.Timedelta(days=1), 1)
+    after_days = max((min(end, last) - split) / pd.Timedelta(days=1), 1)
+
+    times = grid.times
+    n_cells = grid.n_rows * grid.n_cols
+    before = np.bincount(grid.cells[(times >= start) & (times < split)], minlength=n_cells)
+    after = np.bincount(grid.cells[(times >= split) & (times < end)], minlength=n_cells)
+    cells = np.flatnonzero(before + after)
+    lat, lng = cell_centers(grid, cells)
+
+    out = pd.DataFrame({
+        'Latitude': lat,
+        'Longitude': lng,
+        'before': before[cells],
+        'after': after[cells],
+        'before_per_day': before[cells] / before_days,
+        'after_per_day': after[cells] / after_days,
+    }, index=pd.Index(cells, name='Cell'))
+    out['change_per_day'] = out['after_per_day'] - out['before_per_day']
+    return out.sort_values('change_per_day', kind='stable')
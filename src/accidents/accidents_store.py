@@ -0,0 +1,291 @@
+import os
+import json
+import glob
+import shutil
+import uuid
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import pandas as pd
+
+from src.accidents.accidents_data import (
+    remove_cols, accident_dtypes, time_format, file_fingerprint, storage_format, compute_features
+)
+from src.pipeline.instrument import instrumented
+
+# Columns compute_features needs, read whatever columns a query asks for
+feature_inputs = ['Start_Time', 'End_Time', 'Zipcode', 'Start_Lat', 'Start_Lng']
+# Month key of rows without a parsable Start_Time
+undated = 'undated'
+# Bump whenever the partitions or the manifest change layout, so datasets
+# built by an older version are rebuilt. Partitions hold raw rows, so
+# features_version does not apply to them
+storage_version = "1"
+
+
+def _write(df, path, ext):
+    tmp_path = path + '.tmp'
+    if ext == 'parquet':
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.reset_index(drop=True).to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _read(path, ext, columns = None):
+    if ext == 'parquet':
+        return pd.read_parquet(path, columns=columns)
+    df = pd.read_pickle(path)
+    return df if columns is None else df[columns]
+
+
+def _partition_dir(out_dir, state, county):
+    # Quoting keeps names like "St. Louis" or "Prince George's" safe as paths
+    return os.path.join(out_dir, 'State=' + quote(state, safe=' '), 'County=' + quote(county, safe=' '))
+
+
+def _is_dataset(path):
+    return os.path.exists(os.path.join(path, 'manifest.json'))
+
+
+@instrumented
+def build_partitioned_dataset(raw_fp = '../data/accidents/US_Accidents_June20.csv', out_dir = None, chunksize = 500000):
+    '''
+    Convert the national CSV once into files partitioned by state, county
+    and start month, so queries on any county read only their partitions
+
+    Parameters
+    ----------
+    raw_fp : string
+        Raw filepath of Complete US Accidents Dataset CSV file
+    out_dir : string
+        Directory of the dataset. Defaults to an 'accidents_partitioned'
+        folder next to raw_fp. An existing directory is only replaced if it
+        holds a dataset built by this function or is empty
+
+    Returns
+    -------
+    out_dir. Partitions are State=<state>/County=<county>/<YYYY-MM>.<ext>
+    with the columns kept by filter_data and the original row number, and
+    manifest.json lists them with their row counts, the path and
+    fingerprint of raw_fp and storage_version
+    '''
+    assert os.path.exists(raw_fp), "Raw file exists"
+    assert chunksize > 0, "chunksize should be positive"
+
+    if out_dir is None:
+        out_dir = os.path.join(os.path.dirname(raw_fp), 'accidents_partitioned')
+    out_dir = os.path.abspath(out_dir)
+    assert not os.path.exists(out_dir) or _is_dataset(out_dir) or not os.listdir(out_dir), \
+        "out_dir exists and is not a partitioned accidents dataset, not replacing it"
+
+    # Build next to out_dir and swap it in at the end, so a crash never
+    # leaves a half written dataset behind
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    build_dir = '{}.building-{}'.format(out_dir, uuid.uuid4().hex)
+    os.makedirs(build_dir)
+    try:
+        _build(raw_fp, build_dir, chunksize)
+        if os.path.exists(out_dir):
+            old_dir = '{}.old-{}'.format(out_dir, uuid.uuid4().hex)
+            os.replace(out_dir, old_dir)
+            os.replace(build_dir, out_dir)
+            shutil.rmtree(old_dir)
+        else:
+            os.replace(build_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    return out_dir
+
+
+def _build(raw_fp, out_dir, chunksize):
+    '''
+    Write the partitions and the manifest of raw_fp into the empty out_dir
+    '''
+    ext = storage_format()
+    spool_dir = os.path.join(out_dir, '_spool')
+    os.makedirs(spool_dir)
+
+    # Pass 1: spool rows per state, so pass 2 holds a single state in memory
+    reader = pd.read_csv(raw_fp, usecols=lambda col: col not in remove_cols or col == 'State',
+                         dtype=dict(accident_dtypes, State=str), chunksize=chunksize)
+    columns = None
+    for i, chunk in enumerate(reader):
+        chunk = chunk.assign(Row=chunk.index.to_numpy(), Month=chunk['Start_Time'].str.slice(0, 7).fillna(undated))
+        columns = [col for col in chunk.columns if col not in ['State', 'Month']]
+        chunk = chunk[chunk['State'].notna() & chunk['County'].notna()]
+        for state, rows in chunk.groupby('State', sort=False):
+            state_dir = os.path.join(spool_dir, quote(state, safe=' '))
+            os.makedirs(state_dir, exist_ok=True)
+            _write(rows.drop(columns='State'), os.path.join(state_dir, 'part-{}.{}'.format(i, ext)), ext)
+
+    # Pass 2: one file per county and month
+    partitions = []
+    for state_dir in sorted(glob.glob(os.path.join(spool_dir, '*'))):
+        state = unquote(os.path.basename(state_dir))
+        parts = sorted(glob.glob(os.path.join(state_dir, '*.' + ext)), key=lambda p: int(p.rsplit('-', 1)[1].split('.')[0]))
+        rows = pd.concat([_read(part, ext) for part in parts], ignore_index=True)
+        for (county, month), group in rows.groupby(['County', 'Month'], sort=True):
+            county_dir = _partition_dir(out_dir, state, county)
+            os.makedirs(county_dir, exist_ok=True)
+            path = os.path.join(county_dir, '{}.{}'.format(month, ext))
+            _write(group.drop(columns='Month'), path, ext)
+            partitions.append({
+                'state': state, 'county': county, 'month': month,
+                'path': os.path.relpath(path, out_dir), 'rows': len(group),
+            })
+    shutil.rmtree(spool_dir)
+
+    manifest = {
+        'raw_fp': os.path.abspath(raw_fp), 'source': file_fingerprint(raw_fp),
+        'storage_version': storage_version, 'format': ext, 'columns': columns, 'partitions': partitions,
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def load_manifest(dataset_dir):
+    '''
+    Parameters
+    ----------
+    dataset_dir : string
+        Output of build_partitioned_dataset
+
+    Returns
+    -------
+    The manifest as a dict, with the partitions as a DataFrame
+    '''
+    manifest_fp = os.path.join(dataset_dir, 'manifest.json')
+    assert os.path.exists(manifest_fp), "Dataset manifest doesn't exist, run build_partitioned_dataset"
+    with open(manifest_fp) as f:
+        manifest = json.load(f)
+    manifest['partitions'] = pd.DataFrame(manifest['partitions'], columns=['state', 'county', 'month', 'path', 'rows'])
+    return manifest
+
+
+def is_stale(manifest):
+    '''
+    Parameters
+    ----------
+    manifest : dict
+        Output of load_manifest
+
+    Returns
+    -------
+    True when the dataset was built by another storage_version or the raw
+    CSV it was built from changed since. A raw file that is no longer there
+    cannot be compared and counts as current
+    '''
+    if manifest.get('storage_version') != storage_version:
+        return True
+    raw_fp = manifest['raw_fp']
+    return os.path.exists(raw_fp) and file_fingerprint(raw_fp) != manifest['source']
+
+
+def _end_bound(end):
+    '''
+    Exclusive upper bound on the Start_Time strings for an inclusive end. A
+    date without a time of day includes that whole day
+    '''
+    timestamp = pd.Timestamp(end)
+    date_only = isinstance(end, datetime.date) and not isinstance(end, datetime.datetime)
+    date_only |= isinstance(end, str) and ':' not in end and 'T' not in end
+    if date_only:
+        return (timestamp.normalize() + pd.Timedelta(days=1)).strftime(time_format), '<'
+    return timestamp.strftime(time_format), '<='
+
+
+def select_partitions(manifest, counties, states = None, start = None, end = None):
+    '''
+    Parameters
+    ----------
+    manifest : dict
+        Output of load_manifest
+    counties : list
+        County names as in the County column, e.g. ['San Diego']
+    states : list
+        Optional state codes, e.g. ['CA']. Without them a county name
+        matches in every state, like filter_data does
+    start, end : string or pd.Timestamp
+        Optional inclusive bounds on Start_Time, a date only end includes
+        that day
+
+    Returns
+    -------
+    DataFrame of the partitions that can hold matching rows
+    '''
+    partitions = manifest['partitions']
+    keep = partitions['county'].isin(counties)
+    if states is not None:
+        keep &= partitions['state'].isin(states)
+    if start is not None or end is not None:
+        dated = partitions['month'] != undated
+        keep &= dated
+        if start is not None:
+            keep &= partitions['month'] >= pd.Timestamp(start).strftime('%Y-%m')
+        if end is not None:
+            keep &= partitions['month'] <= pd.Timestamp(end).strftime('%Y-%m')
+    return partitions[keep]
+
+
+@instrumented
+def query_accidents(dataset_dir, counties = 'San Diego', states = None, start = None, end = None, columns = None,
+                    max_workers = 8):
+    '''
+    Parameters
+    ----------
+    dataset_dir : string
+        Output of build_partitioned_dataset
+    counties : string or list
+        One or several county names
+    states : string or list
+        Optional state codes restricting the counties
+    start, end : string or pd.Timestamp
+        Optional inclusive bounds on Start_Time, a date only end includes
+        that whole day
+    columns : list
+        Optional raw columns to read on top of the ones compute_features
+        needs. None reads every column
+    max_workers : int
+        Number of partitions read concurrently
+
+    Returns
+    -------
+    The frame ingestion_and_clean builds for these counties, restricted to
+    the date range, in the row order and with the index of the CSV. Only
+    the matching partitions and columns are read. A dataset built by
+    another storage_version, or whose raw CSV changed since, is rebuilt first
+    '''
+    counties = [counties] if isinstance(counties, str) else list(counties)
+    states = [states] if isinstance(states, str) else states
+    manifest = load_manifest(dataset_dir)
+    if is_stale(manifest):
+        build_partitioned_dataset(manifest['raw_fp'], dataset_dir)
+        manifest = load_manifest(dataset_dir)
+    selected = select_partitions(manifest, counties, states, start, end)
+
+    read_cols = None
+    if columns is not None:
+        read_cols = list(dict.fromkeys(['Row', 'County'] + feature_inputs + list(columns)))
+    def read(path):
+        return _read(os.path.join(dataset_dir, path), manifest['format'], read_cols)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        frames = list(pool.map(read, selected['path']))
+    if not frames:
+        # Keep the schema of the dataset for an empty result
+        frames = [pd.DataFrame({
+            col: pd.Series(dtype=accident_dtypes.get(col, 'int64'))
+            for col in manifest['columns'] if read_cols is None or col in read_cols
+        })]
+
+    df = pd.concat(frames, ignore_index=True).sort_values('Row', kind='stable')
+    df = df.set_index('Row').rename_axis(None)
+    if start is not None:
+        df = df[df['Start_Time'] >= pd.Timestamp(start).strftime(time_format)]
+    if end is not None:
+        bound, op = _end_bound(end)
+        df = df[df['Start_Time'] < bound] if op == '<' else df[df['Start_Time'] <= bound]
+    return compute_features(df)
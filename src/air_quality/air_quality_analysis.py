@@ -5,13 +5,18 @@ Created on Mon Dec  7 16:57:21 2020
 @author: 77243
 """
 
+import logging
 import pandas as pd
 import numpy as np
-from math import isnan
-import matplotlib.pyplot as plt
+from io import BytesIO
+from src.air_quality.air_quality_fetch import fetch_daily_files
+from src.pipeline.instrument import instrumented
 
 month_enum = ["Jan","Feb","Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
 selected_sites = ["CHULA VISTA", "EL CAJON LES", "KEARNY MESA", "OTAY MESA DVN", "PENDLETON"]
+base_url = "http://jtimmer.digitalspacemail17.net/data/"
+
+logger = logging.getLogger(__name__)
 
 def get_days(month):
     '''
@@ -67,6 +72,7 @@ def normalize_days(day):
     else:
         return "0" + str(day)
 
+@instrumented
 def get_features(d, selected_sites, year):
     '''
     :Purpose: get all features from a CSV file in a given year
@@ -106,101 +112,304 @@ def get_features(d, selected_sites, year):
         #print(curr_info)
     return features
 
-def get_2019_features(month_enum):
+@instrumented
+def get_features_frame(d, selected_sites):
     '''
-    :Purpose: get all features from CSV files in 2019
+    :Purpose: vectorized get_features returning a tidy frame for either yearly schema
+    :prams: d
+    :type: DataFrame with Parameter, SiteName or Site Name, Avg and Max columns, and optionally a Date column
+    :prams: selected_sites
+    :type: list of str
+    :return: DataFrame indexed by ([Date,] Parameter, Site) with float Avg and Max, "M" becomes NaN.
+             Like get_features, the last parameter of every file and the parameters with fewer
+             than 5 rows of selected sites are left out
+    '''
+    site_col = "SiteName" if "SiteName" in d.columns else "Site Name"
+    params = d["Parameter"].ffill()
+    selected = d[site_col].isin(selected_sites)
+    files = [d["Date"]] if "Date" in d.columns else [np.zeros(len(d), dtype = int)]
+    last = params.groupby(files, dropna = False).transform("last")
+    visited = selected.groupby(files + [params], dropna = False).transform("sum")
+    keep = (selected & (params != last) & (visited >= 5)).to_numpy()
+    d = d.assign(Parameter = params)[keep]
+
+    keys = ["Date", "Parameter", "Site"] if "Date" in d.columns else ["Parameter", "Site"]
+    frame = pd.DataFrame({
+        "Parameter": pd.Categorical(d["Parameter"].astype(str), categories = pd.unique(d["Parameter"].astype(str))),
+        "Site": pd.Categorical(d[site_col], categories = selected_sites),
+        "Avg": pd.to_numeric(d["Avg"], errors = "coerce"),
+        "Max": pd.to_numeric(d["Max"], errors = "coerce"),
+    })
+    if "Date" in d.columns:
+        frame.insert(0, "Date", d["Date"])
+    frame = frame.drop_duplicates(subset = keys)
+    return frame.set_index(keys)
+
+def url_to_date(url):
+    '''
+    :Purpose: return the day of a daily CSV file from its yesterday_YYYYMMDD.CSV name
+    :prams: url
+    :type: str
+    :return: Timestamp
+    '''
+    return pd.Timestamp(url.rsplit("yesterday_", 1)[1][:8])
+
+def get_2019_urls(month_enum, base_url = base_url):
+    '''
+    :Purpose: return the daily CSV file urls of 2019 in day order
     :prams: month_enum
     :type: list of str
-    :return: list
+    :prams: base_url
+    :type: str, server url or local directory mirroring it
+    :return: list of str
     '''
-    features_2019 = []
+    urls = []
     for month in month_enum[2:10]:
         for day in get_days(month):
-            month_num = month_to_num(month)
-            file_path = "http://jtimmer.digitalspacemail17.net/data/2019/" + month +"/yesterday_2019" + month_to_num(month) + normalize_days(day) +".CSV"
-            csv_data = pd.read_csv(file_path, header = 4, encoding = "ISO-8859-1")
-            d = csv_data[["Parameter", "SiteName", "Avg", "Max", "Hr. of Max"]]
-            d["Parameter"].fillna(method = 'ffill',inplace = True)
-            features = get_features(d, selected_sites, 2019)
-            features_2019.append(features)
-    return features_2019
+            urls.append(base_url + "2019/" + month + "/yesterday_2019" + month_to_num(month) + normalize_days(day) + ".CSV")
+    return urls
 
-def get_2020_features(month_enum):
+def get_2020_urls(month_enum, base_url = base_url):
     '''
-    :Purpose: get all features from CSV files in 2020
+    :Purpose: return the daily CSV file urls of 2020 in day order
     :prams: month_enum
     :type: list of str
-    :return: list
+    :prams: base_url
+    :type: str, server url or local directory mirroring it
+    :return: list of str
     '''
-    features_2020 = []
+    urls = []
     for month in month_enum[2:9]:
         for day in get_days(month):
-            month_num = month_to_num(month)
-            file_path = "http://jtimmer.digitalspacemail17.net/data/2020/" + month +"/yesterday_2020" + month_to_num(month) + normalize_days(day) +".CSV"
-            #print(file_path)
-            csv_data = pd.read_csv(file_path, header = 4, encoding = "ISO-8859-1")
-            d = csv_data[["Parameter", "Site Name", "Avg", "Max", "Hr. of Max"]]
-            d["Parameter"].fillna(method = 'ffill',inplace = True)
-            features = get_features(d, selected_sites, 2020)
-            features_2020.append(features)
-    
+            urls.append(base_url + "2020/" + month + "/yesterday_2020" + month_to_num(month) + normalize_days(day) + ".CSV")
     for day in get_days("Oct"):
-        file_path = "http://jtimmer.digitalspacemail17.net/data/" +"yesterday_2020" + month_to_num("Oct") + normalize_days(day) +".CSV"
-        csv_data = pd.read_csv(file_path, header = 4, encoding = "ISO-8859-1")
-        d = csv_data[["Parameter", "Site Name", "Avg", "Max", "Hr. of Max"]]
-        d["Parameter"].fillna(method = 'ffill',inplace = True)
-        features = get_features(d, selected_sites, 2020)
-        features_2020.append(features)
-    
-    return features_2020
+        urls.append(base_url + "yesterday_2020" + month_to_num("Oct") + normalize_days(day) + ".CSV")
+    return urls
+
+@instrumented
+def read_daily_csv(raw, site_col = None):
+    '''
+    :Purpose: parse the raw bytes of a daily CSV file
+    :prams: raw
+    :type: bytes
+    :prams: site_col
+    :type: str, "SiteName" in 2019 and "Site Name" in 2020, None detects it
+    :return: DataFrame
+    '''
+    csv_data = pd.read_csv(BytesIO(raw), header = 4, encoding = "ISO-8859-1")
+    if site_col is None:
+        site_col = "SiteName" if "SiteName" in csv_data.columns else "Site Name"
+    d = csv_data[["Parameter", site_col, "Avg", "Max", "Hr. of Max"]]
+    return d.assign(Parameter = d["Parameter"].ffill())
+
+def missing_features(template):
+    '''
+    :Purpose: return a placeholder for a missing day, with every value of a fetched day set to "M"
+    :prams: template
+    :type: dict, output of get_features for a fetched day, None when no day was fetched
+    :return: dict
+    '''
+    if template is None:
+        return {}
+    return {param: {site: {"Avg": "M", "Max": "M"} for site in sites} for param, sites in template.items()}
+
+def missing_frame(dates, template):
+    '''
+    :Purpose: return NaN rows standing for missing days, with the parameters and sites of a fetched frame
+    :prams: dates
+    :type: list of Timestamp
+    :prams: template
+    :type: DataFrame, output of get_features_frame with a Date level
+    :return: DataFrame indexed like template
+    '''
+    keys = template.index.droplevel("Date").unique()
+    index = pd.MultiIndex.from_tuples(
+        [(date,) + key for date in dates for key in keys], names = template.index.names
+    )
+    frame = pd.DataFrame(np.nan, index = index, columns = template.columns)
+    # Keep the categorical levels, so the placeholders concatenate without changing dtypes
+    return frame.set_index(pd.MultiIndex.from_arrays([
+        index.get_level_values("Date"),
+        pd.Categorical(index.get_level_values("Parameter"), dtype = template.index.levels[1].dtype),
+        pd.Categorical(index.get_level_values("Site"), dtype = template.index.levels[2].dtype),
+    ], names = template.index.names))
+
+@instrumented
+def get_year_features(urls, year, cache_dir = None, max_workers = 8, as_frame = False, offline = False):
+    '''
+    :Purpose: fetch daily CSV files concurrently and get their features, with a placeholder for each missing day
+    :prams: urls
+    :type: list of str
+    :prams: year
+    :type: int
+    :prams: cache_dir
+    :type: str, directory caching the raw files, None disables the cache
+    :prams: max_workers
+    :type: int
+    :prams: as_frame
+    :type: bool, return one (Date, Parameter, Site) indexed frame instead of a list of dicts
+    :prams: offline
+    :type: bool, only read from cache_dir
+    :return: list or DataFrame, one entry per url so day positions stay aligned; missing days hold
+             "M" values in the list and NaN rows in the frame
+    '''
+    site_col = "SiteName" if year == 2019 else "Site Name"
+    files, missing = fetch_daily_files(urls, cache_dir = cache_dir, max_workers = max_workers, offline = offline)
+    if missing:
+        logger.warning("Missing %d daily files of %d: %s", len(missing), year, missing)
+    if as_frame:
+        days = [read_daily_csv(files[url], site_col).assign(Date = url_to_date(url)) for url in urls if url in files]
+        frame = get_features_frame(pd.concat(days, ignore_index = True), selected_sites)
+        if missing and days:
+            frame = pd.concat([frame, missing_frame([url_to_date(url) for url in missing], frame)]).sort_index(
+                level = "Date", sort_remaining = False)
+        return frame
+    features = {url: get_features(read_daily_csv(files[url], site_col), selected_sites, year) for url in files}
+    template = next((features[url] for url in urls if url in features), None)
+    return [features[url] if url in features else missing_features(template) for url in urls]
+
+@instrumented
+def get_2019_features(month_enum, cache_dir = None, max_workers = 8, base_url = base_url, as_frame = False,
+                      offline = False):
+    '''
+    :Purpose: get all features from CSV files in 2019
+    :prams: month_enum
+    :type: list of str
+    :prams: cache_dir
+    :type: str, directory caching the raw files, None disables the cache
+    :prams: as_frame
+    :type: bool, return a tidy frame built by get_features_frame
+    :prams: offline
+    :type: bool, only read from cache_dir
+    :return: list or DataFrame
+    '''
+    return get_year_features(get_2019_urls(month_enum, base_url), 2019, cache_dir, max_workers, as_frame, offline)
+
+@instrumented
+def get_2020_features(month_enum, cache_dir = None, max_workers = 8, base_url = base_url, as_frame = False,
+                      offline = False):
+    '''
+    :Purpose: get all features from CSV files in 2020
+    :prams: month_enum
+    :type: list of str
+    :prams: cache_dir
+    :type: str, directory caching the raw files, None disables the cache
+    :prams: as_frame
+    :type: bool, return a tidy frame built by get_features_frame
+    :prams: offline
+    :type: bool, only read from cache_dir
+    :return: list or DataFrame
+    '''
+    return get_year_features(get_2020_urls(month_enum, base_url), 2020, cache_dir, max_workers, as_frame, offline)
     
-def get_normalized_features(features_2019, features_2020, site_names):
+@instrumented
+def features_to_tensor(features, param_names, site_names):
+    '''
+    :Purpose: pack a list of daily feature dicts into a (days x sites x parameters) array of Avg values
+    :prams: features
+    :type: list of dict, output of get_2019_features or get_2020_features
+    :prams: param_names
+    :type: list of str
+    :prams: site_names
+    :type: list of str
+    :return: np.ndarray of float with NaN where the value is "M" or absent
+    '''
+    param_index = {param: index for index, param in enumerate(param_names)}
+    site_index = {site: index for index, site in enumerate(site_names)}
+    values = np.full((len(features), len(site_names), len(param_names)), np.nan)
+
+    days, sites, params, avgs = [], [], [], []
+    for day, data in enumerate(features):
+        for param in data:
+            for site in data[param]:
+                days.append(day)
+                sites.append(site_index[site])
+                params.append(param_index[param])
+                avgs.append(data[param][site]["Avg"])
+    values[days, sites, params] = pd.to_numeric(pd.Series(avgs, dtype = object), errors = "coerce")
+    return values
+
+@instrumented
+def frame_to_tensor(frame, param_names, site_names):
+    '''
+    :Purpose: pack a (Date, Parameter, Site) indexed frame into a (days x sites x parameters) array of Avg values
+    :prams: frame
+    :type: DataFrame, output of get_2019_features or get_2020_features with as_frame = True
+    :prams: param_names
+    :type: list of str
+    :prams: site_names
+    :type: list of str
+    :return: np.ndarray of float with NaN where the value is missing, sorted dates
+    '''
+    dates = frame.index.get_level_values("Date")
+    day_names = np.sort(dates.unique())
+    days = pd.Index(day_names).get_indexer(dates)
+    sites = pd.Index(site_names).get_indexer(frame.index.get_level_values("Site"))
+    params = pd.Index(param_names).get_indexer(frame.index.get_level_values("Parameter"))
+    keep = (sites >= 0) & (params >= 0)
+
+    values = np.full((len(day_names), len(site_names), len(param_names)), np.nan)
+    values[days[keep], sites[keep], params[keep]] = frame["Avg"].to_numpy()[keep]
+    return values, day_names
+
+@instrumented
+def normalize_tensor(values, missing = "zero"):
+    '''
+    :Purpose: z-score a (days x sites x parameters) array per parameter, scaled down by 10
+    :prams: values
+    :type: np.ndarray with NaN for missing values
+    :prams: missing
+    :type: str, "zero" counts missing values as 0 like the original lists, "mask" leaves them out
+    :return: np.ndarray of the same shape, 0 where masked
+    '''
+    assert missing in ["zero", "mask"]
+
+    mask = ~np.isnan(values)
+    if missing == "zero":
+        values = np.where(mask, values, 0.0)
+        mask = np.ones_like(mask)
+    # One contiguous row per parameter, so the reductions sum in the same order as np.mean on a list
+    by_param = np.ascontiguousarray(values.reshape(-1, values.shape[2]).T)
+    mean = np.nanmean(by_param, axis = 1)
+    std = np.nanstd(by_param, axis = 1, ddof = 1)
+    return np.where(mask, (values - mean) / (std * 10), 0.0)
+
+@instrumented
+def get_normalized_features(features_2019, features_2020, site_names, missing = "zero"):
     '''
     :Purpose: get all normalized features from 2019 and 2020 features
     :prams: features_2019
-    :type: list of dict
+    :type: list of dict or DataFrame from get_2019_features
     :prams: features_2020
-    :type: list of dict
-    :return: list
+    :type: list of dict or DataFrame from get_2020_features
+    :prams: site_names
+    :type: list of str
+    :prams: missing
+    :type: str, "zero" or "mask", see normalize_tensor
+    :return: list of the overall index, dict of per site lists of the index summed over parameters
     '''
-    data_by_site_average = {key: [] for key in features_2020[0]}
-    
-    for data in features_2019:
-        for param in data:
-            for site in data[param]:
-                for statics in data[param][site]:
-                    if statics == "Avg":
-                        if data[param][site][statics] != "M" and not isnan(float(data[param][site][statics])):
-                            data_by_site_average[param].append(float(data[param][site][statics]))
-                        else:
-                            data_by_site_average[param].append(0)
-                            
-    for data in features_2020:
-        for param in data:
-            for site in data[param]:
-                for statics in data[param][site]:
-                    if statics == "Avg":
-                        if data[param][site][statics] != "M" and not isnan(float(data[param][site][statics])):
-                            data_by_site_average[param].append(float(data[param][site][statics]))
-                        else:
-                            data_by_site_average[param].append(0)
-                            
-    averages_average = [np.mean(data) for param, data in data_by_site_average.items()]
-    std_average = [np.std(data, ddof = 1) for param, data in data_by_site_average.items()]
-    
-    standard_param_average = [0] * 474
-    for index, param in enumerate(data_by_site_average):
-        for index2, data in enumerate(data_by_site_average[param]):
-            standard_param_average[index2 % 474] +=  (data - averages_average[index]) / (std_average[index] * 10)
-    
-    standard_param_average_sites = {key : [] for key in site_names}
-    for index, param in enumerate(data_by_site_average):
-        if index == 0:
-            for index2, data in enumerate(data_by_site_average[param]):
-                standard_param_average_sites[site_names[index2 % 5]].append((data - averages_average[index]) / (std_average[index] * 10))
-        else:
-            for index2, data in enumerate(data_by_site_average[param]):
-                standard_param_average_sites[site_names[index2 % 5]][index2 // 5] += ((data - averages_average[index]) / (std_average[index] * 10))
-    
-    
-    return standard_param_average, standard_param_average_sites
\ No newline at end of file
+    if isinstance(features_2020, pd.DataFrame):
+        # The parameters of the first 2020 day, like the keys of features_2020[0]
+        dates = features_2020.index.get_level_values("Date")
+        param_names = list(pd.unique(features_2020.index.get_level_values("Parameter")[dates == dates.min()]))
+        values, _ = frame_to_tensor(pd.concat([features_2019, features_2020]), param_names, site_names)
+    else:
+        param_names = list(features_2020[0])
+        values = features_to_tensor(features_2019 + features_2020, param_names, site_names)
+
+    standard = normalize_tensor(values, missing)
+    # Accumulate parameter by parameter to keep the summation order of the original loops
+    standard_sites = standard[:, :, 0].copy()
+    for index in range(1, len(param_names)):
+        standard_sites += standard[:, :, index]
+
+    # The original loops add value k of each parameter's (day, site) ordered list to day k % days,
+    # kept as is so the published index does not change: per parameter, one slice of days per site
+    n_days, n_sites = standard.shape[:2]
+    standard_param_average = np.zeros(n_days)
+    for index in range(len(param_names)):
+        flat = standard[:, :, index].ravel()
+        for start in range(0, n_days * n_sites, n_days):
+            standard_param_average += flat[start:start + n_days]
+    standard_param_average_sites = {site: standard_sites[:, index].tolist() for index, site in enumerate(site_names)}
+    return standard_param_average.tolist(), standard_param_average_sites
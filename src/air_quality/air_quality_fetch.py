@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent, disk-cached fetching of the daily air quality CSV files
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from src.pipeline.instrument import instrumented
+
+_local = threading.local()
+_index_lock = threading.Lock()
+_manifest_lock = threading.Lock()
+
+class MissingFileError(Exception):
+    '''
+    Raised when the server or the fixture directory does not have a file
+    '''
+
+def _get_connection(scheme, netloc, timeout):
+    '''
+    :Purpose: return a keep-alive connection to netloc reused by the calling thread
+    :prams: scheme
+    :type: str
+    :prams: netloc
+    :type: str
+    :prams: timeout
+    :type: float
+    :return: http.client.HTTPConnection
+    '''
+    if not hasattr(_local, "connections"):
+        _local.connections = {}
+    key = (scheme, netloc)
+    if key not in _local.connections:
+        conn_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        _local.connections[key] = conn_class(netloc, timeout = timeout)
+    return _local.connections[key]
+
+def _drop_connection(scheme, netloc):
+    '''
+    :Purpose: close and forget the connection of the calling thread to netloc
+    :prams: scheme
+    :type: str
+    :prams: netloc
+    :type: str
+    :return: None
+    '''
+    conn = getattr(_local, "connections", {}).pop((scheme, netloc), None)
+    if conn is not None:
+        conn.close()
+
+def read_source(url, timeout = 30):
+    '''
+    :Purpose: return the raw bytes behind an http(s) url or a local file path
+    :prams: url
+    :type: str
+    :prams: timeout
+    :type: float
+    :return: bytes
+    '''
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        path = parts.path if parts.scheme == "file" else url
+        if not os.path.exists(path):
+            raise MissingFileError(url)
+        with open(path, "rb") as f:
+            return f.read()
+
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    conn = _get_connection(parts.scheme, parts.netloc, timeout)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        body = response.read()
+    except (OSError, http.client.HTTPException):
+        _drop_connection(parts.scheme, parts.netloc)
+        raise
+    if response.status == 404:
+        raise MissingFileError(url)
+    if response.status != 200:
+        raise OSError("HTTP {} for {}".format(response.status, url))
+    return body
+
+def fetch_with_retry(url, retries = 3, backoff = 0.5, timeout = 30):
+    '''
+    :Purpose: read a url, retrying transient errors with exponential backoff
+    :prams: url
+    :type: str
+    :prams: retries
+    :type: int
+    :prams: backoff
+    :type: float, seconds before the first retry
+    :return: bytes
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return read_source(url, timeout)
+        except MissingFileError:
+            raise
+        except (OSError, http.client.HTTPException):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+def _load_index(cache_dir):
+    '''
+    :Purpose: return the url -> content hash index of a cache directory
+    :prams: cache_dir
+    :type: str
+    :return: dict
+    '''
+    index_path = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+def _load_missing(cache_dir):
+    '''
+    :Purpose: return the missing urls recorded in a cache directory
+    :prams: cache_dir
+    :type: str
+    :return: list of str
+    '''
+    missing_path = os.path.join(cache_dir, "missing.json")
+    if not os.path.exists(missing_path):
+        return []
+    with open(missing_path) as f:
+        return json.load(f)["missing"]
+
+def _write_json(path, obj):
+    '''
+    :Purpose: atomically write obj as json to path
+    :prams: path
+    :type: str
+    :prams: obj
+    :type: dict
+    :return: None
+    '''
+    with open(path + ".tmp", "w") as f:
+        json.dump(obj, f, indent = 1, sort_keys = True)
+    os.replace(path + ".tmp", path)
+
+@instrumented
+def fetch_daily_files(urls, cache_dir = None, max_workers = 8, retries = 3, backoff = 0.5, offline = False):
+    '''
+    :Purpose: fetch many files concurrently through a content-addressed disk cache, merging its
+              index and missing.json with those of earlier calls so several years can share it
+    :prams: urls
+    :type: list of str, http(s) urls or local paths
+    :prams: cache_dir
+    :type: str, None disables the cache
+    :prams: max_workers
+    :type: int, size of the thread pool
+    :prams: offline
+    :type: bool, only read from the cache
+    :return: dict of url -> bytes, list of missing urls
+    '''
+    index = {}
+    if cache_dir is not None:
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok = True)
+        index = _load_index(cache_dir)
+
+    def fetch(url):
+        if url in index:
+            with open(os.path.join(cache_dir, "objects", index[url]), "rb") as f:
+                return f.read()
+        if offline:
+            raise MissingFileError(url)
+        raw = fetch_with_retry(url, retries = retries, backoff = backoff)
+        if cache_dir is not None:
+            digest = hashlib.sha256(raw).hexdigest()
+            object_path = os.path.join(cache_dir, "objects", digest)
+            if not os.path.exists(object_path):
+                # Threads fetching identical files each write their own temp file
+                tmp_path = "{}.{}.tmp".format(object_path, uuid.uuid4().hex)
+                with open(tmp_path, "wb") as f:
+                    f.write(raw)
+                try:
+                    os.replace(tmp_path, object_path)
+                except OSError:
+                    # Lost the race to a writer of the same content
+                    if not os.path.exists(object_path):
+                        raise
+                    os.remove(tmp_path)
+            with _index_lock:
+                index[url] = digest
+        return raw
+
+    files = {}
+    missing = []
+    with ThreadPoolExecutor(max_workers = max_workers) as pool:
+        futures = [(url, pool.submit(fetch, url)) for url in urls]
+        for url, future in futures:
+            try:
+                files[url] = future.result()
+            except (MissingFileError, OSError, http.client.HTTPException):
+                missing.append(url)
+
+    if cache_dir is not None:
+        with _manifest_lock:
+            merged_index = _load_index(cache_dir)
+            merged_index.update(index)
+            _write_json(os.path.join(cache_dir, "index.json"), merged_index)
+            # Urls of this call are replaced by their new status, others are kept
+            merged_missing = set(_load_missing(cache_dir)) - set(urls) | set(missing)
+            _write_json(os.path.join(cache_dir, "missing.json"), {"missing": sorted(merged_missing)})
+    return files, missing
@@ -5,55 +5,79 @@ Created on Mon Dec  7 17:14:55 2020
 @author: 77243
 """
 
+import os
 import matplotlib.pyplot as plt
 import numpy as np
+from src.air_quality.air_quality_analysis import month_enum, get_2019_urls
+from src.pipeline.render import new_figure
+from src.pipeline.instrument import instrumented
 
-def get_graphs(standard_param_average, standard_param_average_sites, site_names):
+@instrumented
+def get_graphs(standard_param_average, standard_param_average_sites, site_names, out_dir = "", show = True,
+               days_2019 = None):
     '''
     :Purpose: get all graphs generated from normalized 2019 and 2020 features
     :prams: standard_param_average
     :type: list
-    :return: None
+    :prams: days_2019
+    :type: int, number of 2019 days at the start of the series, None uses the number of 2019 daily files
+    :prams: out_dir
+    :type: str, folder the figures are saved to, None does not save them
+    :prams: show
+    :type: bool, create the figures through pyplot and show them, False draws on detached figures
+    :return: list of matplotlib figures
     '''
+    # get_2019_features keeps a placeholder for every missing day, so 2019 always spans all its files
+    days = len(get_2019_urls(month_enum)) if days_2019 is None else days_2019
+    figs = []
     
     ## Average different plot
-    plt.figure(figsize=(40,10))
-    diff = np.array([data_2020 - data_2019 for data_2020, data_2019 in zip(standard_param_average[237:], standard_param_average[:237])])
-    x_range = np.arange(237)
+    fig = new_figure(figsize = (40,10), pyplot = show)
+    ax = fig.add_subplot(111)
+    diff = np.array([data_2020 - data_2019 for data_2020, data_2019 in zip(standard_param_average[days:], standard_param_average[:days])])
+    x_range = np.arange(len(diff))
     above = np.ma.masked_array(diff, diff > 0)
     below = np.ma.masked_array(diff, diff < 0)
-    plt.bar(x_range, above, color =  "#219EBC")
-    plt.bar(x_range, below, color = "#FB8500")
-    plt.xticks(np.arange(0, 237, step=30), ["Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct"],fontsize = 20)
-    plt.yticks(fontsize = 20)
-    plt.xlabel("Date", fontsize = 40)
-    plt.ylabel("Normalized Index Difference", fontsize = 40)
-    plt.title("The difference of Average Pollutant Index between 2020 and 2019", fontsize = 40)
-    plt.legend(fontsize = 30)
-    plt.savefig("general_average_difference.png")
-    plt.show()
+    ax.bar(x_range, above, color =  "#219EBC")
+    ax.bar(x_range, below, color = "#FB8500")
+    ax.set_xticks(np.arange(0, days, step=30))
+    ax.set_xticklabels(["Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct"][:len(np.arange(0, days, step=30))], fontsize = 20)
+    ax.tick_params(axis = "y", labelsize = 20)
+    ax.set_xlabel("Date", fontsize = 40)
+    ax.set_ylabel("Normalized Index Difference", fontsize = 40)
+    ax.set_title("The difference of Average Pollutant Index between 2020 and 2019", fontsize = 40)
+    figs.append((fig, "general_average_difference.png"))
     
     ## Average boxplot of 2019 and 2020
-    data = [standard_param_average[:237], standard_param_average[237:]]
-    plt.figure(figsize=(10,6))
-    box = plt.boxplot(data, showfliers = False, notch=True, patch_artist=True, medianprops=dict(color="black"))
+    data = [standard_param_average[:days], standard_param_average[days:]]
+    fig = new_figure(figsize = (10,6), pyplot = show)
+    ax = fig.add_subplot(111)
+    box = ax.boxplot(data, showfliers = False, notch=True, patch_artist=True, medianprops=dict(color="black"))
     colors = ["#219EBC", "#FB8500"]
     for patch, color in zip(box['boxes'], colors):
         patch.set_facecolor(color)
-    plt.xticks(np.arange(1,3), ["2019","2020"])
-    plt.title('Boxplot of Average Pollutant Index')
-    plt.savefig("box_general_average.png")
-    plt.show()
+    ax.set_xticks(np.arange(1,3))
+    ax.set_xticklabels(["2019","2020"])
+    ax.set_title('Boxplot of Average Pollutant Index')
+    figs.append((fig, "box_general_average.png"))
     
             
     ## Average boxplot of different areas in 2020
-    data = [standard_param_average_sites[site_names[i]][237:] for i in range(5)]
-    plt.figure(figsize=(10,6))
-    box = plt.boxplot(data, showfliers = False, notch=True, patch_artist=True, medianprops=dict(color="green"))
+    data = [standard_param_average_sites[site][days:] for site in site_names]
+    fig = new_figure(figsize = (10,6), pyplot = show)
+    ax = fig.add_subplot(111)
+    box = ax.boxplot(data, showfliers = False, notch=True, patch_artist=True, medianprops=dict(color="green"))
     colors = ["#8ECAE6","#219EBC", "#023047", "#ffb703","#FB8500"]
     for patch, color in zip(box['boxes'], colors):
         patch.set_facecolor(color)
-    plt.xticks(np.arange(1,6), site_names)
-    plt.title('Boxplot of Average Pollutant Index in Different Areas')
-    plt.savefig("Box_AQI_areas.png")
-    plt.show()
\ No newline at end of file
+    ax.set_xticks(np.arange(1,len(site_names) + 1))
+    ax.set_xticklabels(site_names)
+    ax.set_title('Boxplot of Average Pollutant Index in Different Areas')
+    figs.append((fig, "Box_AQI_areas.png"))
+    
+    for fig, name in figs:
+        if out_dir is not None:
+            fig.savefig(os.path.join(out_dir, name))
+    if show:
+        plt.show()
+    return [fig for fig, _ in figs]
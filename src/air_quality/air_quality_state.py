@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental air quality state: running per parameter statistics and the
+normalized series, updated one daily file at a time
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from src.air_quality.air_quality_fetch import fetch_with_retry
+from src.air_quality.air_quality_analysis import (
+    read_daily_csv, get_features_frame, url_to_date, frame_to_tensor, normalize_tensor
+)
+from src.pipeline.instrument import instrumented
+
+# Per day arrays in date order, preallocated with spare capacity; only the first n_days rows are stored days
+day_buffers = ["dates", "values", "normalized", "normalized_sites"]
+
+def new_state(param_names, site_names, missing = "zero"):
+    '''
+    :Purpose: return an empty state for the given parameters and sites
+    :prams: param_names
+    :type: list of str
+    :prams: site_names
+    :type: list of str
+    :prams: missing
+    :type: str, "zero" or "mask", see normalize_tensor
+    :return: dict
+    '''
+    assert missing in ["zero", "mask"]
+    n_sites, n_params = len(site_names), len(param_names)
+    return {
+        "param_names": np.array(param_names, dtype = str),
+        "site_names": np.array(site_names, dtype = str),
+        "missing": np.array(missing),
+        "count": np.zeros(n_params),
+        "mean": np.zeros(n_params),
+        "m2": np.zeros(n_params),
+        "n_days": np.array(0),
+        "dates": np.array([], dtype = "datetime64[D]"),
+        "values": np.empty((0, n_sites, n_params)),
+        "normalized": np.empty(0),
+        "normalized_sites": np.empty((0, n_sites)),
+    }
+
+def welford_update(count, mean, m2, day_values):
+    '''
+    :Purpose: merge a day of values into running per parameter counts, means and squared deviations
+    :prams: count, mean, m2
+    :type: np.ndarray of shape (parameters,)
+    :prams: day_values
+    :type: np.ndarray of shape (sites, parameters), NaN values are skipped
+    :return: updated count, mean, m2
+    '''
+    day_count = np.sum(~np.isnan(day_values), axis = 0)
+    seen = day_count > 0
+    day_mean = np.where(seen, np.nansum(day_values, axis = 0) / np.maximum(day_count, 1), 0.0)
+    day_m2 = np.nansum((day_values - day_mean) ** 2, axis = 0)
+
+    total = count + day_count
+    delta = day_mean - mean
+    ratio = np.where(total > 0, day_count / np.maximum(total, 1), 0.0)
+    return total, mean + delta * ratio, m2 + day_m2 + delta ** 2 * count * ratio
+
+def trim_state(state):
+    '''
+    :Purpose: return the state with its day buffers cut to the stored days, as views
+    :prams: state
+    :type: dict
+    :return: dict
+    '''
+    n_days = int(state["n_days"])
+    return dict(state, **{key: state[key][:n_days] for key in day_buffers})
+
+def reserve_days(state, n_days):
+    '''
+    :Purpose: make room for n_days in every day buffer, doubling the capacity when it runs out
+    :prams: state
+    :type: dict
+    :prams: n_days
+    :type: int
+    :return: None, the state is updated in place
+    '''
+    for key in day_buffers:
+        buffer = state[key]
+        if len(buffer) >= n_days:
+            continue
+        grown = np.empty((max(n_days, 2 * len(buffer), 16),) + buffer.shape[1:], dtype = buffer.dtype)
+        grown[:len(buffer)] = buffer
+        state[key] = grown
+
+def add_params(state, param_names):
+    '''
+    :Purpose: extend the state with parameters it has not seen yet. Stored days get a missing value
+              for them, counted as 0 with missing = "zero" and left out with "mask" like a full
+              recompute would. Copies the stored values, only when a file reports a new pollutant
+    :prams: state
+    :type: dict
+    :prams: param_names
+    :type: list of str, the new parameters
+    :return: None, the state is updated in place
+    '''
+    n_days, n_sites, n_new = int(state["n_days"]), len(state["site_names"]), len(param_names)
+    zero = str(state["missing"]) == "zero"
+    state["param_names"] = np.concatenate([state["param_names"], np.array(param_names, dtype = str)])
+    state["count"] = np.concatenate([state["count"], np.full(n_new, float(n_days * n_sites) if zero else 0.0)])
+    state["mean"] = np.concatenate([state["mean"], np.zeros(n_new)])
+    state["m2"] = np.concatenate([state["m2"], np.zeros(n_new)])
+    filler = np.full((len(state["values"]), n_sites, n_new), 0.0 if zero else np.nan)
+    state["values"] = np.concatenate([state["values"], filler], axis = 2)
+
+def normalize_day(state, day_values):
+    '''
+    :Purpose: normalize one day with the current statistics of the state
+    :prams: state
+    :type: dict
+    :prams: day_values
+    :type: np.ndarray of shape (sites, parameters)
+    :return: float day index, np.ndarray per site index
+    '''
+    std = np.sqrt(state["m2"] / np.maximum(state["count"] - 1, 1))
+    standard = np.where(np.isnan(day_values), 0.0, (day_values - state["mean"]) / (std * 10))
+    standard_sites = standard[:, 0].copy()
+    for index in range(1, standard.shape[1]):
+        standard_sites += standard[:, index]
+    return standard_sites.sum(), standard_sites
+
+@instrumented
+def update_state(state, date, day_frame):
+    '''
+    :Purpose: add one day to the state in amortized O(sites x parameters), historical days are untouched
+    :prams: state
+    :type: dict
+    :prams: date
+    :type: Timestamp
+    :prams: day_frame
+    :type: DataFrame indexed by (Parameter, Site), output of get_features_frame
+    :return: dict, the updated state; days already in the state are ignored. Earlier days than the
+             last stored one are inserted in date order, moving the later days by one. Parameters
+             the state has not seen are added with add_params
+    '''
+    date = np.datetime64(pd.Timestamp(date).date(), "D")
+    n_days = int(state["n_days"])
+    position = int(np.searchsorted(state["dates"][:n_days], date))
+    if position < n_days and state["dates"][position] == date:
+        return state
+
+    day_params = pd.unique(day_frame.index.get_level_values("Parameter").astype(str))
+    new_params = [param for param in day_params if param not in set(state["param_names"])]
+    if new_params:
+        add_params(state, new_params)
+
+    values, _ = frame_to_tensor(
+        pd.concat([day_frame], keys = [date], names = ["Date"]),
+        list(state["param_names"]), list(state["site_names"])
+    )
+    day_values = values[0]
+    if str(state["missing"]) == "zero":
+        day_values = np.where(np.isnan(day_values), 0.0, day_values)
+
+    state["count"], state["mean"], state["m2"] = welford_update(
+        state["count"], state["mean"], state["m2"], day_values
+    )
+    normalized, normalized_sites = normalize_day(state, day_values)
+
+    reserve_days(state, n_days + 1)
+    for key in day_buffers:
+        state[key][position + 1:n_days + 1] = state[key][position:n_days]
+    state["dates"][position] = date
+    state["values"][position] = day_values
+    state["normalized"][position] = normalized
+    state["normalized_sites"][position] = normalized_sites
+    state["n_days"] = np.array(n_days + 1)
+    return state
+
+@instrumented
+def ingest_daily_file(state, url, retries = 3):
+    '''
+    :Purpose: fetch one yesterday_YYYYMMDD.CSV file and add it to the state
+    :prams: state
+    :type: dict
+    :prams: url
+    :type: str, http(s) url or local path
+    :return: dict, the updated state
+    '''
+    d = read_daily_csv(fetch_with_retry(url, retries = retries))
+    return update_state(state, url_to_date(url), get_features_frame(d, list(state["site_names"])))
+
+@instrumented
+def build_state(features, site_names, missing = "zero"):
+    '''
+    :Purpose: seed a state from a full season frame, one day at a time
+    :prams: features
+    :type: DataFrame indexed by (Date, Parameter, Site), output of get_2019_features with as_frame = True
+    :prams: site_names
+    :type: list of str
+    :return: dict
+    '''
+    param_names = list(pd.unique(features.index.get_level_values("Parameter")))
+    state = new_state(param_names, site_names, missing)
+    for date, day_frame in features.groupby(level = "Date", sort = True):
+        state = update_state(state, date, day_frame.droplevel("Date"))
+    return state
+
+@instrumented
+def recompute_state(state, verify = True, rtol = 1e-9):
+    '''
+    :Purpose: recompute the statistics and normalized series of every day from the stored values
+    :prams: state
+    :type: dict
+    :prams: verify
+    :type: bool, check that the running statistics match a two pass computation
+    :return: dict, a new state normalized with the final statistics of all days
+    '''
+    state = trim_state(state)
+    values = state["values"]
+    flat = values.reshape(-1, values.shape[2])
+    if verify and len(flat) > 1:
+        count = np.sum(~np.isnan(flat), axis = 0)
+        assert np.array_equal(count, state["count"]), "Running counts drifted"
+        assert np.allclose(np.nanmean(flat, axis = 0), state["mean"], rtol = rtol), "Running means drifted"
+        assert np.allclose(np.nanvar(flat, axis = 0) * count, state["m2"], rtol = rtol), "Running variances drifted"
+
+    standard = normalize_tensor(values, str(state["missing"]))
+    standard_sites = standard[:, :, 0].copy()
+    for index in range(1, standard.shape[2]):
+        standard_sites += standard[:, :, index]
+
+    state["normalized_sites"] = standard_sites
+    state["normalized"] = standard_sites.sum(axis = 1)
+    return state
+
+@instrumented
+def save_state(state, path):
+    '''
+    :Purpose: atomically persist the stored days of the state to a .npz file
+    :prams: state
+    :type: dict
+    :prams: path
+    :type: str
+    :return: None
+    '''
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, **trim_state(state))
+    os.replace(tmp_path, path)
+
+@instrumented
+def load_state(path):
+    '''
+    :Purpose: load a state saved by save_state
+    :prams: path
+    :type: str
+    :return: dict
+    '''
+    with np.load(path, allow_pickle = False) as data:
+        state = {key: data[key] for key in data.files}
+    return state
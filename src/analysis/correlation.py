@@ -0,0 +1,259 @@
+import itertools
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from src.pipeline.render import process_pool
+from src.pipeline.instrument import instrumented
+
+
+def _pearson_from_sums(n, sx, sy, sxx, syy, sxy, min_periods):
+    """
+    Pearson correlation from the sums over the valid pairs, NaN where fewer
+    than min_periods pairs were seen or a side is constant
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx * sy / n
+        var_x = sxx - sx * sx / n
+        var_y = syy - sy * sy / n
+        r = cov / np.sqrt(var_x * var_y)
+    r[(n < max(min_periods, 2)) | (var_x <= 0) | (var_y <= 0)] = np.nan
+    return np.clip(r, -1, 1)
+
+
+def _valid_pairs(x, y):
+    """
+    Centered copies of x and y with 0 where either side is missing, and the
+    mask of valid pairs
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    valid = ~(np.isnan(x) | np.isnan(y))
+    # Centering keeps the cumulative and FFT sums well conditioned
+    x = np.where(valid, x - np.nanmean(x[valid]) if valid.any() else 0.0, 0.0)
+    y = np.where(valid, y - np.nanmean(y[valid]) if valid.any() else 0.0, 0.0)
+    return x, y, valid
+
+
+@instrumented
+def rolling_pearson(x, y, window, min_periods=None):
+    """
+    Trailing-window Pearson correlation in O(n) with cumulative sums
+
+    Parameters
+    ----------
+    x, y : array-like
+        Series of equal length, NaN marks missing values
+    window : int
+        Number of periods per window
+    min_periods : int
+        Minimum number of valid pairs in a window, defaults to window
+
+    Returns
+    -------
+    np.ndarray of length n, NaN for the first window - 1 periods
+    """
+    min_periods = window if min_periods is None else min_periods
+    x, y, valid = _valid_pairs(x, y)
+
+    def window_sum(a):
+        c = np.concatenate([[0.0], np.cumsum(a)])
+        out = np.full(len(a), np.nan)
+        out[window - 1:] = c[window:] - c[:-window]
+        return out
+
+    return _pearson_from_sums(
+        window_sum(valid.astype('float64')), window_sum(x), window_sum(y),
+        window_sum(x * x), window_sum(y * y), window_sum(x * y), min_periods
+    )
+
+
+@instrumented
+def rolling_spearman(x, y, window, min_periods=None):
+    """
+    Trailing-window Spearman correlation. Ranks have to be recomputed per
+    window, so this costs O(n w log w), vectorized over windows
+
+    Parameters
+    ----------
+    x, y : array-like
+        Series of equal length, NaN marks missing values
+    window : int
+        Number of periods per window
+    min_periods : int
+        Minimum number of valid pairs in a window, defaults to window
+
+    Returns
+    -------
+    np.ndarray of length n, NaN for the first window - 1 periods
+    """
+    min_periods = window if min_periods is None else min_periods
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    out = np.full(len(x), np.nan)
+    if len(x) < window:
+        return out
+
+    xw = sliding_window_view(x, window).copy()
+    yw = sliding_window_view(y, window).copy()
+    valid = ~(np.isnan(xw) | np.isnan(yw))
+    xw[~valid] = np.nan
+    yw[~valid] = np.nan
+    rx = pd.DataFrame(xw).rank(axis=1).to_numpy()
+    ry = pd.DataFrame(yw).rank(axis=1).to_numpy()
+
+    n = valid.sum(axis=1).astype('float64')
+    rx = np.where(valid, rx, 0.0)
+    ry = np.where(valid, ry, 0.0)
+    out[window - 1:] = _pearson_from_sums(
+        n, rx.sum(axis=1), ry.sum(axis=1), (rx * rx).sum(axis=1),
+        (ry * ry).sum(axis=1), (rx * ry).sum(axis=1), min_periods
+    )
+    return out
+
+
+@instrumented
+def lagged_correlation(x, y, max_lag, min_periods=3):
+    """
+    Pearson correlation of x[t] with y[t + lag] for every lag in
+    [-max_lag, max_lag], computed over the overlapping valid pairs of each
+    lag with FFTs in O(n log n)
+
+    Parameters
+    ----------
+    x, y : array-like
+        Series of equal length, NaN marks missing values
+    max_lag : int
+        Largest shift in periods; a positive lag means y follows x
+    min_periods : int
+        Minimum number of overlapping valid pairs
+
+    Returns
+    -------
+    np.ndarray of length 2 * max_lag + 1, indexed from -max_lag
+    """
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    n = len(x)
+    max_lag = min(max_lag, n - 1)
+    mx = ~np.isnan(x)
+    my = ~np.isnan(y)
+    # Center each series on its own valid values; Pearson is shift invariant
+    x = np.where(mx, x - (x[mx].mean() if mx.any() else 0.0), 0.0)
+    y = np.where(my, y - (y[my].mean() if my.any() else 0.0), 0.0)
+    mx = mx.astype('float64')
+    my = my.astype('float64')
+
+    nfft = 1 << int(np.ceil(np.log2(2 * n)))
+    lags = np.arange(-max_lag, max_lag + 1)
+
+    def xcorr(a, b):
+        # sum_t a[t] * b[t + lag] for every lag
+        c = np.fft.irfft(np.conj(np.fft.rfft(a, nfft)) * np.fft.rfft(b, nfft), nfft)
+        return c[lags % nfft]
+
+    counts = np.rint(xcorr(mx, my))
+    return _pearson_from_sums(
+        counts, xcorr(x, my), xcorr(mx, y), xcorr(x * x, my),
+        xcorr(mx, y * y), xcorr(x, y), min_periods
+    )
+
+
+def _correlate_pairs(args):
+    """
+    Correlate a chunk of pairs, run in a worker process by correlate_panel
+    """
+    values, pairs, windows, max_lag, method, min_periods = args
+    rolling = spearman_or_pearson[method]
+    results = []
+    for i, j in pairs:
+        lagged = lagged_correlation(values[:, i], values[:, j], max_lag)
+        windowed = [rolling(values[:, i], values[:, j], w, min_periods) for w in windows]
+        results.append((i, j, lagged, windowed))
+    return results
+
+
+spearman_or_pearson = {'pearson': rolling_pearson, 'spearman': rolling_spearman}
+
+
+@instrumented
+def correlate_panel(panel, windows=(30,), max_lag=30, method='pearson', min_periods=None, max_workers=1, chunk_size=64):
+    """
+    Lagged and rolling correlations of every pair of panel columns
+
+    Parameters
+    ----------
+    panel : pd.DataFrame
+        Time aligned columns, e.g. the output of build_panel
+    windows : list
+        Rolling window lengths in periods
+    max_lag : int
+        Largest shift in periods of the lagged correlations
+    method : str
+        'pearson' or 'spearman' for the rolling correlations
+    min_periods : int
+        Minimum number of valid pairs per window, defaults to the window
+    max_workers : int
+        Number of worker processes, 1 runs in the current process and None
+        uses every core
+    chunk_size : int
+        Number of pairs sent to a worker at a time
+
+    Returns
+    -------
+    lagged : pd.DataFrame
+        Index of lags, one (x, y) column per pair
+    rolling : dict
+        Window length to a DataFrame with the panel index and one (x, y)
+        column per pair
+    """
+    assert method in spearman_or_pearson, "method should be 'pearson' or 'spearman'"
+
+    values = panel.to_numpy(dtype='float64')
+    pairs = list(itertools.combinations(range(values.shape[1]), 2))
+    chunks = [
+        (values, pairs[k:k + chunk_size], list(windows), max_lag, method, min_periods)
+        for k in range(0, len(pairs), chunk_size)
+    ]
+    if max_workers == 1:
+        results = [r for chunk in chunks for r in _correlate_pairs(chunk)]
+    else:
+        with process_pool(max_workers) as pool:
+            results = [r for rs in pool.map(_correlate_pairs, chunks) for r in rs]
+
+    names = panel.columns
+    columns = pd.MultiIndex.from_tuples([(names[i], names[j]) for i, j, _, _ in results], names=['x', 'y'])
+    max_lag = min(max_lag, len(panel) - 1)
+    lagged = pd.DataFrame(
+        np.column_stack([r[2] for r in results]) if results else None,
+        index=pd.RangeIndex(-max_lag, max_lag + 1, name='lag'), columns=columns
+    )
+    rolling = {
+        w: pd.DataFrame(
+            np.column_stack([r[3][k] for r in results]) if results else None,
+            index=panel.index, columns=columns
+        )
+        for k, w in enumerate(windows)
+    }
+    return lagged, rolling
+
+
+@instrumented
+def best_lags(lagged):
+    """
+    Parameters
+    ----------
+    lagged : pd.DataFrame
+        Output of correlate_panel
+
+    Returns
+    -------
+    DataFrame with the lag of the strongest absolute correlation of each
+    pair and that correlation, sorted by strength
+    """
+    strength = lagged.abs()
+    best = strength.fillna(-1).idxmax()
+    out = pd.DataFrame({
+        'lag': best,
+        'correlation': [lagged.loc[lag, pair] for pair, lag in best.items()],
+    })
+    return out.reindex(out['correlation'].abs().sort_values(ascending=False).index)
@@ -0,0 +1,207 @@
+import numpy as np
+import pandas as pd
+
+from src.accidents.accidents_data import cached_ingestion_and_clean
+from src.air_quality.air_quality_analysis import (
+    month_enum, selected_sites, get_2019_features, get_2020_features,
+    frame_to_tensor, normalize_tensor
+)
+from src.econ.data import ingest_and_clean, aggregate_on
+from src.mobility.data import read_mobility_regions
+from src.sdge.data import read_sdge_range
+from src.pipeline.instrument import instrumented
+
+
+@instrumented
+def accidents_series(df, freq='D'):
+    """
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Output of ingestion_and_clean
+    freq : str
+        Frequency of the panel
+
+    Returns
+    -------
+    DataFrame with the number of accidents per period
+    """
+    return df.resample(freq, on='Start_Time').size().rename('accidents').to_frame()
+
+
+@instrumented
+def econ_series(df, freq='D'):
+    """
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Output of econ.data.ingest_and_clean
+    freq : str
+        Frequency of the panel
+
+    Returns
+    -------
+    DataFrame with the number of business accounts opened per period
+    """
+    return aggregate_on(df, 'date_account_creation', period=freq).rename('econ_accounts_opened').to_frame()
+
+
+@instrumented
+def mobility_series(df, freq='D'):
+    """
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Output of ingest_filter_data or read_mobility_regions for one region
+    freq : str
+        Frequency of the panel
+
+    Returns
+    -------
+    DataFrame with the mean percent change from baseline of every place
+    category per period
+    """
+    values = df.set_index('date').select_dtypes('number')
+    return values.resample(freq).mean().add_prefix('mobility_')
+
+
+@instrumented
+def sdge_series(df, freq='D'):
+    """
+    Parameters
+    ----------
+    df : pd.DataFrame
+        ELEC rows of read_sdge_range, with Year, Month, CustomerClass and
+        AveragekWh columns
+    freq : str
+        Frequency of the panel
+
+    Returns
+    -------
+    DataFrame with the summed average kWh of every customer class. Monthly
+    values are held constant over the periods of their month
+    """
+    months = pd.to_datetime(pd.DataFrame({'year': df['Year'], 'month': df['Month'], 'day': 1}))
+    monthly = (
+        df.assign(MonthStart=months)
+        .pivot_table(index='MonthStart', columns='CustomerClass', values='AveragekWh',
+                     aggfunc='sum', observed=True)
+        .add_prefix('sdge_avgkwh_')
+    )
+    monthly.columns = [str(col) for col in monthly.columns]
+    grid = pd.date_range(monthly.index.min(), monthly.index.max() + pd.offsets.MonthEnd(1), freq=freq)
+    return monthly.reindex(monthly.index.union(grid)).ffill().reindex(grid)
+
+
+@instrumented
+def air_quality_series(df, freq='D', site_names=selected_sites, missing='zero'):
+    """
+    Parameters
+    ----------
+    df : pd.DataFrame
+        (Date, Parameter, Site) indexed features of get_2019_features and
+        get_2020_features with as_frame = True, concatenated
+    freq : str
+        Frequency of the panel
+    site_names : list
+        Sites summed into the index
+    missing : str
+        "zero" or "mask", see normalize_tensor
+
+    Returns
+    -------
+    DataFrame with the per-day sum of the z-scores over sites and
+    parameters, averaged per period. That is the sum over sites of the per
+    site series of get_normalized_features, not its overall index, which
+    mixes days. The parameters are the ones get_features_frame keeps
+    """
+    param_names = list(pd.unique(df.index.get_level_values('Parameter')))
+    values, dates = frame_to_tensor(df, param_names, site_names)
+    index = normalize_tensor(values, missing).sum(axis=(1, 2))
+    daily = pd.Series(index, index=pd.DatetimeIndex(dates), name='air_quality_index')
+    return daily.resample(freq).mean().to_frame()
+
+
+domain_series = {
+    'accidents': accidents_series,
+    'econ': econ_series,
+    'mobility': mobility_series,
+    'sdge': sdge_series,
+    'air_quality': air_quality_series,
+}
+
+
+def default_loaders(data_dir='../data/', air_quality_cache_dir=None):
+    """
+    Parameters
+    ----------
+    data_dir : str
+        Folder laid out as described in the README
+    air_quality_cache_dir : str
+        Optional raw file cache of the air quality fetcher
+
+    Returns
+    -------
+    Dict of domain name to a function loading the domain data. Nothing is
+    read until a loader is called
+    """
+    def load_air_quality():
+        return pd.concat([
+            get_2019_features(month_enum, cache_dir=air_quality_cache_dir, as_frame=True),
+            get_2020_features(month_enum, cache_dir=air_quality_cache_dir, as_frame=True),
+        ])
+
+    def load_sdge():
+        data, _ = read_sdge_range(data_dir + 'sdge/', ['2019', '2020'], types=['ELEC'])
+        return data
+
+    return {
+        'accidents': lambda: cached_ingestion_and_clean(data_dir + 'accidents/US_Accidents_June20.csv'),
+        'econ': lambda: ingest_and_clean(
+            data_dir + 'econ/sd_businesses_active_since08_datasd_v1.csv',
+            usecols=['date_account_creation']
+        ),
+        'mobility': lambda: read_mobility_regions(data_dir + 'mobility/')[('California', 'San Diego County')],
+        'sdge': load_sdge,
+        'air_quality': load_air_quality,
+    }
+
+
+@instrumented
+def build_panel(loaders, domains=None, freq='D', start=None, end=None, cache=None):
+    """
+    Join several domains on a common DatetimeIndex
+
+    Parameters
+    ----------
+    loaders : dict
+        Domain name to a function returning the domain data, see default_loaders
+    domains : list
+        Domains to include, all loaders by default
+    freq : str
+        Frequency of the common index, e.g. 'D', 'W' or 'M'
+    start, end : str or pd.Timestamp
+        Optional bounds of the panel
+    cache : dict
+        Optional dict reused across calls. Domain data and resampled frames
+        are stored in it, so only domains not computed yet are loaded
+
+    Returns
+    -------
+    A float32 DataFrame with one column per domain series
+    """
+    domains = list(loaders) if domains is None else domains
+    assert all(domain in domain_series for domain in domains), "Unknown domain"
+    cache = {} if cache is None else cache
+
+    frames = []
+    for domain in domains:
+        if (domain, freq) not in cache:
+            if domain not in cache:
+                cache[domain] = loaders[domain]()
+            cache[(domain, freq)] = domain_series[domain](cache[domain], freq).astype(np.float32)
+        frames.append(cache[(domain, freq)])
+
+    panel = pd.concat(frames, axis=1, join='outer').sort_index()
+    panel.index.name = 'date'
+    return panel.loc[start:end]
@@ -1,39 +1,71 @@
 import pandas as pd
-from io import StringIO
+from src.pipeline.instrument import instrumented
 
-def ingest_and_clean(raw_fp):
+date_columns = ['date_account_creation', 'date_cert_expiration', 'date_business_start']
+date_format = '%Y-%m-%d'
+
+# Corrupted year prefixes found in the date columns and their repairs
+date_prefix_fixes = {
+    '0017-': '2017-',
+    '7201-': '2017-',
+    '7202-': '2027-',
+    '0018-': '2018-',
+    '0019-': '2019-',
+    '1019-': '2019-',
+    '0020-': '2020-',
+}
+
+@instrumented
+def ingest_and_clean(raw_fp, usecols=None):
     '''
     Parameters
     ----------
     raw_fp : string
         path to tax certification data
+    usecols : list
+        Optional subset of columns to load
     
     Returns
     -------
     DataFrame od data read from csv
     '''
-    with open(raw_fp) as f:
-        raw_str = f.read()
-
-    raw_str = raw_str.replace('"0017-', '"2017-')
-    raw_str = raw_str.replace('"7201-', '"2017-')
-    raw_str = raw_str.replace('"7202-', '"2027-')
-    raw_str = raw_str.replace('"0018-', '"2018-')
-    raw_str = raw_str.replace('"0019-', '"2019-')
-    raw_str = raw_str.replace('"1019-', '"2019-')
-    raw_str = raw_str.replace('"0020-', '"2020-')
-
-    df = pd.read_csv(
-        StringIO(raw_str),
-        parse_dates=[
-            'date_account_creation',
-            'date_cert_expiration',
-            'date_business_start'
-        ]
-    )
+    dates = [col for col in date_columns if usecols is None or col in usecols]
+    df = pd.read_csv(raw_fp, usecols=usecols, dtype={col: str for col in dates})
+    df = repair_dates(df, dates)
     verify_good_data(df)
     return df
 
+@instrumented
+def repair_dates(df, columns=date_columns):
+    '''
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame with date columns read as strings
+    columns : list
+        Date columns to repair and parse
+    
+    Returns
+    -------
+    DataFrame with corrupted year prefixes fixed and the columns parsed to
+    datetimes. A column with unparseable or out of bounds dates is left as
+    strings, like read_csv's parse_dates does
+    '''
+    repaired = {}
+    for col in columns:
+        values = df[col]
+        prefix = values.str.slice(0, 5)
+        bad = prefix.isin(list(date_prefix_fixes)).to_numpy()
+        if bad.any():
+            values = values.copy()
+            values[bad] = prefix[bad].map(date_prefix_fixes) + values[bad].str.slice(5)
+        try:
+            repaired[col] = pd.to_datetime(values, format=date_format)
+        except (ValueError, pd.errors.OutOfBoundsDatetime):
+            repaired[col] = values
+    return df.assign(**repaired)
+
+@instrumented
 def verify_good_data(df):
     '''
     Parameters
@@ -46,12 +78,14 @@ def verify_good_data(df):
     Nothing is everything is good; otherwise it raises an error
     '''
     try:
-        pd.to_datetime(df['date_account_creation'])
-        pd.to_datetime(df['date_business_start'])
+        for col in ['date_account_creation', 'date_business_start']:
+            if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+                pd.to_datetime(df[col])
     except pd.errors.OutOfBoundsDatetime as e:
         print(e)
         raise e
 
+@instrumented
 def aggregate_on(df, column, period='W'):
     """
     Return a numerial time pd.Series with freq=period based on counts
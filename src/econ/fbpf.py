@@ -1,22 +1,17 @@
+import os
+import json
+import uuid
+import pickle
+import hashlib
 import numpy as np
-from fbprophet import Prophet
 from src.econ.data import *
+from src.econ.trend import make_trend
+from src.pipeline.render import new_figure, process_pool
+from src.pipeline.instrument import instrumented
 
-try:
-    from matplotlib import pyplot as plt
-    from matplotlib.dates import (
-        MonthLocator,
-        num2date,
-        AutoDateLocator,
-        AutoDateFormatter,
-        DateFormatter
-    )
-    from matplotlib.ticker import FuncFormatter
-
-    from pandas.plotting import deregister_matplotlib_converters
-    deregister_matplotlib_converters()
-except ImportError:
-    logger.error('Importing matplotlib failed. Plotting will not work.')
+# fbprophet (and its Stan backend) and matplotlib are imported by the
+# functions using them, so importing this module stays cheap for callers
+# that only aggregate or read cached forecasts
 
 
 def prepare_ts(s):
@@ -37,9 +32,9 @@ def prepare_ts(s):
     return out
 
 
-def make_prophet(s, prior=0.5):
+def prophet_settings(s, prior=0.5):
     """
-    Make a Prophet object and initialize the analysis
+    Prophet settings used by make_prophet for a series
 
     Parameters
     ----------
@@ -50,7 +45,7 @@ def make_prophet(s, prior=0.5):
     
     Returns
     -------
-    A prophet model object and the forecast time series
+    A dict of keyword arguments for Prophet
     """
     if 'W' in s.index.freq.name:
         weekly_seasonality=False
@@ -58,24 +53,277 @@ def make_prophet(s, prior=0.5):
     if 'D' in s.index.freq.name:
         weekly_seasonality=True
         daily_seasonality=False
-    m = Prophet(
+    return dict(
         changepoint_range=1, changepoint_prior_scale=prior,
         weekly_seasonality=weekly_seasonality,
         daily_seasonality=daily_seasonality
     )
+
+
+def prophet_cache_key(s, settings):
+    """
+    Hash of everything a fitted model depends on
+
+    Parameters
+    ----------
+    s : pd.Series
+        A datetime indexed pd.Series
+    settings : dict
+        Output of prophet_settings
+    
+    Returns
+    -------
+    Hex digest of the series values, index, freq, the settings and the
+    fbprophet version
+    """
+    import fbprophet
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(s.to_numpy(dtype='float64')).tobytes())
+    digest.update(np.ascontiguousarray(s.index.asi8).tobytes())
+    digest.update(json.dumps(
+        [s.index.freqstr, settings, fbprophet.__version__], sort_keys=True
+    ).encode())
+    return digest.hexdigest()
+
+
+def load_cached_prophet(cache_dir, key):
+    """
+    Load a model and forecast stored by store_cached_prophet
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the model cache
+    key : str
+        Output of prophet_cache_key
+    
+    Returns
+    -------
+    The prophet model object and the forecast time series, or None on a miss.
+    An entry that cannot be read, e.g. truncated by an interrupted write, is
+    deleted and counts as a miss
+    """
+    from fbprophet.serialize import model_from_json
+    model_fp = os.path.join(cache_dir, key + '.json')
+    forecast_fp = os.path.join(cache_dir, key + '.pkl')
+    try:
+        with open(model_fp) as f:
+            m = model_from_json(f.read())
+        forecast = pd.read_pickle(forecast_fp)
+        # Mark the entry as recently used for the LRU eviction
+        os.utime(model_fp)
+        os.utime(forecast_fp)
+    except FileNotFoundError:
+        # Not stored, or the other half is still being written
+        return None
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, KeyError, TypeError, AttributeError):
+        remove_cached_prophet(cache_dir, key)
+        return None
+    return m, forecast
+
+
+def remove_cached_prophet(cache_dir, key):
+    """
+    Delete both files of a cache entry, whichever exist
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the model cache
+    key : str
+        Output of prophet_cache_key
+    """
+    for ext in ('.json', '.pkl'):
+        try:
+            os.remove(os.path.join(cache_dir, key + ext))
+        except FileNotFoundError:
+            pass
+
+
+def store_cached_prophet(cache_dir, key, m, forecast, max_bytes=500 * 2**20):
+    """
+    Store a fitted model and its forecast, evicting the least recently used
+    entries once the cache grows past max_bytes. Each file is written to a
+    temporary file first and renamed into place, and entries are evicted
+    whole, never the one just stored
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the model cache
+    key : str
+        Output of prophet_cache_key
+    m : Prophet
+        Fitted prophet model
+    forecast : pd.DataFrame
+        Output of m.predict
+    max_bytes : int
+        Size bound of the cache directory
+    """
+    from fbprophet.serialize import model_to_json
+    os.makedirs(cache_dir, exist_ok=True)
+    model_fp = os.path.join(cache_dir, key + '.json')
+    forecast_fp = os.path.join(cache_dir, key + '.pkl')
+    # Unique names, so concurrent writers of the same key never share one
+    tmp = '.{}.tmp'.format(uuid.uuid4().hex)
+    try:
+        with open(model_fp + tmp, 'w') as f:
+            f.write(model_to_json(m))
+        forecast.to_pickle(forecast_fp + tmp)
+        os.replace(forecast_fp + tmp, forecast_fp)
+        os.replace(model_fp + tmp, model_fp)
+    finally:
+        for fp in (model_fp + tmp, forecast_fp + tmp):
+            if os.path.exists(fp):
+                os.remove(fp)
+
+    # Key to the last use and total size of its files
+    entries = {}
+    for name in os.listdir(cache_dir):
+        entry, ext = os.path.splitext(name)
+        if ext in ('.json', '.pkl'):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue
+            mtime, size = entries.get(entry, (0, 0))
+            entries[entry] = (max(mtime, stat.st_mtime), size + stat.st_size)
+    total = sum(size for _, size in entries.values())
+    for mtime, size, entry in sorted((mtime, size, entry) for entry, (mtime, size) in entries.items()):
+        if total <= max_bytes:
+            break
+        if entry == key:
+            continue
+        remove_cached_prophet(cache_dir, entry)
+        total -= size
+
+
+@instrumented
+def make_prophet(s, prior=0.5, cache_dir=None, cache_max_bytes=500 * 2**20, engine='prophet'):
+    """
+    Make a Prophet object and initialize the analysis
+
+    Parameters
+    ----------
+    s : pd.Series
+        A datetime indexed pd.Series
+    prior : float
+        The scale given to prior trend
+    cache_dir : str
+        Optional directory caching fitted models and forecasts
+    cache_max_bytes : int
+        Size bound of the cache directory
+    engine : str
+        'prophet' fits with Stan. 'numpy' fits the piecewise-linear trend of
+        make_trend instead, milliseconds per series and without fbprophet;
+        its model has the attributes the plots read and is not cached
+    
+    Returns
+    -------
+    A prophet model object and the forecast time series
+    """
+    assert engine in ('prophet', 'numpy'), "engine should be 'prophet' or 'numpy'"
+    if engine == 'numpy':
+        return make_trend(s, prior=prior)
+
+    from fbprophet import Prophet
+    settings = prophet_settings(s, prior)
+    if cache_dir is not None:
+        key = prophet_cache_key(s, settings)
+        cached = load_cached_prophet(cache_dir, key)
+        if cached is not None:
+            return cached
+
+    m = Prophet(**settings)
     m.fit(prepare_ts(s))
 
     future = m.make_future_dataframe(periods=0)
     forecast = m.predict(future)
+    if cache_dir is not None:
+        store_cached_prophet(cache_dir, key, m, forecast, cache_max_bytes)
     return m, forecast
 
 
+def _fit_serialized(args):
+    """
+    Fit one series in a worker process and return the model as json, so it
+    survives the trip back to the parent without the Stan backend
+    """
+    from fbprophet.serialize import model_to_json
+    name, s, prior, seed, cache_dir = args
+    np.random.seed(seed)
+    m, forecast = make_prophet(s, prior=prior, cache_dir=cache_dir)
+    return name, model_to_json(m), forecast
+
+
+@instrumented
+def make_prophet_batch(df, prior=0.5, max_workers=None, seed=0, cache_dir=None, engine='prophet'):
+    """
+    Fit a Prophet model on every column of a wide frame concurrently
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        A datetime indexed pd.DataFrame with one series per column, such as
+        the unstacked counts by ownership type
+    prior : float
+        The scale given to prior trend
+    max_workers : int
+        Number of worker processes, defaults to the number of cores. 1 fits
+        serially in the current process
+    seed : int
+        Seed of the uncertainty sampling, reset before every fit so the
+        result does not depend on scheduling
+    cache_dir : str
+        Optional directory caching fitted models, see make_prophet. Cached
+        series are not sent to the pool
+    engine : str
+        'prophet' or 'numpy', see make_prophet. numpy fits run serially, they
+        are faster than starting a pool
+    
+    Returns
+    -------
+    Two dicts keyed by column: the prophet models and the forecast time series
+    """
+    assert isinstance(df, pd.DataFrame), "df should be a dataframe"
+    if engine == 'numpy':
+        fits = {name: make_trend(df[name], prior=prior) for name in df.columns}
+        return {name: m for name, (m, _) in fits.items()}, {name: f for name, (_, f) in fits.items()}
+
+    from fbprophet.serialize import model_from_json
+
+    results = []
+    jobs = []
+    for name in df.columns:
+        cached = None
+        if cache_dir is not None:
+            settings = prophet_settings(df[name], prior)
+            cached = load_cached_prophet(cache_dir, prophet_cache_key(df[name], settings))
+        if cached is not None:
+            results.append((name,) + cached)
+        else:
+            jobs.append((name, df[name], prior, seed, cache_dir))
 
+    if max_workers == 1:
+        for name, s, _, _, _ in jobs:
+            np.random.seed(seed)
+            results.append((name,) + make_prophet(s, prior=prior, cache_dir=cache_dir))
+    elif jobs:
+        with process_pool(max_workers) as pool:
+            results += [
+                (name, model_from_json(m_json), forecast)
+                for name, m_json, forecast in pool.map(_fit_serialized, jobs)
+            ]
 
+    models = {name: m for name, m, _ in results}
+    forecasts = {name: forecast for name, _, forecast in results}
+    return models, forecasts
 
+
+@instrumented
 def pf_custom_plot(
     m, fcst, ax=None, uncertainty=True, plot_cap=True, xlabel='ds', ylabel='y',
-    figsize=(10, 6), custom_date_formatter=None
+    figsize=(10, 6), custom_date_formatter=None, show=True
 ):
     """
     Plot the Prophet forecast with more customizations
@@ -92,13 +340,15 @@ def pf_custom_plot(
     xlabel: Optional label name on X-axis
     ylabel: Optional label name on Y-axis
     figsize: Optional tuple width, height in inches.
+    show: Create the figure through pyplot. False draws on a figure
+        detached from pyplot, for headless rendering
 
     Returns
     -------
     A matplotlib figure.
     """
     if ax is None:
-        fig = plt.figure(facecolor='w', figsize=figsize)
+        fig = new_figure(figsize=figsize, pyplot=show)
         ax = fig.add_subplot(111)
     else:
         fig = ax.get_figure()
@@ -115,6 +365,9 @@ def pf_custom_plot(
     if uncertainty and m.uncertainty_samples:
         ax.fill_between(fcst_t, fcst['yhat_lower'], fcst['yhat_upper'],
                         color='#0072B2', alpha=0.2, label='Uncertainty Interval')
+    from matplotlib.dates import AutoDateLocator, AutoDateFormatter
+    from pandas.plotting import deregister_matplotlib_converters
+    deregister_matplotlib_converters()
     # Specify formatting to workaround matplotlib issue #12925
     locator = AutoDateLocator(interval_multiples=False)
     formatter = AutoDateFormatter(locator)
@@ -162,7 +415,8 @@ def add_changepoints_to_plot(
     return artists
 
 
-def make_figure_overall(econ_df):
+@instrumented
+def make_figure_overall(econ_df, cache_dir=None, out_dir='figures/', show=True, engine='prophet'):
     """
     Plot the first analysis graph with all data
 
@@ -170,23 +424,40 @@ def make_figure_overall(econ_df):
     ----------
     econ_df : pd.DataFrame
         DataFrame of good data
+    cache_dir : str
+        Optional directory caching fitted models, see make_prophet
+    out_dir : str
+        Folder the figure is saved to, None does not save it
+    show : bool
+        Create the figure through pyplot, see pf_custom_plot
+    engine : str
+        'prophet' or 'numpy', see make_prophet
+
+    Returns
+    -------
+    A matplotlib figure.
     """
     ts = aggregate_on(econ_df, 'date_account_creation', period='W')
-    model, forecasts = make_prophet(ts)
+    model, forecasts = make_prophet(ts, cache_dir=cache_dir, engine=engine)
 
     fig = pf_custom_plot(
         model, forecasts, uncertainty=True,
         xlabel='', ylabel='Number of Accounts Opened',
-        figsize=(8, 5)
+        figsize=(8, 5), show=show
     )
-    add_changepoints_to_plot(fig.gca(), model, forecasts, cp_color='#FB8500', cp_vlines=False)
-    plt.title('Number of Business Accounts Opened by Week Since 2008', {'fontsize': 15})
-    plt.ylabel('Number of Accounts Opened', fontsize=13)
-    fig.gca().legend(bbox_to_anchor=(1.04,0), loc="lower left", prop={'size': 12})
-    fig.savefig('figures/econ-1.png', bbox_inches='tight', dpi=200)
+    ax = fig.gca()
+    add_changepoints_to_plot(ax, model, forecasts, cp_color='#FB8500', cp_vlines=False)
+    ax.set_title('Number of Business Accounts Opened by Week Since 2008', {'fontsize': 15})
+    ax.set_ylabel('Number of Accounts Opened', fontsize=13)
+    ax.legend(bbox_to_anchor=(1.04,0), loc="lower left", prop={'size': 12})
+    if out_dir is not None:
+        fig.savefig(os.path.join(out_dir, 'econ-1.png'), bbox_inches='tight', dpi=200)
+    return fig
 
 
-def make_figure_group(indf, groupname):
+@instrumented
+def make_figure_group(indf, groupname, fitted=None, out_dir='figures/', show=True, cache_dir=None,
+                      engine='prophet'):
     """
     Plot the rest analysis graphs with group data
 
@@ -196,41 +467,103 @@ def make_figure_group(indf, groupname):
         DataFrame of good data
     groupname : str
         Name of group to graph
+    fitted : tuple
+        Optional (model, forecast) already fitted on indf, e.g. by make_prophet_batch
+    out_dir : str
+        Folder the figure is saved to, None does not save it
+    show : bool
+        Create the figure through pyplot and show it, see pf_custom_plot
+    cache_dir : str
+        Optional directory caching fitted models, see make_prophet
+    engine : str
+        'prophet' or 'numpy', see make_prophet
+
+    Returns
+    -------
+    A matplotlib figure.
     """
-    model, forecasts = make_prophet(indf, prior=0.8)
+    from matplotlib.dates import DateFormatter
+    if fitted is None:
+        fitted = make_prophet(indf, prior=0.8, cache_dir=cache_dir, engine=engine)
+    model, forecasts = fitted
 
     fig = pf_custom_plot(
         model, forecasts, uncertainty=True,
         xlabel='', ylabel='Number of Accounts Opened',
-        figsize=(8, 3), custom_date_formatter=DateFormatter('%b-%y')
+        figsize=(8, 3), custom_date_formatter=DateFormatter('%b-%y'), show=show
     )
-    add_changepoints_to_plot(fig.gca(), model, forecasts, cp_color='#FB8500', cp_vlines=False)
-    plt.title(f'{groupname}', {'fontsize': 15})
-    plt.ylabel('Number of Accounts Opened', fontsize=12)
-    fig.gca().legend(
+    ax = fig.gca()
+    add_changepoints_to_plot(ax, model, forecasts, cp_color='#FB8500', cp_vlines=False)
+    ax.set_title(f'{groupname}', {'fontsize': 15})
+    ax.set_ylabel('Number of Accounts Opened', fontsize=12)
+    ax.legend(
         loc='upper center', bbox_to_anchor=(0.5, -0.18),
         fancybox=True, shadow=True, ncol=4
     )
-    plt.show()
-    fig.savefig(f'figures/econ-{indf.name}.png', bbox_inches='tight', dpi=200)
+    if show:
+        from matplotlib import pyplot as plt
+        plt.show()
+    if out_dir is not None:
+        fig.savefig(os.path.join(out_dir, f'econ-{indf.name}.png'), bbox_inches='tight', dpi=200)
+    return fig
 
 
-def make_figures(econ_data_fp):
-    """
-    Helper function that includes all graphs in notebook
+ownership_groups = {
+    'CORP': 'Corporations',
+    'LLC': 'LLCs',
+    'SCORP': '"S" Corporations',
+    'SOLE': 'Sole Ownerships',
+}
+
+
+@instrumented
+def count_by_ownership(econ_df, since='2018-01-01'):
     """
-    econ_df = ingest_and_clean(econ_data_fp)
-    make_figure_overall(econ_df)
+    Weekly number of accounts opened per ownership type
+
+    Parameters
+    ----------
+    econ_df : pd.DataFrame
+        DataFrame of good data
+    since : str
+        First day counted
 
-    creations_by_ownership = (
-        econ_df[econ_df.date_account_creation >= pd.Timestamp('2018-01-01')]
+    Returns
+    -------
+    A wide pd.DataFrame with one column per ownership type
+    """
+    return (
+        econ_df[econ_df.date_account_creation >= pd.Timestamp(since)]
         .groupby([
             pd.Grouper(key='date_account_creation', freq='W'),
             'ownership_type'
         ])
         .size().unstack().fillna(0)
     )
-    make_figure_group(creations_by_ownership['CORP'], 'Corporations')
-    make_figure_group(creations_by_ownership['LLC'], 'LLCs')
-    make_figure_group(creations_by_ownership['SCORP'], '"S" Corporations')
-    make_figure_group(creations_by_ownership['SOLE'], 'Sole Ownerships')
+
+
+@instrumented
+def make_figures(econ_data_fp, cache_dir=None, out_dir='figures/', show=True, engine='prophet'):
+    """
+    Helper function that includes all graphs in notebook
+
+    Fitted models are cached in cache_dir, by default a 'prophet_cache'
+    folder next to econ_data_fp, so re-rendering skips fitting. engine='numpy'
+    draws the fast piecewise-linear trend of make_trend instead of Prophet.
+    Returns the list of figures
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(econ_data_fp), 'prophet_cache')
+    econ_df = ingest_and_clean(econ_data_fp)
+    figs = [make_figure_overall(econ_df, cache_dir=cache_dir, out_dir=out_dir, show=show, engine=engine)]
+
+    creations_by_ownership = count_by_ownership(econ_df)
+    models, forecasts = make_prophet_batch(
+        creations_by_ownership[list(ownership_groups)], prior=0.8, cache_dir=cache_dir, engine=engine
+    )
+    for column, groupname in ownership_groups.items():
+        figs.append(make_figure_group(
+            creations_by_ownership[column], groupname,
+            fitted=(models[column], forecasts[column]), out_dir=out_dir, show=show
+        ))
+    return figs
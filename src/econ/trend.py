@@ -0,0 +1,202 @@
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from src.pipeline.instrument import instrumented
+
+
+class TrendModel:
+    """
+    Fitted piecewise-linear trend exposing the attributes of a Prophet model
+    read by pf_custom_plot and add_changepoints_to_plot
+    """
+    logistic_floor = False
+
+    def __init__(self, history, changepoints, params, y_scale, sigma, uncertainty_samples):
+        self.history = history
+        self.changepoints = changepoints
+        self.params = params
+        self.y_scale = y_scale
+        self.sigma = sigma
+        self.uncertainty_samples = uncertainty_samples
+
+
+def changepoint_grid(ds, n_changepoints=25, changepoint_range=1):
+    """
+    Changepoints placed like Prophet: evenly over the first changepoint_range
+    of the history, first date excluded
+
+    Parameters
+    ----------
+    ds : pd.Series
+        Dates of the history
+    n_changepoints : int
+        Number of potential changepoints
+    changepoint_range : float
+        Share of the history holding changepoints
+
+    Returns
+    -------
+    pd.Series of changepoint dates
+    """
+    hist_size = int(np.floor(len(ds) * changepoint_range))
+    n_changepoints = min(n_changepoints, hist_size - 1)
+    if n_changepoints <= 0:
+        return ds.iloc[:0]
+    cp_indexes = np.linspace(0, hist_size - 1, n_changepoints + 1).round().astype(int)
+    return ds.iloc[cp_indexes].tail(-1)
+
+
+def fourier_terms(ds, period=365.25, order=10):
+    """
+    Parameters
+    ----------
+    ds : pd.Series
+        Dates
+    period : float
+        Period in days
+    order : int
+        Number of sine/cosine pairs
+
+    Returns
+    -------
+    np.ndarray of shape (len(ds), 2 * order)
+    """
+    t = ds.to_numpy(dtype='datetime64[ns]').astype('int64') / (86400 * 1e9)
+    angles = 2 * np.pi * np.arange(1, order + 1)[None, :] * t[:, None] / period
+    return np.column_stack([np.sin(angles), np.cos(angles)])
+
+
+@instrumented
+def make_trend(s, prior=0.5, n_changepoints=25, changepoint_range=1, yearly_order='auto',
+               interval_width=0.8, iterations=50, tol=1e-8):
+    """
+    Fit a piecewise-linear trend with an L1 penalty on the slope changes,
+    the MAP estimate of Prophet's Laplace changepoint prior, by iteratively
+    reweighted least squares. Takes milliseconds where Stan takes seconds
+
+    Parameters
+    ----------
+    s : pd.Series
+        A datetime indexed pd.Series
+    prior : float
+        The scale given to prior trend, like changepoint_prior_scale
+    n_changepoints : int
+        Number of potential changepoints
+    changepoint_range : float
+        Share of the history holding changepoints
+    yearly_order : int or 'auto'
+        Fourier order of the yearly seasonality, 0 turns it off. 'auto' uses
+        10 with at least two years of history, like Prophet
+    interval_width : float
+        Width of the yhat uncertainty interval
+    iterations : int
+        Maximum number of reweighting iterations
+    tol : float
+        Stop once the coefficients move less than this
+
+    Returns
+    -------
+    A TrendModel and a forecast DataFrame with the columns of Prophet's
+    predict: ds, trend, yhat_lower, yhat_upper, trend_lower, trend_upper,
+    additive_terms, yearly, multiplicative_terms and yhat (with bounds)
+    """
+    history = s.rename_axis('ds').rename('y').reset_index()
+    history = history[history['y'].notna()].reset_index(drop=True)
+    ds = history['ds']
+    y = history['y'].to_numpy(dtype='float64')
+
+    # Same scaling as Prophet, so delta thresholds keep their meaning
+    y_scale = np.abs(y).max() or 1.0
+    y_scaled = y / y_scale
+    start, span = ds.iloc[0], (ds.iloc[-1] - ds.iloc[0]) or pd.Timedelta(days=1)
+    t = ((ds - start) / span).to_numpy(dtype='float64')
+    changepoints = changepoint_grid(ds, n_changepoints, changepoint_range)
+    t_cp = ((changepoints - start) / span).to_numpy(dtype='float64')
+
+    if yearly_order == 'auto':
+        yearly_order = 10 if ds.iloc[-1] - ds.iloc[0] >= pd.Timedelta(days=730) else 0
+    seasonal = fourier_terms(ds, order=yearly_order) if yearly_order else np.empty((len(ds), 0))
+
+    # Columns: offset, slope, one hinge per changepoint, seasonal terms
+    hinges = np.maximum(t[:, None] - t_cp[None, :], 0)
+    X = np.column_stack([np.ones_like(t), t, hinges, seasonal])
+    n_cp = len(t_cp)
+    cp_cols = slice(2, 2 + n_cp)
+    seasonal_cols = slice(2 + n_cp, X.shape[1])
+
+    gram = X.T @ X
+    xty = X.T @ y_scaled
+    penalty = np.zeros(X.shape[1])
+    # Normal(0, 10) prior of Prophet's seasonal coefficients, a light ridge
+    ridge = np.zeros(X.shape[1])
+    beta = np.linalg.lstsq(X, y_scaled, rcond=None)[0]
+    for _ in range(iterations):
+        sigma2 = max(np.mean((y_scaled - X @ beta) ** 2), 1e-12)
+        ridge[seasonal_cols] = sigma2 / 10 ** 2
+        # sigma^2 |delta| / prior approximated around the current deltas
+        penalty[cp_cols] = sigma2 / (prior * (np.abs(beta[cp_cols]) + 1e-6))
+        new_beta = np.linalg.solve(gram + np.diag(penalty + ridge), xty)
+        converged = np.max(np.abs(new_beta - beta)) < tol
+        beta = new_beta
+        if converged:
+            break
+
+    delta = beta[cp_cols]
+    trend = (X[:, :2 + n_cp] @ beta[:2 + n_cp]) * y_scale
+    yearly = (X[:, seasonal_cols] @ beta[seasonal_cols]) * y_scale
+    yhat = trend + yearly
+    sigma = np.sqrt(np.mean((y - yhat) ** 2))
+    half_width = NormalDist().inv_cdf(0.5 + interval_width / 2) * sigma
+
+    forecast = pd.DataFrame({
+        'ds': ds,
+        'trend': trend,
+        'yhat_lower': yhat - half_width,
+        'yhat_upper': yhat + half_width,
+        # In-sample trend is certain, as in Prophet without future periods
+        'trend_lower': trend,
+        'trend_upper': trend,
+        'additive_terms': yearly,
+        'additive_terms_lower': yearly,
+        'additive_terms_upper': yearly,
+        'yearly': yearly,
+        'yearly_lower': yearly,
+        'yearly_upper': yearly,
+        'multiplicative_terms': 0.0,
+        'multiplicative_terms_lower': 0.0,
+        'multiplicative_terms_upper': 0.0,
+        'yhat': yhat,
+    })
+    if not yearly_order:
+        forecast = forecast.drop(columns=['yearly', 'yearly_lower', 'yearly_upper'])
+
+    params = {
+        'k': np.array([[beta[1]]]), 'm': np.array([[beta[0]]]), 'delta': delta[None, :],
+        'sigma_obs': np.array([[sigma / y_scale]]), 'beta': beta[seasonal_cols][None, :],
+    }
+    model = TrendModel(history, changepoints, params, y_scale, sigma, uncertainty_samples=1000)
+    return model, forecast
+
+
+def significant_changepoints(model, threshold=0.01):
+    """
+    Parameters
+    ----------
+    model : TrendModel or Prophet
+        Fitted model
+    threshold : float
+        Threshold on the scaled slope change, as in add_changepoints_to_plot
+
+    Returns
+    -------
+    DataFrame with the date and the slope change, in the scaled units of
+    the fit, of every significant changepoint
+    """
+    delta = np.nanmean(model.params['delta'], axis=0)
+    keep = np.abs(delta) >= threshold
+    return pd.DataFrame({
+        'ds': np.asarray(model.changepoints)[keep],
+        'delta': delta[keep],
+    })
@@ -1,7 +1,13 @@
 import pandas as pd
 import os
-from matplotlib import pyplot as plt
+import io
+import re
+import csv
+import json
+from src.pipeline.render import new_figure
+from src.pipeline.instrument import instrumented
 
+@instrumented
 def read_mobility_data(path):
     '''
     Parameters
@@ -17,6 +23,178 @@ def read_mobility_data(path):
     assert os.path.exists(file_path), "File does not exist"
     return pd.read_csv(file_path)
 
+@instrumented
+def read_mobility_regions(path, regions=[('California','San Diego County')], chunksize=200000):
+    '''
+    Parameters
+    ----------
+    path : string
+        path to mobility data
+    regions : list
+        (sub_region_1, sub_region_2) pairs to extract
+    chunksize : int
+        Number of rows parsed at a time
+    Returns
+    -------
+    Dictionary mapping each region to a DataFrame shaped like the output of
+    ingest_filter_data. Rows are filtered chunk by chunk, only the date and
+    percent change columns are read and dates are parsed for kept rows only
+    '''
+    file_path = path+"Region_Mobility_Report_CSVs/2020_US_Region_Mobility_Report.csv"
+    assert os.path.exists(file_path), "File does not exist"
+
+    header = pd.read_csv(file_path, nrows=0).columns
+    value_cols = [col for col in header if col.endswith('_percent_change_from_baseline')]
+    region_cols = ['sub_region_1','sub_region_2']
+    reader = pd.read_csv(file_path, usecols=region_cols+['date']+value_cols,
+                         dtype={col: str for col in region_cols+['date']}, chunksize=chunksize)
+
+    states = {state for state,_ in regions}
+    chunks = []
+    for chunk in reader:
+        chunk = chunk[chunk['sub_region_1'].isin(states)]
+        keep = pd.MultiIndex.from_frame(chunk[region_cols]).isin(regions)
+        chunk = chunk[keep]
+        # Only the kept rows pay for date parsing
+        chunks.append(chunk.assign(date=pd.to_datetime(chunk['date'], format='%Y-%m-%d')))
+    data = pd.concat(chunks)
+
+    region_data = {}
+    for region in regions:
+        selected = data[(data['sub_region_1']==region[0]) & (data['sub_region_2']==region[1])]
+        selected = selected.drop(columns=region_cols)
+        region_data[region] = selected.rename(columns=lambda x: str(x).split('_')[0])
+    return region_data
+
+def _region_ranges(file_path):
+    '''
+    Parameters
+    ----------
+    file_path : string
+        Path of one region mobility report
+    Returns
+    -------
+    Dictionary mapping "sub_region_1|sub_region_2" to the list of
+    [start, end) byte ranges of its rows. Consecutive rows of a region are
+    merged into one range
+    '''
+    ranges = {}
+    with open(file_path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8')]))
+        col1, col2 = header.index('sub_region_1'), header.index('sub_region_2')
+        offset = f.tell()
+        last_key = None
+        for line in f:
+            if b'"' in line:
+                fields = next(csv.reader([line.decode('utf-8')]))
+            else:
+                fields = line.decode('utf-8').split(',')
+            key = fields[col1] + '|' + fields[col2]
+            end = offset + len(line)
+            if key == last_key:
+                ranges[key][-1][1] = end
+            else:
+                ranges.setdefault(key, []).append([offset, end])
+            last_key = key
+            offset = end
+    return ranges
+
+@instrumented
+def build_region_index(path, index_fp=None):
+    '''
+    Parameters
+    ----------
+    path : string
+        path to mobility data
+    index_fp : string
+        Where the index is persisted. Defaults to region_index.json in the
+        Region_Mobility_Report_CSVs folder
+    Returns
+    -------
+    Dictionary describing every <year>_<country>_Region_Mobility_Report.csv
+    file: its year, country, size, mtime and region byte ranges. Files whose
+    size or mtime changed since the last build are scanned again
+    '''
+    csv_dir = path+"Region_Mobility_Report_CSVs/"
+    assert os.path.isdir(csv_dir), "Directory does not exist"
+    if index_fp is None:
+        index_fp = csv_dir+"region_index.json"
+
+    index = {}
+    if os.path.exists(index_fp):
+        with open(index_fp) as f:
+            index = json.load(f)
+
+    files = {}
+    for name in sorted(os.listdir(csv_dir)):
+        match = re.match(r'^(\d{4})_([A-Z]{2})_Region_Mobility_Report\.csv$', name)
+        if match is None:
+            continue
+        stat = os.stat(csv_dir+name)
+        entry = index.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'year': int(match.group(1)), 'country': match.group(2),
+                     'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                     'regions': _region_ranges(csv_dir+name)}
+        files[name] = entry
+
+    if files != index:
+        with open(index_fp+'.tmp', 'w') as f:
+            json.dump(files, f)
+        os.replace(index_fp+'.tmp', index_fp)
+    return files
+
+@instrumented
+def read_region(path, region=('California','San Diego County'), years=None, countries=None, index_fp=None):
+    '''
+    Parameters
+    ----------
+    path : string
+        path to mobility data
+    region : tuple
+        (sub_region_1, sub_region_2), use '' for an empty level
+    years : list
+        Optional years to read as ints or strings, all indexed years by
+        default
+    countries : list
+        Optional two letter country codes to read
+    index_fp : string
+        Passed to build_region_index
+    Returns
+    -------
+    DataFrame with the rows and columns of ingest_filter_data for the
+    region, read by seeking to its byte ranges instead of scanning the
+    files. Rows may come from several files, so the index is a fresh
+    RangeIndex rather than the row labels of one file
+    '''
+    csv_dir = path+"Region_Mobility_Report_CSVs/"
+    index = build_region_index(path, index_fp)
+    key = region[0] + '|' + region[1]
+    if years is not None:
+        years = [int(year) for year in years]
+
+    frames = []
+    for name, entry in index.items():
+        if years is not None and entry['year'] not in years:
+            continue
+        if countries is not None and entry['country'] not in countries:
+            continue
+        if key not in entry['regions']:
+            continue
+        with open(csv_dir+name, 'rb') as f:
+            blocks = [f.readline()]
+            for start, end in entry['regions'][key]:
+                f.seek(start)
+                blocks.append(f.read(end - start))
+        frames.append(pd.read_csv(io.BytesIO(b''.join(blocks)), parse_dates=['date']))
+
+    if not frames:
+        return pd.DataFrame()
+    data = pd.concat(frames, ignore_index=True)
+    data = data.drop(data.filter(regex='region|code|area').columns, axis=1)
+    return data.rename(columns=lambda x: str(x).split('_')[0])
+
+@instrumented
 def ingest_filter_data(df):
     '''
     Parameters
@@ -41,8 +219,9 @@ def ingest_filter_data(df):
 
     return SD_data
 
+@instrumented
 def make_figure(df, cols=['transit','residential','workplaces','grocery'],
-                   colors=['#219ebc', '#023047', '#fb8500', '#ffb703']):
+                   colors=['#219ebc', '#023047', '#fb8500', '#ffb703'], show=True):
     '''
     Parameters
     ----------
@@ -52,14 +231,17 @@ def make_figure(df, cols=['transit','residential','workplaces','grocery'],
         List of columns we want to plot
     colors: string
         list of colors we want to use for the plots
+    show : bool
+        Create the figure through pyplot. False draws on a figure detached
+        from pyplot, for headless rendering
     Returns
     -------
-    None
+    A matplotlib figure
     '''
     assert all(col in df.columns for col in cols), "Columns don't exist in DataFrame"
     assert len(cols) <= len(colors), "Insufficient Colors for plots"
 
-    fig = plt.figure(facecolor='w',figsize=(10,6),dpi=300)
+    fig = new_figure(figsize=(10,6), dpi=300, pyplot=show)
     ax = fig.add_subplot(1, 1, 1)
     for idx,key in enumerate(cols):
         df.plot(x='date',y=key, label=key, ax=ax, legend=True, color = colors[idx % len(colors)])
@@ -71,4 +253,5 @@ def make_figure(df, cols=['transit','residential','workplaces','grocery'],
     # Shrink current axis by 20%
     box = ax.get_position()
     ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-    plt.legend(cols,loc='lower left', bbox_to_anchor=(1, 0.5))
\ No newline at end of file
+    ax.legend(cols,loc='lower left', bbox_to_anchor=(1, 0.5))
+    return fig
\ No newline at end of file
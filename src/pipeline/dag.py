@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from src.pipeline.render import figure_job, render_figures
+from src.pipeline.instrument import span, track_memory
+
+
+logger = logging.getLogger(__name__)
+
+# Stages take the run config and a dict of their dependencies' artifacts.
+# Domain modules are imported inside the stages, so a run only loads the
+# libraries of the domains it was asked for.
+
+def accidents_ingest(config, inputs):
+    from src.accidents.accidents_data import cached_ingestion_and_clean
+    return cached_ingestion_and_clean(os.path.join(config['data_dir'], 'accidents', 'US_Accidents_June20.csv'))
+
+
+def accidents_feature(config, inputs):
+    from src.accidents.accidents_graph import prepare_series
+    return prepare_series(inputs['accidents.ingest'], field='RushHour', timestamp='2019-09-09', freq='W')
+
+
+def accidents_figure(config, inputs):
+    from src.accidents.accidents_graph import custom_plot
+    jobs = [figure_job('accidents-rush-hour', custom_plot, inputs['accidents.feature'])]
+    return render_figures(jobs, config['out_dir'], config['render_workers'], force=config['force'])
+
+
+def econ_ingest(config, inputs):
+    from src.econ.data import ingest_and_clean
+    return ingest_and_clean(
+        os.path.join(config['data_dir'], 'econ', 'sd_businesses_active_since08_datasd_v1.csv'),
+        usecols=['date_account_creation', 'ownership_type']
+    )
+
+
+def econ_feature(config, inputs):
+    from src.econ.data import aggregate_on
+    from src.econ.fbpf import count_by_ownership
+    econ_df = inputs['econ.ingest']
+    return {
+        'overall': aggregate_on(econ_df, 'date_account_creation', period='W'),
+        'by_ownership': count_by_ownership(econ_df),
+    }
+
+
+def econ_model(config, inputs):
+    from src.econ.fbpf import make_prophet, make_prophet_batch, ownership_groups
+    features = inputs['econ.feature']
+    if config['econ_engine'] == 'numpy':
+        # Fits take milliseconds, the figure jobs refit instead of caching
+        return None
+    make_prophet(features['overall'], cache_dir=config['prophet_cache_dir'])
+    make_prophet_batch(
+        features['by_ownership'][list(ownership_groups)], prior=0.8,
+        cache_dir=config['prophet_cache_dir']
+    )
+    return config['prophet_cache_dir']
+
+
+def econ_figure(config, inputs):
+    from src.econ.fbpf import make_figure_overall, make_figure_group, ownership_groups
+    cache_dir = inputs['econ.model']
+    engine = config['econ_engine']
+    by_ownership = inputs['econ.feature']['by_ownership']
+    jobs = [figure_job('econ-1', make_figure_overall, inputs['econ.ingest'], cache_dir=cache_dir,
+                       out_dir=None, engine=engine)]
+    jobs += [
+        figure_job('econ-' + column, make_figure_group, by_ownership[column], groupname,
+                   out_dir=None, cache_dir=cache_dir, engine=engine)
+        for column, groupname in ownership_groups.items()
+    ]
+    return render_figures(jobs, config['out_dir'], config['render_workers'], force=config['force'])
+
+
+def mobility_ingest(config, inputs):
+    from src.mobility.data import read_mobility_regions
+    regions = read_mobility_regions(os.path.join(config['data_dir'], 'mobility', ''))
+    return regions[('California', 'San Diego County')]
+
+
+def mobility_figure(config, inputs):
+    from src.mobility.data import make_figure
+    jobs = [figure_job('mobility', make_figure, inputs['mobility.ingest'])]
+    return render_figures(jobs, config['out_dir'], config['render_workers'], force=config['force'])
+
+
+def sdge_ingest(config, inputs):
+    from src.sdge.data import read_sdge_range
+    data, missing = read_sdge_range(os.path.join(config['data_dir'], 'sdge', ''), ['2019', '2020'], types=['ELEC'])
+    if missing:
+        logger.warning('Missing SDG&E files: %s', missing)
+    return data
+
+
+def sdge_feature(config, inputs):
+    from src.sdge.data import aggregate_avgkwh
+    return aggregate_avgkwh(inputs['sdge.ingest'], ['FileYear', 'Month', 'CustomerClass'])
+
+
+def sdge_figure(config, inputs):
+    from src.sdge.data import make_figure
+    avgkwh = inputs['sdge.feature']
+    jobs = []
+    for c, customer in {'I': 'Industrial', 'C': 'Commercial', 'R': 'Residential'}.items():
+        rows = avgkwh[avgkwh['CustomerClass'] == c].sort_values('Month')
+        d_19 = (rows[rows['FileYear'] == 2019]['AveragekWh'] / 1e3).tolist()
+        d_20 = (rows[rows['FileYear'] == 2020]['AveragekWh'] / 1e3).tolist()
+        jobs.append(figure_job('sdge-' + c, make_figure, d_19, d_20, customer))
+    return render_figures(jobs, config['out_dir'], config['render_workers'], force=config['force'])
+
+
+def air_quality_ingest(config, inputs):
+    from src.air_quality.air_quality_analysis import month_enum, get_2019_features, get_2020_features
+    cache_dir = os.path.join(config['data_dir'], 'air_quality')
+    return (
+        get_2019_features(month_enum, cache_dir=cache_dir, as_frame=True),
+        get_2020_features(month_enum, cache_dir=cache_dir, as_frame=True),
+    )
+
+
+def air_quality_feature(config, inputs):
+    from src.air_quality.air_quality_analysis import selected_sites, get_normalized_features
+    features_2019, features_2020 = inputs['air_quality.ingest']
+    return get_normalized_features(features_2019, features_2020, selected_sites)
+
+
+def air_quality_figure(config, inputs):
+    from src.air_quality.air_quality_analysis import selected_sites
+    from src.air_quality.air_quality_graph import get_graphs
+    average, average_sites = inputs['air_quality.feature']
+    days_2019 = inputs['air_quality.ingest'][0].index.get_level_values('Date').nunique()
+    jobs = [figure_job('air-quality', get_graphs, average, average_sites, selected_sites, out_dir=None,
+                       days_2019=days_2019)]
+    return render_figures(jobs, config['out_dir'], config['render_workers'], force=config['force'])
+
+
+# Stage name to (function, dependencies)
+stages = {
+    'accidents.ingest': (accidents_ingest, []),
+    'accidents.feature': (accidents_feature, ['accidents.ingest']),
+    'accidents.figure': (accidents_figure, ['accidents.feature']),
+    'econ.ingest': (econ_ingest, []),
+    'econ.feature': (econ_feature, ['econ.ingest']),
+    'econ.model': (econ_model, ['econ.feature']),
+    'econ.figure': (econ_figure, ['econ.ingest', 'econ.feature', 'econ.model']),
+    'mobility.ingest': (mobility_ingest, []),
+    'mobility.figure': (mobility_figure, ['mobility.ingest']),
+    'sdge.ingest': (sdge_ingest, []),
+    'sdge.feature': (sdge_feature, ['sdge.ingest']),
+    'sdge.figure': (sdge_figure, ['sdge.feature']),
+    'air_quality.ingest': (air_quality_ingest, []),
+    'air_quality.feature': (air_quality_feature, ['air_quality.ingest']),
+    'air_quality.figure': (air_quality_figure, ['air_quality.ingest', 'air_quality.feature']),
+}
+
+domains = ['accidents', 'econ', 'mobility', 'sdge', 'air_quality']
+
+
+def select_stages(selected_domains, graph=stages):
+    """
+    Parameters
+    ----------
+    selected_domains : list
+        Domain names, e.g. ['accidents', 'econ']
+    graph : dict
+        Stage name to (function, dependencies)
+
+    Returns
+    -------
+    The sub-graph of the stages of the selected domains and their dependencies
+    """
+    assert all(domain in domains for domain in selected_domains), "Unknown domain"
+    todo = [name for name in graph if name.split('.')[0] in selected_domains]
+    selected = {}
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected[name] = graph[name]
+            todo.extend(graph[name][1])
+    return {name: graph[name] for name in graph if name in selected}
+
+
+def run_stages(graph, config, max_workers=4, memory=True):
+    """
+    Run a stage graph, starting every stage as soon as its dependencies are
+    done so independent stages run concurrently
+
+    Parameters
+    ----------
+    graph : dict
+        Stage name to (function, dependencies)
+    config : dict
+        Passed to every stage
+    max_workers : int
+        Number of stages running at the same time
+    memory : bool
+        Trace Python allocations to record the peak memory of every stage
+
+    Returns
+    -------
+    artifacts : dict
+        Stage name to its output, shared with the stages depending on it
+    report : list
+        One dict per stage with its start, wall time, and with memory=True
+        the peak of the Python allocations made while it ran, above what
+        was allocated when it started. Stages running at the same time share
+        the process, so their peaks include each other's allocations; the
+        'concurrent' count says how many other stages overlapped it. Figure
+        worker processes are not traced
+    """
+    artifacts, report = {}, []
+    pending = dict(graph)
+    running = {}
+    # Highest number of other stages seen running alongside each running stage
+    overlaps = {}
+    t0 = time.perf_counter()
+
+    def run(name, func, inputs):
+        start = time.perf_counter()
+        usage = {}
+        with span('stage ' + name):
+            if memory:
+                with track_memory() as usage:
+                    out = func(config, inputs)
+            else:
+                out = func(config, inputs)
+        return out, {
+            'stage': name,
+            'start_s': round(start - t0, 3),
+            'wall_s': round(time.perf_counter() - start, 3),
+            'peak_mb': usage.get('peak_mb'),
+        }
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            ready = [name for name, (_, deps) in pending.items() if all(dep in artifacts for dep in deps)]
+            for name in ready:
+                func, deps = pending.pop(name)
+                running[pool.submit(run, name, func, {dep: artifacts[dep] for dep in deps})] = name
+            for name in running.values():
+                overlaps[name] = max(overlaps.get(name, 0), len(running) - 1)
+            assert running, "Stage graph has a cycle or a missing dependency"
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                artifacts[name], stats = future.result()
+                stats['concurrent'] = overlaps.pop(name)
+                report.append(stats)
+    return artifacts, report
+
+
+def run_pipeline(selected_domains=domains, data_dir='data/', out_dir='figures/', max_workers=4,
+                 render_workers=None, force=False, econ_engine='prophet', memory=True):
+    """
+    Ingest, model and render the figures of the selected domains
+
+    Parameters
+    ----------
+    selected_domains : list
+        Domain names, all domains by default
+    data_dir : str
+        Folder laid out as described in the README
+    out_dir : str
+        Folder of the figures and of pipeline_report.json
+    max_workers : int
+        Number of stages running at the same time
+    render_workers : int
+        Worker processes of each figure stage, see render_figures
+    force : bool
+        Render figures even if their inputs did not change
+    econ_engine : str
+        'prophet' or 'numpy', see make_prophet
+    memory : bool
+        Record the peak memory of every stage, see run_stages
+
+    Returns
+    -------
+    The per-stage report, also written to pipeline_report.json
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    config = {
+        'data_dir': data_dir,
+        'out_dir': out_dir,
+        'render_workers': render_workers,
+        'force': force,
+        'econ_engine': econ_engine,
+        'prophet_cache_dir': os.path.join(data_dir, 'econ', 'prophet_cache'),
+    }
+    _, report = run_stages(select_stages(selected_domains), config, max_workers, memory)
+    with open(os.path.join(out_dir, 'pipeline_report.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+    return report
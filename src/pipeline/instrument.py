@@ -0,0 +1,307 @@
+import os
+import json
+import time
+import logging
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger('src.instrument')
+
+# None while instrumentation is off, so instrumented functions only pay for
+# one global lookup. Set to a dict of the run settings by enable
+_active = None
+_events = []
+# Running peaks of the blocks measuring memory, on every thread. tracemalloc
+# has a single peak, so it is folded into all of them before each reset
+_watchers = []
+_watch_lock = threading.Lock()
+# Open track_memory blocks, and whether one of them started tracemalloc
+_tracking = 0
+_tracking_started = False
+
+
+def enable(trace_fp=None, log=False, memory=False):
+    """
+    Start recording instrumented calls and spans
+
+    Parameters
+    ----------
+    trace_fp : str
+        Optional Chrome trace JSON file written by disable, viewable in
+        chrome://tracing or Perfetto
+    log : bool
+        Also emit every record as a JSON line on the 'src.instrument' logger
+    memory : bool
+        Trace Python allocations with tracemalloc to record the peak of
+        every call. Slows calls down noticeably; peaks of calls running on
+        several threads at once include each other's allocations
+    """
+    global _active
+    _events.clear()
+    # Leave tracemalloc running on disable if someone else started it
+    owns_tracemalloc = memory and not tracemalloc.is_tracing()
+    if owns_tracemalloc:
+        tracemalloc.start()
+    _active = {
+        'trace_fp': trace_fp, 'log': log, 'memory': memory, 'owns_tracemalloc': owns_tracemalloc,
+        't0': time.perf_counter(), 'pid': os.getpid(),
+    }
+
+
+def disable():
+    """
+    Stop recording and write the Chrome trace if one was asked for
+
+    Returns
+    -------
+    List of the recorded events
+    """
+    global _active, _tracking_started
+    active, _active = _active, None
+    if active is None:
+        return []
+    with _watch_lock:
+        if active['owns_tracemalloc'] or _tracking_started:
+            if _tracking:
+                # Leave it to the last open track_memory block
+                _tracking_started = True
+            else:
+                tracemalloc.stop()
+                _tracking_started = False
+    events = list(_events)
+    if active['trace_fp'] is not None:
+        write_chrome_trace(events, active['trace_fp'])
+    return events
+
+
+def frame_stats(obj):
+    """
+    Parameters
+    ----------
+    obj : object
+        Frame, series, array, or a tuple, list or dict of them
+
+    Returns
+    -------
+    Number of rows and shallow memory usage in bytes of the frames, series
+    and arrays in obj, (0, 0) for anything else
+    """
+    if isinstance(obj, pd.DataFrame):
+        return len(obj), int(obj.memory_usage(index=True, deep=False).sum())
+    if isinstance(obj, pd.Series):
+        return len(obj), int(obj.memory_usage(index=True, deep=False))
+    if isinstance(obj, np.ndarray):
+        return (len(obj) if obj.ndim else 1), obj.nbytes
+    if isinstance(obj, (tuple, list, dict)):
+        rows = nbytes = 0
+        for item in (obj.values() if isinstance(obj, dict) else obj):
+            if isinstance(item, (pd.DataFrame, pd.Series, np.ndarray, tuple, list, dict)):
+                r, b = frame_stats(item)
+                rows, nbytes = rows + r, nbytes + b
+        return rows, nbytes
+    return 0, 0
+
+
+def _fold_peak():
+    """
+    Fold the tracemalloc peak into every open watcher and reset it. Call
+    with _watch_lock held
+    """
+    peak = tracemalloc.get_traced_memory()[1]
+    for watcher in _watchers:
+        watcher['peak'] = max(watcher['peak'], peak)
+    tracemalloc.reset_peak()
+
+
+@contextmanager
+def _watch():
+    """
+    Track the peak of traced memory over a block, tracemalloc running
+    """
+    with _watch_lock:
+        _fold_peak()
+        watcher = {'start': tracemalloc.get_traced_memory()[0], 'peak': 0}
+        _watchers.append(watcher)
+    try:
+        yield watcher
+    finally:
+        with _watch_lock:
+            _fold_peak()
+            _watchers.remove(watcher)
+            watcher['end'] = tracemalloc.get_traced_memory()[0]
+
+
+@contextmanager
+def track_memory():
+    """
+    Measure the Python allocations of a block, starting tracemalloc for its
+    duration if needed, e.g.
+
+        with track_memory() as usage:
+            ...
+        usage['peak_mb']
+
+    Yields
+    ------
+    Dict filled on exit with peak_mb, the peak of traced memory above what
+    was allocated when the block started. Allocations of other threads
+    running at the same time are included, and child processes are not
+    """
+    global _tracking, _tracking_started
+    with _watch_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracking_started = True
+        _tracking += 1
+    usage = {}
+    try:
+        with _watch() as watcher:
+            yield usage
+        usage['peak_mb'] = round(max(watcher['peak'] - watcher['start'], 0) / 2**20, 3)
+    finally:
+        with _watch_lock:
+            _tracking -= 1
+            # Keep tracing while instrumentation records memory
+            if _tracking == 0 and _tracking_started and not (_active and _active['memory']):
+                tracemalloc.stop()
+                _tracking_started = False
+
+
+@contextmanager
+def span(name, **fields):
+    """
+    Record a block of code, e.g.
+
+        with span('econ.fit', group=name) as record:
+            ...
+            record['rows_out'] = len(forecast)
+
+    Parameters
+    ----------
+    name : str
+        Name of the block in the trace
+    fields
+        Extra values stored with the record
+
+    Yields
+    ------
+    The record dict, so the block can add values, or None when
+    instrumentation is off
+    """
+    active = _active
+    if active is None:
+        yield None
+        return
+
+    record = dict(fields)
+    if not active['memory']:
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            _record(active, name, start, time.perf_counter(), record)
+        return
+
+    try:
+        with _watch() as watcher:
+            start = time.perf_counter()
+            try:
+                yield record
+            finally:
+                end = time.perf_counter()
+    finally:
+        record['peak_mb'] = round(watcher['peak'] / 2**20, 3)
+        record['end_mb'] = round(watcher['end'] / 2**20, 3)
+        _record(active, name, start, end, record)
+
+
+def _record(active, name, start, end, record):
+    """
+    Store one complete event and log it if asked
+    """
+    event = {
+        'name': name,
+        'ph': 'X',
+        'ts': round((start - active['t0']) * 1e6, 1),
+        'dur': round((end - start) * 1e6, 1),
+        'pid': active['pid'],
+        'tid': threading.get_ident(),
+        'args': record,
+    }
+    _events.append(event)
+    if active['log']:
+        logger.info(json.dumps(dict(record, name=name, seconds=round(end - start, 6)), default=str))
+
+
+def instrumented(func):
+    """
+    Decorator recording every call of func while instrumentation is on: its
+    duration, the rows and shallow memory of the frames, series and arrays
+    it takes and returns, and with memory=True its tracemalloc peak. When
+    instrumentation is off the call goes straight through
+    """
+    name = '{}.{}'.format(func.__module__, func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return func(*args, **kwargs)
+        rows_in, bytes_in = frame_stats(list(args) + list(kwargs.values()))
+        with span(name) as record:
+            out = func(*args, **kwargs)
+            rows_out, bytes_out = frame_stats(out if isinstance(out, (tuple, list, dict)) else [out])
+            record.update(
+                rows_in=rows_in, mb_in=round(bytes_in / 2**20, 3),
+                rows_out=rows_out, mb_out=round(bytes_out / 2**20, 3)
+            )
+        return out
+
+    return wrapper
+
+
+def write_chrome_trace(events, trace_fp):
+    """
+    Parameters
+    ----------
+    events : list
+        Output of disable
+    trace_fp : str
+        JSON file in the Chrome trace event format
+    """
+    with open(trace_fp, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+def summarize(events):
+    """
+    Parameters
+    ----------
+    events : list
+        Output of disable
+
+    Returns
+    -------
+    DataFrame with the number of calls, total and slowest duration in
+    seconds and the largest rows and peak memory of every name, slowest
+    total first
+    """
+    if not events:
+        return pd.DataFrame(columns=['calls', 'total_s', 'max_s', 'rows_in', 'rows_out', 'peak_mb'])
+    df = pd.DataFrame({
+        'name': [e['name'] for e in events],
+        'seconds': [e['dur'] / 1e6 for e in events],
+        'rows_in': [e['args'].get('rows_in', np.nan) for e in events],
+        'rows_out': [e['args'].get('rows_out', np.nan) for e in events],
+        'peak_mb': [e['args'].get('peak_mb', np.nan) for e in events],
+    })
+    out = df.groupby('name').agg(
+        calls=('seconds', 'size'), total_s=('seconds', 'sum'), max_s=('seconds', 'max'),
+        rows_in=('rows_in', 'max'), rows_out=('rows_out', 'max'), peak_mb=('peak_mb', 'max')
+    )
+    return out.sort_values('total_s', ascending=False)
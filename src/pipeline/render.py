@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import pickle
+import hashlib
+import inspect
+import threading
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from src.pipeline.instrument import instrumented
+
+
+# Serializes manifest updates of render_figures calls sharing an out_dir
+_manifest_lock = threading.Lock()
+
+
+def process_pool(max_workers=None, initializer=None):
+    """
+    Parameters
+    ----------
+    max_workers : int
+        Number of worker processes, defaults to the number of cores
+    initializer : callable
+        Optional function run once in every worker
+
+    Returns
+    -------
+    A ProcessPoolExecutor that is safe to open from any thread. Workers are
+    started by a fork server where available, since forking a process whose
+    other threads hold the import lock or a library lock hangs the child
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver') if 'forkserver' in methods else None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=initializer)
+
+
+def _read_manifest(manifest_fp):
+    """
+    Render manifest as a dict, empty if it does not exist yet
+    """
+    if os.path.exists(manifest_fp):
+        with open(manifest_fp) as f:
+            return json.load(f)
+    return {}
+
+
+def new_figure(figsize=(10, 6), dpi=100, facecolor='w', pyplot=True):
+    """
+    Parameters
+    ----------
+    figsize : tuple
+        Width, height in inches
+    dpi : int
+        Resolution of the figure
+    facecolor : str
+        Background color
+    pyplot : bool
+        Create the figure through pyplot so notebooks display it. False
+        returns a figure detached from pyplot drawn with Agg, which never
+        touches global pyplot state and is freed once unreferenced
+
+    Returns
+    -------
+    A matplotlib figure
+    """
+    if pyplot:
+        from matplotlib import pyplot as plt
+        return plt.figure(figsize=figsize, dpi=dpi, facecolor=facecolor)
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize, dpi=dpi, facecolor=facecolor)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _code_fingerprint(func):
+    """
+    Bytes changing with the code of func: the source of its module when it
+    has a file, so edits to the helpers it calls count too, else its own
+    bytecode and constants
+    """
+    path = getattr(sys.modules.get(func.__module__), '__file__', None)
+    if path and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    code = getattr(inspect.unwrap(func), '__code__', None)
+    return b'' if code is None else code.co_code + repr(code.co_consts).encode()
+
+
+def data_fingerprint(obj, digest=None):
+    """
+    Parameters
+    ----------
+    obj : object
+        Frames, series, arrays, containers of them or any picklable value
+    digest : hashlib object
+        Optional running digest to update
+
+    Returns
+    -------
+    Hex digest of the content of obj. Functions count with their code, so
+    editing a figure function invalidates the figures it drew
+    """
+    top = digest is None
+    digest = hashlib.sha1() if top else digest
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        digest.update(type(obj).__name__.encode())
+        if isinstance(obj, pd.DataFrame):
+            digest.update(repr(list(obj.columns)).encode())
+        else:
+            digest.update(repr(obj.name).encode())
+        digest.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+    elif isinstance(obj, np.ndarray):
+        digest.update(repr((obj.dtype.str, obj.shape)).encode())
+        digest.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        digest.update(b'dict')
+        for key in sorted(obj, key=repr):
+            digest.update(repr(key).encode())
+            data_fingerprint(obj[key], digest)
+    elif isinstance(obj, (list, tuple)):
+        digest.update(type(obj).__name__.encode())
+        for item in obj:
+            data_fingerprint(item, digest)
+    elif callable(obj) and hasattr(obj, '__qualname__'):
+        digest.update('{}.{}'.format(obj.__module__, obj.__qualname__).encode())
+        digest.update(_code_fingerprint(obj))
+    else:
+        digest.update(pickle.dumps(obj))
+    return digest.hexdigest() if top else None
+
+
+def figure_job(name, func, *args, **kwargs):
+    """
+    Parameters
+    ----------
+    name : str
+        Base name of the output files
+    func : callable
+        Module level figure function returning a figure or a list of
+        figures. It is called with show=False
+    args, kwargs
+        Arguments of func
+
+    Returns
+    -------
+    A job dict for render_figures
+    """
+    return {'name': name, 'func': func, 'args': args, 'kwargs': kwargs}
+
+
+def _use_agg():
+    """
+    Select the Agg backend before any figure is made in a worker
+    """
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+
+def _output_paths(out_dir, name, count):
+    """
+    File names of a job producing count figures
+    """
+    if count == 1:
+        return [os.path.join(out_dir, name + '.png')]
+    return [os.path.join(out_dir, '{}-{}.png'.format(name, i + 1)) for i in range(count)]
+
+
+def _render_job(args):
+    """
+    Render one job and save its figures, closing them before returning
+    """
+    job, out_dir, dpi = args
+    from matplotlib import pyplot as plt
+    figs = job['func'](*job['args'], show=False, **job['kwargs'])
+    figs = figs if isinstance(figs, (list, tuple)) else [figs]
+    paths = _output_paths(out_dir, job['name'], len(figs))
+    try:
+        for fig, path in zip(figs, paths):
+            fig.savefig(path, bbox_inches='tight', dpi=dpi or fig.dpi)
+    finally:
+        for fig in figs:
+            fig.clf()
+            plt.close(fig)
+    return job['name'], paths
+
+
+@instrumented
+def render_figures(jobs, out_dir='figures/', max_workers=None, dpi=None, force=False):
+    """
+    Render figure jobs headlessly in a process pool, skipping jobs whose
+    inputs did not change since the last run
+
+    Parameters
+    ----------
+    jobs : list
+        Job dicts made by figure_job
+    out_dir : str
+        Folder of the png files and of the render manifest
+    max_workers : int
+        Number of worker processes, 1 renders in the current process
+    dpi : int
+        Optional resolution overriding the one of each figure
+    force : bool
+        Render every job even if its inputs did not change
+
+    Returns
+    -------
+    Dict with the names of the 'rendered' and 'skipped' jobs
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_fp = os.path.join(out_dir, 'render_manifest.json')
+    manifest = _read_manifest(manifest_fp)
+
+    todo, skipped, keys = [], [], {}
+    for job in jobs:
+        keys[job['name']] = data_fingerprint([job['func'], job['args'], job['kwargs'], dpi])
+        entry = manifest.get(job['name'], {})
+        up_to_date = (
+            entry.get('key') == keys[job['name']]
+            and all(os.path.exists(os.path.join(out_dir, path)) for path in entry.get('files', []))
+        )
+        if up_to_date and not force:
+            skipped.append(job['name'])
+        else:
+            todo.append((job, out_dir, dpi))
+
+    if max_workers == 1:
+        # show=False figures are detached from pyplot, so the current backend is left alone
+        results = [_render_job(args) for args in todo]
+    elif todo:
+        with process_pool(max_workers, initializer=_use_agg) as pool:
+            results = list(pool.map(_render_job, todo))
+    else:
+        results = []
+
+    with _manifest_lock:
+        # Re-read so entries written meanwhile by other calls are kept
+        manifest = _read_manifest(manifest_fp)
+        for name, paths in results:
+            # Relative to out_dir, so runs from another working directory still match
+            manifest[name] = {'key': keys[name], 'files': [os.path.relpath(path, out_dir) for path in paths]}
+        with open(manifest_fp + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(manifest_fp + '.tmp', manifest_fp)
+    return {'rendered': [name for name, _ in results], 'skipped': skipped}
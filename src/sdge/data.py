@@ -1,6 +1,17 @@
 
+import os
+import numpy as np
 import pandas as pd
+from src.pipeline.render import new_figure
+from concurrent.futures import ThreadPoolExecutor
+from src.pipeline.instrument import instrumented
 
+sdge_dtypes = {"ZipCode":"category","Month":"int8","Year":"int16",
+               "CustomerClass":"category","Combined":"category",
+               "TotalCustomers":"float64","TotalkWh":"float64","AveragekWh":"float64",
+               "TotalTherms":"float64","AverageTherms":"float64"}
+
+@instrumented
 def read_sdge_data(path,year,quarter,type="ELEC"):
     '''
     Parameters
@@ -26,12 +37,91 @@ def read_sdge_data(path,year,quarter,type="ELEC"):
     return pd.read_csv(path+"SDGE-{}-{}-{}.csv".format(type,year,quarter))
 
 
-def get_avgkwh_per_customer_month(data):
+@instrumented
+def aggregate_avgkwh(data,keys=["Month","CustomerClass"]):
     '''
     Parameters
     ----------
     data : DataFrame
         Contains the SDGE data.
+    keys : list
+        Columns to group on, e.g. ["Month","CustomerClass","ZipCode"]
+
+    Returns
+    -------
+    DataFrame
+        One row per combination of keys with the sum of AveragekWh
+    '''
+    
+    assert isinstance(data,pd.DataFrame)
+    assert all(key in data.columns for key in keys), "Keys missing from data"
+    
+    return data.groupby(keys,sort=False,observed=True)["AveragekWh"].sum().reset_index()
+
+@instrumented
+def read_sdge_range(path,years,quarters=["Q1","Q2","Q3","Q4"],types=["ELEC","GAS"],max_workers=8):
+    '''
+    Parameters
+    ----------
+    path : string
+        path to SDGE data
+    years : list
+        Years as strings, e.g. ["2019","2020"]
+    quarters : list
+        Any of "Q1","Q2","Q3","Q4"
+    types : list
+        Any of "ELEC","GAS"
+    max_workers : int
+        Number of files read concurrently
+
+    Returns
+    -------
+    data : DataFrame
+        Rows of every file found, tagged with Type, FileYear and Quarter
+    missing : list
+        File names that do not exist
+    '''
+    
+    assert all(t in ["ELEC","GAS"] for t in types)
+    assert all(isinstance(y,str) for y in years)
+    assert all(q in ["Q1","Q2","Q3","Q4"] for q in quarters)
+    
+    names = ["SDGE-{}-{}-{}.csv".format(t,y,q) for t in types for y in years for q in quarters]
+    found = [name for name in names if os.path.exists(os.path.join(path,name))]
+    missing = [name for name in names if name not in found]
+    
+    def read(name):
+        _, t, y, q = name[:-4].split("-")
+        frame = pd.read_csv(os.path.join(path,name),dtype=sdge_dtypes)
+        return frame.assign(Type=t,FileYear=int(y),Quarter=q)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        frames = list(pool.map(read,found))
+    if not frames:
+        return pd.DataFrame(), missing
+    
+    # Align categories across files so the concatenated columns stay categorical
+    for col in frames[0].columns:
+        if all(col in f.columns and isinstance(f[col].dtype,pd.CategoricalDtype) for f in frames):
+            categories = pd.api.types.union_categoricals([f[col] for f in frames]).categories
+            for f in frames:
+                f[col] = f[col].cat.set_categories(categories)
+    
+    data = pd.concat(frames,ignore_index=True)
+    data["FileYear"] = data["FileYear"].astype("int16")
+    for col in ["Type","Quarter"]:
+        data[col] = data[col].astype("category")
+    return data, missing
+
+@instrumented
+def get_avgkwh_per_customer_month(data,as_frame=False):
+    '''
+    Parameters
+    ----------
+    data : DataFrame
+        Contains the SDGE data.
+    as_frame : bool
+        Return the tidy frame of aggregate_avgkwh instead of a dict
 
     Returns
     -------
@@ -39,22 +129,21 @@ def get_avgkwh_per_customer_month(data):
         Dictionary containing the sum of average kWh per month per type of customer
     '''
     
-    assert isinstance(data,pd.DataFrame)
+    avgkwh = aggregate_avgkwh(data,["Month","CustomerClass"])
+    if as_frame:
+        return avgkwh
     
+    # Keep a zero entry for every month and customer pair like the original loops
     months = data["Month"].unique()
     customer = data["CustomerClass"].unique()
-    avgkwh = data["AveragekWh"]
-    
-    avgkwh_cm = {}
-    
-    for m in months:
-        for c in customer:
-            akwh = avgkwh[data["Month"] == m][data["CustomerClass"]==c]
-            avgkwh_cm[str(m)+str(c)] = sum(akwh)
+    avgkwh_cm = {str(m)+str(c): 0 for m in months for c in customer}
+    keys = avgkwh["Month"].astype(str) + avgkwh["CustomerClass"].astype(str)
+    avgkwh_cm.update(zip(keys, avgkwh["AveragekWh"].tolist()))
             
     return avgkwh_cm
 
-def make_figure(data19,data20,customer):
+@instrumented
+def make_figure(data19,data20,customer,ax=None,show=True):
     '''
     
 
@@ -66,20 +155,31 @@ def make_figure(data19,data20,customer):
         2020 electricity consumption across months
     customer: string
         customer class being analysed
+    ax : matplotlib axes
+        Optional axes to draw on. By default the current pyplot axes, or a
+        new detached figure when show is False
+    show : bool
+        Draw through pyplot. False is used for headless rendering
 
     Returns
     -------
-    None
+    A matplotlib figure
 
     '''
     
+    if ax is None:
+        from matplotlib import pyplot as plt
+        ax = plt.gca() if show else new_figure(figsize=(5,3),pyplot=False).add_subplot(111)
+    
     x = np.arange(12)
-    plt.bar(x-0.4,data19,width=0.4,align='edge',color="#219EBC")
+    ax.bar(x-0.4,data19,width=0.4,align='edge',color="#219EBC")
     
-    x = np.arange(9)
-    plt.bar(x,data20,width=0.4,align='edge',color="#FB8500")
+    x = np.arange(len(data20))
+    ax.bar(x,data20,width=0.4,align='edge',color="#FB8500")
     
-    plt.title(customer,fontsize=15)
-    plt.xticks(np.arange(12),['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec'])
-    plt.ylabel("Average Power (MWh) ",fontsize=10)
-    plt.legend(['2019','2020'],bbox_to_anchor=(1.05, 1), loc='upper left')
+    ax.set_title(customer,fontsize=15)
+    ax.set_xticks(np.arange(12))
+    ax.set_xticklabels(['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec'])
+    ax.set_ylabel("Average Power (MWh) ",fontsize=10)
+    ax.legend(['2019','2020'],bbox_to_anchor=(1.05, 1), loc='upper left')
+    return ax.get_figure()